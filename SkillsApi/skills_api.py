@@ -6,23 +6,34 @@ Anthropic Skills API Server
 
 import os
 import asyncio
-import threading
-import queue
+import base64
+import functools
+import hashlib
+import heapq
+import logging
+import math
+import random
+import re
 import time
+import unicodedata
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack, aclosing, asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import json
 
 import anthropic
+import httpx
 from fastapi import FastAPI, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
-from pydantic import BaseModel, Field
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
-from slowapi.util import get_remote_address
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field, model_validator
 
 
 # 加载环境变量
@@ -50,11 +61,32 @@ def load_env():
 
 load_env()
 
+logger = logging.getLogger("skills_api")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动容器预热池和预生成调度；关闭时释放共享的上游连接池"""
+    if CONTAINER_POOL_ENABLED:
+        container_pool.start()
+    if PREGENERATE_ENABLED:
+        pregeneration_scheduler.start()
+    yield
+    await pregeneration_scheduler.stop()
+    await container_pool.stop()
+    await _shutdown_stream_runs()
+    await _shutdown_jobs()
+    await client.close()
+    if _redis_client is not None:
+        await _redis_client.aclose()
+
+
 # 初始化 FastAPI
 app = FastAPI(
     title="Anthropic Skills API",
     description="API for calling various Anthropic Skills with rate limiting",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # 配置 CORS 以允许前端访问
@@ -64,26 +96,549 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["RateLimit-Limit", "RateLimit-Remaining", "RateLimit-Reset", "RateLimit-Policy", "Retry-After"],
 )
 
-# 初始化限流器 (5 requests per second)
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+# ============================================================================
+# 上游限额自适应：根据 anthropic-ratelimit-* 响应头维护剩余额度，
+# 额度不足时在发出请求之前等待，而不是等上游返回 429
+# ============================================================================
+
+UPSTREAM_THROTTLE_ENABLED = os.environ.get("UPSTREAM_THROTTLE_ENABLED", "true").lower() == "true"
+# 单次调用最多等待的时间（秒），超过后照常发出（由 SDK 的重试处理可能的 429）
+UPSTREAM_THROTTLE_MAX_WAIT = float(os.environ.get("UPSTREAM_THROTTLE_MAX_WAIT", "60"))
+# 保留的请求数余量，剩余请求数不超过该值时开始等待
+UPSTREAM_THROTTLE_REQUEST_RESERVE = int(os.environ.get("UPSTREAM_THROTTLE_REQUEST_RESERVE", "1"))
+
+_UPSTREAM_LIMIT_FAMILIES = ("requests", "tokens", "input-tokens", "output-tokens")
+
+
+def _parse_reset(value: str) -> Optional[float]:
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+class UpstreamBudget:
+    """
+    上游剩余额度（每个 worker 独立维护，数据来自上游的组织级响应头）
+
+    每个上游响应都会刷新 requests / tokens / input-tokens / output-tokens 的
+    limit、remaining 和 reset；两次刷新之间按本 worker 发出的请求在本地扣减，
+    避免一批并发请求同时用光额度。上游返回 429 时按 retry-after 暂停发送。
+    """
+
+    def __init__(self):
+        self.limits: Dict[str, Dict[str, Any]] = {}  # family -> {"limit", "remaining", "reset"}
+        self.blocked_until = 0.0
+        self.stats: Dict[str, Any] = {"throttled": 0, "throttle_wait_seconds": 0.0, "upstream_429": 0}
+
+    async def observe(self, response: httpx.Response) -> None:
+        """httpx 响应钩子：读取限额响应头"""
+        headers = response.headers
+        for family in _UPSTREAM_LIMIT_FAMILIES:
+            remaining = headers.get(f"anthropic-ratelimit-{family}-remaining")
+            if remaining is None:
+                continue
+            self.limits[family] = {
+                "limit": int(headers.get(f"anthropic-ratelimit-{family}-limit", remaining)),
+                "remaining": int(remaining),
+                "reset": _parse_reset(headers.get(f"anthropic-ratelimit-{family}-reset", "")),
+            }
+        if response.status_code == 429:
+            self.stats["upstream_429"] += 1
+            retry_after = headers.get("retry-after")
+            if retry_after:
+                try:
+                    self.blocked_until = max(self.blocked_until, time.time() + float(retry_after))
+                except ValueError:
+                    pass
+
+    def _available(self, family: str) -> Optional[Dict[str, Any]]:
+        state = self.limits.get(family)
+        if state is not None and state["reset"] is not None and state["reset"] <= time.time():
+            # 已过重置时间：视为额度已补满，直到下一个响应给出新数据
+            state.update(remaining=state["limit"], reset=None)
+        return state
+
+    def _wait_until(self, input_tokens: int) -> float:
+        """返回需要等待到的时间点，额度足够时返回 0"""
+        now = time.time()
+        wait_until = self.blocked_until if self.blocked_until > now else 0.0
+        needs = {
+            "requests": 1 + UPSTREAM_THROTTLE_REQUEST_RESERVE,
+            "tokens": input_tokens,
+            "input-tokens": input_tokens,
+            "output-tokens": 1,
+        }
+        for family, need in needs.items():
+            state = self._available(family)
+            if state is None or state["remaining"] >= need:
+                continue
+            # 重置时间未知时按一分钟的窗口处理
+            wait_until = max(wait_until, state["reset"] or now + 60)
+        return wait_until
+
+    async def acquire(self, kwargs: Dict[str, Any]) -> None:
+        """发出上游调用前调用：额度不足时等待（最多 UPSTREAM_THROTTLE_MAX_WAIT 秒），然后在本地扣减"""
+        if not UPSTREAM_THROTTLE_ENABLED:
+            return
+        input_tokens = _estimate_tokens(
+            [kwargs.get("system") or "", kwargs.get("tools") or [], kwargs["messages"]]
+        )
+        started = time.time()
+        deadline = started + UPSTREAM_THROTTLE_MAX_WAIT
+        while True:
+            wait_until = min(self._wait_until(input_tokens), deadline)
+            if wait_until <= time.time():
+                break
+            await asyncio.sleep(wait_until - time.time())
+        if time.time() - started > 0.001:
+            self.stats["throttled"] += 1
+            self.stats["throttle_wait_seconds"] += time.time() - started
+
+        for family, used in (("requests", 1), ("tokens", input_tokens), ("input-tokens", input_tokens)):
+            state = self.limits.get(family)
+            if state is not None:
+                state["remaining"] = max(0, state["remaining"] - used)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": UPSTREAM_THROTTLE_ENABLED,
+            "blocked_until": self.blocked_until if self.blocked_until > time.time() else None,
+            "limits": {family: dict(state) for family, state in self.limits.items()},
+        }
+
+
+upstream_budget = UpstreamBudget()
+
 
 # Anthropic 客户端
 api_key = os.environ.get("ANTHROPIC_API_KEY")
 if not api_key:
     raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
 
+# 上游连接池配置（单个 worker 需要同时承载数百个长时间运行的 Skills 调用）
+ANTHROPIC_TIMEOUT = float(os.environ.get("ANTHROPIC_TIMEOUT", "300"))  # 5分钟超时
+ANTHROPIC_MAX_CONNECTIONS = int(os.environ.get("ANTHROPIC_MAX_CONNECTIONS", "1000"))
+ANTHROPIC_MAX_KEEPALIVE = int(os.environ.get("ANTHROPIC_MAX_KEEPALIVE", "100"))
+# 瞬时错误的重试次数，只由 _upstream_call 执行：客户端本身不重试（max_retries=0），
+# 新增的上游调用（消息、Files API 等）必须经过 _upstream_call / _upstream_stream，否则没有任何重试
+ANTHROPIC_MAX_RETRIES = int(os.environ.get("ANTHROPIC_MAX_RETRIES", "2"))
+
+# 共享的异步客户端：所有请求复用同一个连接池，长调用不再阻塞事件循环
 # 设置较长的超时时间（Skills 调用可能需要较长时间执行代码）
-client = anthropic.Anthropic(
+client = anthropic.AsyncAnthropic(
     api_key=api_key,
-    timeout=300.0,  # 5分钟超时
+    timeout=ANTHROPIC_TIMEOUT,
+    max_retries=0,  # 重试与熔断见 _upstream_call
+    http_client=anthropic.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=ANTHROPIC_MAX_CONNECTIONS,
+            max_keepalive_connections=ANTHROPIC_MAX_KEEPALIVE,
+        ),
+        timeout=ANTHROPIC_TIMEOUT,
+        event_hooks={"response": [upstream_budget.observe]},
+    ),
 )
 
+# Skills 调用使用的模型
+SKILL_MODEL = "claude-sonnet-4-5-20250929"
+
 # Beta headers for Skills API and Files API
 BETA_HEADERS = ["code-execution-2025-08-25", "skills-2025-10-02", "files-api-2025-04-14"]
+# 上游返回 pause_turn 时在服务端自动继续的最大次数，0 表示不自动继续
+PAUSE_TURN_MAX_CONTINUATIONS = int(os.environ.get("PAUSE_TURN_MAX_CONTINUATIONS", "5"))
+
+
+# ============================================================================
+# 上游重试与熔断：瞬时错误（529 过载、5xx、连接失败）按带抖动的指数退避重试，
+# 上游持续故障时熔断，直接返回 503 而不再排队等待超时
+# ============================================================================
+
+UPSTREAM_RETRY_BASE_DELAY = float(os.environ.get("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+UPSTREAM_RETRY_MAX_DELAY = float(os.environ.get("UPSTREAM_RETRY_MAX_DELAY", "8"))
+CIRCUIT_BREAKER_ENABLED = os.environ.get("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+# 连续多少次瞬时错误后熔断，熔断多少秒后放行一个探测请求
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5"))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_BREAKER_RESET_TIMEOUT", "30"))
+
+
+def _is_transient(e: anthropic.APIError) -> bool:
+    """与 Anthropic SDK 的判断一致：408 / 409 / 429 / 5xx（含 529 过载）和连接错误可以重试"""
+    if isinstance(e, anthropic.APIStatusError):
+        should_retry = e.response.headers.get("x-should-retry")
+        if should_retry in ("true", "false"):
+            return should_retry == "true"
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return isinstance(e, anthropic.APIConnectionError)
+
+
+def _not_started(e: anthropic.APIError) -> bool:
+    """上游没有执行这次请求（返回了错误状态码或没有建立连接），重发不会重复执行"""
+    if isinstance(e, anthropic.APIStatusError):
+        return True
+    return isinstance(e.__cause__, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def _retry_delay(e: anthropic.APIError, attempt: int) -> float:
+    """全抖动指数退避；上游给出 retry-after 时至少等待该时间"""
+    delay = random.uniform(0, min(UPSTREAM_RETRY_MAX_DELAY, UPSTREAM_RETRY_BASE_DELAY * 2 ** attempt))
+    if isinstance(e, anthropic.APIStatusError):
+        try:
+            delay = max(delay, float(e.response.headers.get("retry-after", 0)))
+        except ValueError:
+            pass
+    return delay
+
+
+class CircuitBreaker:
+    """
+    熔断器（每个 worker 独立）：closed -> 连续失败达到阈值 -> open（快速失败）
+    -> 超过 CIRCUIT_BREAKER_RESET_TIMEOUT -> half_open（只放行一个探测请求）
+    -> 探测成功 closed / 失败重新 open
+
+    429 表示超出额度而不是上游故障（由 upstream_budget 处理），既不计入失败也不算成功。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.changed_at = time.time()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.stats: Dict[str, Any] = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0, "transitions": {}}
+
+    def _transition(self, state: str) -> None:
+        key = f"{self.state}->{state}"
+        self.stats["transitions"][key] = self.stats["transitions"].get(key, 0) + 1
+        logger.warning("upstream circuit %s: %s", self.name, key)
+        self.state = state
+        self.changed_at = time.time()
+        if state == "open":
+            self._opened_at = time.monotonic()
+
+    def before_call(self) -> None:
+        """熔断期间（或探测请求进行中）直接返回 503"""
+        self.stats["calls"] += 1
+        if not CIRCUIT_BREAKER_ENABLED:
+            return
+        if self.state == "open" and time.monotonic() - self._opened_at >= CIRCUIT_BREAKER_RESET_TIMEOUT:
+            self._transition("half_open")
+        if self.state == "open" or (self.state == "half_open" and self._probing):
+            self.stats["rejected"] += 1
+            retry_after = self._opened_at + CIRCUIT_BREAKER_RESET_TIMEOUT - time.monotonic()
+            raise HTTPException(
+                status_code=503,
+                detail="Upstream is unavailable, please retry later",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+        if self.state == "half_open":
+            self._probing = True
+
+    def record(self, failed: Optional[bool]) -> None:
+        """记录一次调用的结果；None 表示调用被取消，不影响状态"""
+        self._probing = False
+        if failed is None or not CIRCUIT_BREAKER_ENABLED:
+            return
+        if not failed:
+            self._failures = 0
+            if self.state != "closed":
+                self._transition("closed")
+            return
+        self.stats["failures"] += 1
+        self._failures += 1
+        if self.state == "half_open" or (
+            self.state == "closed" and self._failures >= CIRCUIT_BREAKER_FAILURE_THRESHOLD
+        ):
+            self._transition("open")
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "state": self.state,
+            "changed_at": datetime.fromtimestamp(self.changed_at).isoformat(),
+            "consecutive_failures": self._failures,
+        }
+
+
+# messages（含流式和 Message Batches）与 files 分别熔断
+circuit_breakers = {"messages": CircuitBreaker("messages"), "files": CircuitBreaker("files")}
+
+
+async def _upstream_call(family: str, call: Callable[[], Any], idempotent: bool = False):
+    """
+    通过熔断器调用上游，瞬时错误最多重试 ANTHROPIC_MAX_RETRIES 次
+
+    非幂等的调用（创建消息）只在上游确定没有执行时重试；
+    剩余时间（请求截止时间）不足以等待退避时不再重试。
+    """
+    breaker = circuit_breakers[family]
+    attempt = 0
+    while True:
+        breaker.before_call()
+        failed = None
+        try:
+            result = await call()
+            failed = False
+            return result
+        except anthropic.APIError as e:
+            transient = _is_transient(e)
+            # 429 不说明上游是否健康：不改变熔断器状态
+            failed = None if getattr(e, "status_code", None) == 429 else transient
+            if not transient or attempt >= ANTHROPIC_MAX_RETRIES or not (idempotent or _not_started(e)):
+                raise
+            delay = _retry_delay(e, attempt)
+            remaining = _remaining_time()
+            if delay > UPSTREAM_RETRY_MAX_DELAY or (remaining is not None and delay >= remaining):
+                raise
+        finally:
+            breaker.record(failed)
+        attempt += 1
+        breaker.stats["retries"] += 1
+        await asyncio.sleep(delay)
+
+
+@asynccontextmanager
+async def _upstream_stream(open_stream: Callable[[], Any]):
+    """打开上游流式调用：收到响应之前的失败按 _upstream_call 的规则重试，之后的事件不重试"""
+    async with AsyncExitStack() as stack:
+        yield await _upstream_call("messages", lambda: stack.enter_async_context(open_stream()))
+
+# 可选的 Redis（多 worker 共享状态）
+SKILLS_REDIS_URL = os.environ.get("SKILLS_REDIS_URL", "")
+_redis_client = None
+
+
+def get_redis():
+    """延迟创建共享的异步 Redis 客户端"""
+    global _redis_client
+    if _redis_client is None:
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError(
+                "SKILLS_REDIS_URL is set but the 'redis' package is not installed"
+            ) from e
+        _redis_client = redis_asyncio.from_url(SKILLS_REDIS_URL, decode_responses=True)
+    return _redis_client
+
+
+# ============================================================================
+# 限流：令牌桶，设置了 SKILLS_REDIS_URL 时由 Redis 原子脚本在多 worker 间共享，
+# Redis 不可用时退回进程内计数
+# ============================================================================
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_STORAGE = os.environ.get("RATE_LIMIT_STORAGE", "redis" if SKILLS_REDIS_URL else "memory")
+# 按路由覆盖装饰器中的默认限额，如 /invoke=10/second,/files=20/second
+RATE_LIMIT_ROUTES = {
+    route.strip(): rate.strip()
+    for route, _, rate in (
+        item.partition("=") for item in os.environ.get("RATE_LIMIT_ROUTES", "").split(",") if "=" in item
+    )
+}
+# 携带该请求头的客户端按 API key 而不是 IP 计数
+RATE_LIMIT_KEY_HEADER = os.environ.get("RATE_LIMIT_KEY_HEADER", "X-API-Key")
+# 每个 API key 在所有路由上的总限额（空表示不限），以及个别 key 的单独限额（key=rate）
+RATE_LIMIT_PER_KEY = os.environ.get("RATE_LIMIT_PER_KEY", "")
+RATE_LIMIT_KEY_LIMITS = {
+    hashlib.sha256(key.strip().encode("utf-8")).hexdigest()[:16]: rate.strip()
+    for key, _, rate in (
+        item.partition("=") for item in os.environ.get("RATE_LIMIT_KEY_LIMITS", "").split(",") if "=" in item
+    )
+}
+# Redis 出错后使用进程内计数的时间（秒），之后重新尝试 Redis
+RATE_LIMIT_FALLBACK_SECONDS = float(os.environ.get("RATE_LIMIT_FALLBACK_SECONDS", "30"))
+
+_RATE_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+# 令牌桶：KEYS[1] 为桶，ARGV 为每秒补充的令牌数和桶容量；使用 Redis 服务器时间，
+# 不受各 worker 时钟偏差影响。返回 {是否放行, 剩余令牌数}
+_TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(tokens)}
+"""
+
+
+def _parse_rate(rate: str) -> Tuple[int, int]:
+    """解析 "5/second"、"100/minute" 形式的限额，返回 (次数, 周期秒数)"""
+    amount, _, period = rate.partition("/")
+    return int(amount), _RATE_PERIODS[period.strip().rstrip("s")]
+
+
+def _client_identity(request: Request) -> str:
+    """限流和公平调度使用的客户端标识：携带 API key 时按 key，否则按 IP"""
+    api_key = request.headers.get(RATE_LIMIT_KEY_HEADER)
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.strip().encode("utf-8")).hexdigest()[:16]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, rate: str, headers: Dict[str, str]):
+        self.rate = rate
+        self.headers = headers
+
+
+class RateLimiter:
+    """
+    令牌桶限流器，接口与原来的 slowapi Limiter 相同（@limiter.limit("5/second")）
+
+    每个 (路由, 客户端) 一个桶，容量为限额次数，按限额速率补充；API key 另有
+    跨路由的总限额。结果以 RateLimit-Limit / RateLimit-Remaining / RateLimit-Reset
+    响应头返回，超限时返回 429 和 Retry-After。
+    """
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}  # key -> (tokens, ts, 补满的时间)
+        self._script = None
+        self._redis_failed_at = 0.0
+        self.stats: Dict[str, int] = {"allowed": 0, "limited": 0, "fallbacks": 0}
+
+    def _hit_local(self, key: str, rate: float, capacity: int) -> float:
+        now = time.monotonic()
+        tokens, ts, _ = self._buckets.get(key, (capacity, now, now))
+        tokens = min(capacity, tokens + (now - ts) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+        if len(self._buckets) > 10000:
+            # 清理已补满的桶（与新建的桶等价）
+            self._buckets = {k: bucket for k, bucket in self._buckets.items() if bucket[2] > now}
+        return tokens if allowed else tokens - 1
+
+    async def _hit(self, key: str, rate: float, capacity: int) -> float:
+        """消耗一个令牌，返回剩余令牌数；被拒绝时返回值小于 0（差额为 1 - 剩余令牌数）"""
+        if RATE_LIMIT_STORAGE == "redis" and time.time() - self._redis_failed_at > RATE_LIMIT_FALLBACK_SECONDS:
+            try:
+                if self._script is None:
+                    self._script = get_redis().register_script(_TOKEN_BUCKET_SCRIPT)
+                allowed, tokens = await self._script(keys=[f"skills:ratelimit:{key}"], args=[rate, capacity])
+                return float(tokens) if int(allowed) else float(tokens) - 1
+            except Exception:
+                self._redis_failed_at = time.time()
+                self.stats["fallbacks"] += 1
+                logger.exception("rate limit storage unreachable, falling back to in-memory counters")
+        return self._hit_local(key, rate, capacity)
+
+    async def check(self, request: Request, default_rate: str) -> None:
+        # 同一个请求只计一次（如 /invoke/{skill_name} 内部复用 invoke_skills）
+        if not RATE_LIMIT_ENABLED or getattr(request.state, "rate_limit_checked", False):
+            return
+        request.state.rate_limit_checked = True
+
+        route = request.scope.get("route")
+        path = route.path if route is not None else request.url.path
+        identity = _client_identity(request)
+        limits = [(f"route:{path}:{identity}", RATE_LIMIT_ROUTES.get(path, default_rate))]
+        if identity.startswith("key:"):
+            key_rate = RATE_LIMIT_KEY_LIMITS.get(identity[4:], RATE_LIMIT_PER_KEY)
+            if key_rate:
+                limits.append((identity, key_rate))
+
+        tightest = None
+        for bucket_key, rate in limits:
+            amount, period = _parse_rate(rate)
+            refill = amount / period
+            remaining = await self._hit(bucket_key, refill, amount)
+            if tightest is None or remaining < tightest[3]:
+                tightest = (rate, amount, period, remaining)
+
+        # 响应头反映剩余额度最少的那个桶
+        rate, amount, period, remaining = tightest
+        refill = amount / period
+        headers = {
+            "RateLimit-Limit": str(amount),
+            "RateLimit-Remaining": str(max(0, int(remaining))),
+            "RateLimit-Reset": str(math.ceil((amount - max(0.0, remaining)) / refill)),
+            "RateLimit-Policy": f"{amount};w={period}",
+        }
+        if remaining < 0:
+            self.stats["limited"] += 1
+            headers["Retry-After"] = str(max(1, math.ceil(-remaining / refill)))
+            raise RateLimitExceeded(rate, headers)
+        self.stats["allowed"] += 1
+        request.state.rate_limit_headers = headers
+
+    def limit(self, rate: str):
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                request = kwargs.get("request")
+                if request is None:
+                    request = next(arg for arg in args if isinstance(arg, Request))
+                await self.check(request, rate)
+                return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": RATE_LIMIT_ENABLED,
+            "storage": RATE_LIMIT_STORAGE,
+            "fallback_active": time.time() - self._redis_failed_at <= RATE_LIMIT_FALLBACK_SECONDS,
+        }
+
+
+class RateLimitHeadersMiddleware:
+    """把限流检查得到的 RateLimit-* 头加到响应上（包括流式响应）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        state = scope.setdefault("state", {})
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start" and state.get("rate_limit_headers"):
+                message = dict(message, headers=[
+                    *message.get("headers", []),
+                    *((name.lower().encode("latin-1"), value.encode("latin-1"))
+                      for name, value in state["rate_limit_headers"].items()),
+                ])
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+async def _rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded) -> JSONResponse:
+    amount, period = _parse_rate(exc.rate)
+    unit = next(name for name, seconds in _RATE_PERIODS.items() if seconds == period)
+    return JSONResponse(
+        status_code=429,
+        content={"error": f"Rate limit exceeded: {amount} per 1 {unit}"},
+        headers=exc.headers,
+    )
+
+
+limiter = RateLimiter()
+app.add_middleware(RateLimitHeadersMiddleware)
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 
 # Skills 配置
@@ -149,6 +704,17 @@ class SkillRequest(BaseModel):
     container_id: Optional[str] = Field(
         None, description="Reuse existing container ID for multi-turn conversations"
     )
+    parallel: bool = Field(
+        default=False,
+        description="Fan-out: run each skill in its own container concurrently and merge the results",
+    )
+
+    @model_validator(mode="after")
+    def _check_parallel(self):
+        # 并行模式下每个 Skill 使用各自的容器，无法复用同一个容器
+        if self.parallel and self.container_id:
+            raise ValueError("container_id cannot be combined with parallel")
+        return self
 
 
 class SkillResponse(BaseModel):
@@ -159,6 +725,9 @@ class SkillResponse(BaseModel):
     response: List[Dict[str, Any]]
     usage: Dict[str, int]
     file_ids: List[str] = Field(default_factory=list, description="List of file IDs generated during execution")
+    branches: Optional[List[Dict[str, Any]]] = Field(
+        None, description="Per-skill results (container_id, stop_reason, usage, file_ids) in parallel mode"
+    )
 
 
 class FileDownloadResponse(BaseModel):
@@ -169,512 +738,3649 @@ class FileDownloadResponse(BaseModel):
     content_type: str
 
 
-# API 路由
+# 用量统计（包括被取消或失败的上游调用）
+USAGE_TOTALS: Dict[str, int] = {
+    "requests": 0,
+    "completed": 0,
+    "cancelled": 0,
+    "failed": 0,
+    "input_tokens": 0,
+    "output_tokens": 0,
+    "cache_creation_input_tokens": 0,
+    "cache_read_input_tokens": 0,
+}
 
+USAGE_TOKEN_KEYS = (
+    "input_tokens",
+    "output_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens",
+)
 
-@app.get("/")
-async def root():
-    """API 根路径"""
-    return {
-        "message": "Anthropic Skills API Server",
-        "version": "1.0.0",
-        "rate_limit": "5 requests per second",
-        "docs": "/docs",
-    }
 
+def _usage_dict(usage) -> Dict[str, int]:
+    """把 SDK 返回的 usage 对象转换为 dict（input_tokens 不含写入 / 命中提示词缓存的部分）"""
+    return {key: getattr(usage, key, 0) or 0 for key in USAGE_TOKEN_KEYS}
 
-@app.get("/skills")
-async def list_skills():
-    """列出所有可用的 Skills"""
-    return {"total": len(SKILLS_METADATA), "skills": SKILLS_METADATA}
 
+def _partial_usage(stream) -> Optional[Dict[str, int]]:
+    """读取流式调用到目前为止上游报告的用量，尚未收到 message_start 时返回 None"""
+    try:
+        return _usage_dict(stream.current_message_snapshot.usage)
+    except (AssertionError, AttributeError):
+        return None
 
-@app.post("/invoke", response_model=SkillResponse)
-@limiter.limit("5/second")
-async def invoke_skills(request: Request, skill_request: SkillRequest):
+
+def _record_usage(endpoint: str, usage: Optional[Dict[str, int]], outcome: str):
+    """记录一次上游调用的 token 用量，outcome 为 completed / cancelled / failed"""
+    USAGE_TOTALS["requests"] += 1
+    USAGE_TOTALS[outcome] += 1
+    for key in USAGE_TOKEN_KEYS:
+        USAGE_TOTALS[key] += (usage or {}).get(key, 0)
+    logger.info("usage endpoint=%s outcome=%s usage=%s", endpoint, outcome, usage)
+
+
+# ============================================================================
+# 提示词缓存 (Anthropic prompt caching)：在稳定前缀末尾自动设置 cache_control 断点
+# ============================================================================
+
+PROMPT_CACHE_ENABLED = os.environ.get("PROMPT_CACHE_ENABLED", "true").lower() == "true"
+# 设置断点的位置：tools（工具定义）、system（系统提示词）、messages（对话前缀）
+PROMPT_CACHE_BREAKPOINTS = {
+    item.strip()
+    for item in os.environ.get("PROMPT_CACHE_BREAKPOINTS", "tools,system,messages").split(",")
+    if item.strip()
+}
+PROMPT_CACHE_TTL = os.environ.get("PROMPT_CACHE_TTL", "5m")  # 5m / 1h
+
+
+def _cache_control() -> Dict[str, str]:
+    if PROMPT_CACHE_TTL == "5m":
+        return {"type": "ephemeral"}
+    return {"type": "ephemeral", "ttl": PROMPT_CACHE_TTL}
+
+
+def _with_cache_breakpoint(content):
+    """返回在最后一个内容块上设置了 cache_control 的副本"""
+    if isinstance(content, str):
+        # 空文本块不能设置 cache_control
+        return [{"type": "text", "text": content, "cache_control": _cache_control()}] if content else content
+    if not content:
+        return content
+    blocks = [dict(block) for block in content]
+    blocks[-1]["cache_control"] = _cache_control()
+    return blocks
+
+
+def _with_prompt_cache(kwargs: Dict[str, Any]) -> Dict[str, Any]:
     """
-    调用指定的 Skills
+    给上游请求参数自动加上提示词缓存断点（不修改传入的参数）
 
-    Rate Limit: 5 requests per second
+    断点依次设在：最后一个工具定义、system 末尾、最近两条 user 消息末尾，
+    共不超过 Anthropic 允许的 4 个。多轮对话每次都会重发不断增长的历史，
+    上一轮的前缀命中缓存后按缓存读取计费，并省去这部分的 prefill 时间；
+    前缀不足最小缓存长度时上游直接忽略断点。
     """
-    # 验证 skill_ids 数量
-    if len(skill_request.skill_ids) > 8:
-        raise HTTPException(
-            status_code=400, detail="Maximum 8 skills allowed per request"
-        )
+    if not PROMPT_CACHE_ENABLED:
+        return kwargs
+    kwargs = dict(kwargs)
 
-    # 验证 skill_ids 是否存在
-    invalid_skills = [
-        sid for sid in skill_request.skill_ids if sid not in SKILLS_METADATA
-    ]
-    if invalid_skills:
-        raise HTTPException(
-            status_code=400, detail=f"Invalid skill IDs: {invalid_skills}"
-        )
+    if "tools" in PROMPT_CACHE_BREAKPOINTS and kwargs.get("tools"):
+        kwargs["tools"] = _with_cache_breakpoint(kwargs["tools"])
 
-    # 构建 skills 配置
-    skills_config = []
-    for skill_id in skill_request.skill_ids:
-        metadata = SKILLS_METADATA[skill_id]
-        skills_config.append(
-            {"type": metadata["type"], "skill_id": skill_id, "version": "latest"}
-        )
+    if "system" in PROMPT_CACHE_BREAKPOINTS and kwargs.get("system"):
+        kwargs["system"] = _with_cache_breakpoint(kwargs["system"])
 
-    try:
-        # 构建容器配置
-        container = {"skills": skills_config}
-        if skill_request.container_id:
-            container["id"] = skill_request.container_id
+    if "messages" in PROMPT_CACHE_BREAKPOINTS:
+        messages = list(kwargs["messages"])
+        user_indexes = [i for i, m in enumerate(messages) if m["role"] == "user"]
+        for i in user_indexes[-2:]:
+            messages[i] = dict(messages[i], content=_with_cache_breakpoint(messages[i]["content"]))
+        kwargs["messages"] = messages
 
-        # 调用 Anthropic API
-        response = client.beta.messages.create(
-            model="claude-sonnet-4-5-20250929",
-            max_tokens=skill_request.max_tokens,
-            betas=BETA_HEADERS,
-            container=container,
-            messages=[{"role": "user", "content": skill_request.message}],
-            tools=[{"type": "code_execution_20250825", "name": "code_execution"}],
-        )
+    return kwargs
 
-        # 处理响应内容并提取 file_ids
-        response_content = []
-        file_ids = []
 
-        for content in response.content:
-            if hasattr(content, "text"):
-                response_content.append({"type": "text", "text": content.text})
-            elif content.type == "bash_code_execution_tool_result":
-                # 从 bash 结果中提取 file_ids
-                result_content = getattr(content, "content", None)
-                if result_content and hasattr(result_content, "type"):
-                    if result_content.type == "bash_code_execution_result":
-                        for item in getattr(result_content, "content", []):
-                            if hasattr(item, "file_id") and item.file_id:
-                                file_ids.append(item.file_id)
-                response_content.append({"type": content.type, "data": str(content)})
-            else:
-                response_content.append({"type": content.type, "data": str(content)})
-
-        return SkillResponse(
-            status="success",
-            container_id=response.container.id
-            if hasattr(response, "container") and response.container
-            else "",
-            stop_reason=response.stop_reason,
-            model=response.model,
-            response=response_content,
-            usage={
-                "input_tokens": response.usage.input_tokens,
-                "output_tokens": response.usage.output_tokens,
-            },
-            file_ids=file_ids,
-        )
+# ============================================================================
+# 历史压缩：多轮对话超出 token 预算时，保留最近几轮原文，压缩更早的轮次
+# ============================================================================
 
-    except anthropic.APIError as e:
-        raise HTTPException(status_code=500, detail=f"Anthropic API Error: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+HISTORY_COMPACTION_ENABLED = os.environ.get("HISTORY_COMPACTION_ENABLED", "true").lower() == "true"
+# 历史消息估算 token 数超过预算时触发压缩，压缩到 预算 × HISTORY_COMPACTION_TARGET 以下
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "120000"))
+HISTORY_COMPACTION_TARGET = float(os.environ.get("HISTORY_COMPACTION_TARGET", "0.6"))
+# 原样保留的最近轮数，至少保留当前这一轮
+HISTORY_KEEP_TURNS = max(1, int(os.environ.get("HISTORY_KEEP_TURNS", "4")))
+HISTORY_TOOL_OUTPUT_CHARS = int(os.environ.get("HISTORY_TOOL_OUTPUT_CHARS", "2000"))
+HISTORY_SUMMARY_CHARS = int(os.environ.get("HISTORY_SUMMARY_CHARS", "300"))
 
+HISTORY_SUMMARY_MARKER = "[Earlier conversation, compacted]"
 
-@app.post("/invoke/{skill_name}")
-@limiter.limit("5/second")
-async def invoke_single_skill(
-    request: Request, skill_name: str, message: str, max_tokens: int = 4096
-):
+COMPACTION_STATS: Dict[str, int] = {"compacted_requests": 0, "tokens_saved": 0, "turns_dropped": 0}
+
+
+def _estimate_tokens(value) -> int:
+    """离线估算 token 数：中日韩字符约 1 token / 字，其余约 4 字符 / token"""
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide) // 4 + 1
+
+
+def _is_turn_start(message: Dict[str, Any]) -> bool:
+    """用户发起新一轮的消息（不是只包含工具结果的 user 消息）"""
+    if message["role"] != "user":
+        return False
+    content = message["content"]
+    return isinstance(content, str) or any(block.get("type") == "text" for block in content)
+
+
+def _message_text(message: Dict[str, Any]) -> str:
+    content = message["content"]
+    if isinstance(content, str):
+        return content
+    return " ".join(block.get("text", "") for block in content if block.get("type") == "text")
+
+
+def _truncate_strings(value, max_chars: int):
+    """截断嵌套结构中过长的字符串，保持工具调用 / 结果块的结构不变"""
+    if isinstance(value, str):
+        if len(value) > max_chars:
+            return f"{value[:max_chars]}\n...[truncated {len(value) - max_chars} chars]"
+        return value
+    if isinstance(value, list):
+        return [_truncate_strings(item, max_chars) for item in value]
+    if isinstance(value, dict):
+        return {key: _truncate_strings(item, max_chars) for key, item in value.items()}
+    return value
+
+
+def _compact_history(messages: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
     """
-    调用单个 Skill (简化版接口)
+    按 token 预算压缩对话历史，返回 (压缩后的消息, 节省的估算 token 数)
 
-    Rate Limit: 5 requests per second
+    未超出 HISTORY_TOKEN_BUDGET 时原样返回。超出时先截断早期轮次中的工具调用和
+    工具输出，仍然超出目标时再把最早的轮次合并成一段摘要，放在保留下来的第一条
+    user 消息开头；最近 HISTORY_KEEP_TURNS 轮始终原样保留。压缩到预算以下的
+    目标值（而不是刚好等于预算），之后几轮的前缀保持不变，仍能命中提示词缓存。
     """
-    # 查找 skill ID
-    skill_id = None
-    for sid, metadata in SKILLS_METADATA.items():
-        if (
-            sid == skill_name
-            or metadata["name"].lower().replace(" ", "-") == skill_name.lower()
-        ):
-            skill_id = sid
+    if not HISTORY_COMPACTION_ENABLED:
+        return messages, 0
+    before = _estimate_tokens(messages)
+    if before <= HISTORY_TOKEN_BUDGET:
+        return messages, 0
+    target = HISTORY_TOKEN_BUDGET * HISTORY_COMPACTION_TARGET
+
+    turn_starts = [i for i, message in enumerate(messages) if _is_turn_start(message)]
+    if len(turn_starts) <= HISTORY_KEEP_TURNS:
+        return messages, 0
+    keep_from = turn_starts[-HISTORY_KEEP_TURNS]
+
+    # 第一步：截断早期轮次中的工具调用和工具输出
+    older = [
+        message if isinstance(message["content"], str) else dict(message, content=[
+            block if block.get("type") == "text" else _truncate_strings(block, HISTORY_TOOL_OUTPUT_CHARS)
+            for block in message["content"]
+        ])
+        for message in messages[:keep_from]
+    ]
+    compacted = older + messages[keep_from:]
+
+    # 第二步：把最早的轮次合并为摘要，直到低于目标或只剩保留的轮次
+    summary_lines: List[str] = []
+    dropped = 0
+    while _estimate_tokens(compacted) + _estimate_tokens(summary_lines) > target:
+        starts = [i for i, message in enumerate(compacted) if _is_turn_start(message)]
+        if len(starts) <= HISTORY_KEEP_TURNS:
             break
+        for message in compacted[:starts[1]]:
+            content = message["content"]
+            if not isinstance(content, str) and content and content[0].get("text", "").startswith(
+                HISTORY_SUMMARY_MARKER
+            ):
+                # 之前压缩留下的摘要原样并入
+                summary_lines.extend(content[0]["text"].splitlines()[1:])
+                message = dict(message, content=content[1:])
+            text = _message_text(message)
+            if text:
+                summary_lines.append(f"{message['role']}: {text[:HISTORY_SUMMARY_CHARS]}")
+        compacted = compacted[starts[1]:]
+        dropped += 1
+
+    if summary_lines:
+        first = compacted[0]
+        content = first["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        summary = "\n".join([HISTORY_SUMMARY_MARKER, *summary_lines])
+        compacted = [dict(first, content=[{"type": "text", "text": summary}, *content]), *compacted[1:]]
+
+    saved = before - _estimate_tokens(compacted)
+    if saved <= 0:
+        return messages, 0
+    COMPACTION_STATS["compacted_requests"] += 1
+    COMPACTION_STATS["tokens_saved"] += saved
+    COMPACTION_STATS["turns_dropped"] += dropped
+    logger.info("history compacted: ~%d tokens saved, %d turns summarized", saved, dropped)
+    return compacted, saved
 
-    if not skill_id:
-        raise HTTPException(status_code=404, detail=f"Skill '{skill_name}' not found")
 
-    # 复用 invoke_skills 逻辑
-    skill_request = SkillRequest(
-        skill_ids=[skill_id], message=message, max_tokens=max_tokens
+# ============================================================================
+# 结果缓存：相同请求直接返回已有结果（进程内 LRU + 可选的 Redis / 磁盘二级缓存）
+# ============================================================================
+
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "false").lower() == "true"
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "512"))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", "3600"))
+# 按 Skill 覆盖 TTL，格式 "skill_id=秒,skill_id=秒"，0 表示该 Skill 不缓存
+RESULT_CACHE_TTLS = {
+    skill_id.strip(): int(ttl)
+    for skill_id, _, ttl in (
+        item.partition("=") for item in os.environ.get("RESULT_CACHE_TTLS", "").split(",") if "=" in item
     )
+}
+# 二级缓存：none / redis / disk
+RESULT_CACHE_L2 = os.environ.get("RESULT_CACHE_L2", "redis" if SKILLS_REDIS_URL else "none")
+RESULT_CACHE_DIR = Path(os.environ.get("RESULT_CACHE_DIR", str(Path(__file__).parent / ".cache" / "results")))
 
-    return await invoke_skills(request, skill_request)
+# 只缓存完整结束的结果
+CACHEABLE_STOP_REASONS = ("end_turn", "stop_sequence")
 
 
-@app.post("/stream/invoke")
-@limiter.limit("5/second")
-async def invoke_skills_stream(request: Request, skill_request: SkillRequest):
-    """
-    调用指定的 Skills (流式响应)
+class RedisCacheTier:
+    """Redis 二级缓存（多 worker 共享）"""
 
-    返回 Server-Sent Events (SSE) 格式的流式响应
-    Rate Limit: 5 requests per second
+    async def get(self, key: str) -> Optional[Any]:
+        raw = await get_redis().get(key)
+        return json.loads(raw) if raw is not None else None
 
-    使用线程和队列来支持keepalive heartbeat，避免长时间无事件导致连接超时
-    """
-    # 验证 skill_ids 数量
-    if len(skill_request.skill_ids) > 8:
-        raise HTTPException(
-            status_code=400, detail="Maximum 8 skills allowed per request"
-        )
+    async def set(self, key: str, value: Any, ttl: int) -> None:
+        await get_redis().set(key, json.dumps(value, ensure_ascii=False), ex=ttl)
 
-    # 验证 skill_ids 是否存在
-    invalid_skills = [
-        sid for sid in skill_request.skill_ids if sid not in SKILLS_METADATA
-    ]
-    if invalid_skills:
-        raise HTTPException(
-            status_code=400, detail=f"Invalid skill IDs: {invalid_skills}"
-        )
 
-    # 构建 skills 配置
-    skills_config = []
-    for skill_id in skill_request.skill_ids:
-        metadata = SKILLS_METADATA[skill_id]
-        skills_config.append(
-            {"type": metadata["type"], "skill_id": skill_id, "version": "latest"}
-        )
+class DiskCacheTier:
+    """本地磁盘二级缓存（单机多 worker 共享，重启后保留）"""
 
-    # 使用队列在线程间传递数据
-    event_queue = queue.Queue()
+    def __init__(self, directory: Path):
+        self.directory = directory
 
-    # 用于跟踪当前正在执行的内容块
-    current_blocks = {}
-    step_counter = [0]  # 使用列表以便在闭包中修改
-    active_steps_info = {}  # 跟踪每个 block_index 对应的 step_number
-    collected_file_ids = []  # 收集执行过程中产生的文件ID
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key.rsplit(':', 1)[-1]}.json"
 
-    def run_anthropic_stream():
-        """在单独线程中运行Anthropic流式调用"""
+    def _read(self, key: str) -> Optional[Any]:
+        path = self._path(key)
         try:
-            # 构建容器配置
-            container = {"skills": skills_config}
-            if skill_request.container_id:
-                container["id"] = skill_request.container_id
-
-            # 调用 Anthropic API (流式)
-            with client.beta.messages.stream(
-                model="claude-sonnet-4-5-20250929",
-                max_tokens=skill_request.max_tokens,
-                betas=BETA_HEADERS,
-                container=container,
-                messages=[{"role": "user", "content": skill_request.message}],
-                tools=[{"type": "code_execution_20250825", "name": "code_execution"}],
-            ) as stream:
-                for event in stream:
-                    # 处理不同类型的事件
-                    if hasattr(event, "type"):
-                        if event.type == "content_block_delta":
-                            if hasattr(event.delta, "text"):
-                                # 文本增量
-                                event_queue.put({"type": "text_delta", "text": event.delta.text})
-                            # 处理 code_execution 的输入增量
-                            elif hasattr(event.delta, "type"):
-                                if event.delta.type == "code_execution_input_json_delta":
-                                    # 代码输入增量
-                                    if hasattr(event.delta, "partial_json"):
-                                        event_queue.put({
-                                            "type": "code_input_delta",
-                                            "partial_json": event.delta.partial_json,
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["expires_at"] < time.time():
+            path.unlink(missing_ok=True)
+            return None
+        return entry["value"]
+
+    def _write(self, key: str, value: Any, ttl: int) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"expires_at": time.time() + ttl, "value": value}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self._read, key)
+
+    async def set(self, key: str, value: Any, ttl: int) -> None:
+        await asyncio.to_thread(self._write, key, value, ttl)
+
+
+class ResultCache:
+    """两级结果缓存：进程内按条目数限制的 LRU，未命中时再查二级缓存"""
+
+    def __init__(self, max_entries: int, l2=None):
+        self.max_entries = max_entries
+        self.l2 = l2
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self.stats: Dict[str, int] = {"hits": 0, "l2_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _put_local(self, key: str, value: Any, expires_at: float) -> None:
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            del self._entries[key]
+
+        if self.l2 is not None:
+            try:
+                value = await self.l2.get(key)
+            except Exception:
+                logger.exception("result cache L2 read failed")
+                value = None
+            if value is not None:
+                # 回填到内存，过期时间与二级缓存中的条目一致
+                self._put_local(key, value, value["cached_at"] + value["ttl"])
+                self.stats["l2_hits"] += 1
+                return value
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: Dict[str, Any], ttl: int) -> None:
+        if ttl <= 0:
+            return
+        value = dict(value, ttl=ttl, cached_at=time.time())
+        self._put_local(key, value, time.time() + ttl)
+        self.stats["stores"] += 1
+        if self.l2 is not None:
+            try:
+                await self.l2.set(key, value, ttl)
+            except Exception:
+                logger.exception("result cache L2 write failed")
+
+
+if RESULT_CACHE_L2 == "redis":
+    result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, RedisCacheTier())
+elif RESULT_CACHE_L2 == "disk":
+    result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, DiskCacheTier(RESULT_CACHE_DIR))
+else:
+    result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES)
+
+
+def _cache_key(kind: str, **parts) -> str:
+    """由规范化后的请求内容生成缓存 key"""
+    payload = json.dumps({"kind": kind, **parts}, sort_keys=True, ensure_ascii=False)
+    return f"skills:cache:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+def _skill_cache_ttl(skill_ids: List[str]) -> int:
+    """请求涉及多个 Skill 时取最短的 TTL"""
+    return min(RESULT_CACHE_TTLS.get(skill_id, RESULT_CACHE_TTL) for skill_id in skill_ids)
+
+
+def _skill_cache_key(request: Optional[Request], skill_request: SkillRequest) -> Optional[str]:
+    """
+    返回 Skill 请求的缓存 key，不可缓存时返回 None
+
+    多轮对话（带 container_id）依赖容器状态，不缓存；
+    客户端可以用 Cache-Control: no-cache / no-store 跳过缓存。
+    后台预生成没有客户端请求，request 为 None。
+    """
+    if not RESULT_CACHE_ENABLED or skill_request.container_id:
+        return None
+    if request is not None and "no-" in request.headers.get("cache-control", ""):
+        return None
+    if _skill_cache_ttl(skill_request.skill_ids) <= 0:
+        return None
+    return _cache_key(
+        "skill",
+        skill_ids=sorted(set(skill_request.skill_ids)),
+        message=skill_request.message.strip(),
+        max_tokens=skill_request.max_tokens,
+        model=SKILL_MODEL,
+        **({"parallel": True} if skill_request.parallel else {}),
+    )
+
+
+def _events_from_skill_response(skill_response: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """由 /invoke 的缓存结果合成与 /stream/invoke 相同格式的事件序列"""
+    events: List[Dict[str, Any]] = [{"type": "message_start"}]
+    for index, block in enumerate(skill_response["response"]):
+        if block.get("type") == "text":
+            events.append({"type": "content_start", "content_type": "text", "index": index})
+            events.append({"type": "text_delta", "text": block["text"]})
+            events.append({"type": "content_stop", "content_type": "text", "index": index})
+    events.append({"type": "message_stop", "total_steps": 0})
+    events.append({
+        "type": "done",
+        "container_id": skill_response["container_id"],
+        "stop_reason": skill_response["stop_reason"],
+        "usage": skill_response["usage"],
+        "file_ids": skill_response["file_ids"] or None,
+        **({"branches": skill_response["branches"]} if skill_response.get("branches") else {}),
+    })
+    return events
+
+
+async def _replay_events(events: List[Dict[str, Any]]):
+    for event in events:
+        yield event
+
+
+# 只对当次执行有意义的事件（排队位置、自动继续的次数），不写入缓存，回放时不再发送
+_LIVE_ONLY_EVENT_TYPES = {"queued", "continuation"}
+
+
+async def _caching_skill_events(events, final_response: List[SkillResponse], store):
+    """转发流式事件，执行成功结束后把事件序列和最终结果交给 store 写入缓存"""
+    recorded = []
+    async with aclosing(events):
+        async for event in events:
+            if event.get("type") not in _LIVE_ONLY_EVENT_TYPES:
+                recorded.append(event)
+            yield event
+            if event.get("type") == "done" and event.get("stop_reason") in CACHEABLE_STOP_REASONS:
+                value = {"events": recorded}
+                if final_response:
+                    value["response"] = final_response[0].model_dump()
+                await store(value)
+
+
+# ============================================================================
+# 近似重复提示词缓存：只有空白、标点或少量措辞不同的请求复用已有结果
+# ============================================================================
+
+SIMILARITY_CACHE_ENABLED = os.environ.get("SIMILARITY_CACHE_ENABLED", "false").lower() == "true"
+# 字符 shingle 集合的 Jaccard 相似度阈值
+SIMILARITY_CACHE_THRESHOLD = float(os.environ.get("SIMILARITY_CACHE_THRESHOLD", "0.8"))
+# 启用的 Skill，默认为 SKILLS_METADATA 中的全部自定义 Skill
+SIMILARITY_CACHE_SKILLS = {
+    skill_id.strip()
+    for skill_id in os.environ.get(
+        "SIMILARITY_CACHE_SKILLS",
+        ",".join(sid for sid, metadata in SKILLS_METADATA.items() if metadata["type"] == "custom"),
+    ).split(",")
+    if skill_id.strip()
+}
+SIMILARITY_CACHE_MAX_ENTRIES = int(os.environ.get("SIMILARITY_CACHE_MAX_ENTRIES", "1024"))
+SIMILARITY_CACHE_NUM_PERM = int(os.environ.get("SIMILARITY_CACHE_NUM_PERM", "128"))
+SIMILARITY_CACHE_BANDS = int(os.environ.get("SIMILARITY_CACHE_BANDS", "32"))
+# 中文提示词按字符二元组切分效果最好
+SIMILARITY_CACHE_SHINGLE_SIZE = int(os.environ.get("SIMILARITY_CACHE_SHINGLE_SIZE", "2"))
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+
+class SimilarityCache:
+    """
+    近似重复提示词缓存（进程内，离线计算）
+
+    提示词规范化（NFKC、小写、去掉空白和标点）后切成字符 shingle，计算 MinHash 签名；
+    签名按 LSH 分段入桶，查询时只比较至少一段相同的候选，再用 shingle 集合的
+    精确 Jaccard 相似度确认是否达到阈值。
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        threshold: float,
+        num_perm: int = 128,
+        bands: int = 32,
+        shingle_size: int = 2,
+    ):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = max(num_perm // bands, 1)
+        self.shingle_size = shingle_size
+        # 固定种子，保证各 worker、重启前后的签名一致
+        rng = random.Random(20251002)
+        self._perms = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(self.bands * self.rows)
+        ]
+        # entry_id -> (expires_at, shingles, band_keys, value)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._buckets: Dict[tuple, set] = {}
+        self._next_id = 0
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        text = unicodedata.normalize("NFKC", text).lower()
+        # 去掉标点（P）、符号（S）、空白（Z）和控制字符（C）
+        return "".join(ch for ch in text if unicodedata.category(ch)[0] not in "PSZC")
+
+    def _shingles(self, text: str) -> frozenset:
+        text = self.normalize(text)
+        if len(text) <= self.shingle_size:
+            return frozenset([text])
+        return frozenset(text[i:i + self.shingle_size] for i in range(len(text) - self.shingle_size + 1))
+
+    def _band_keys(self, scope: str, shingles: frozenset) -> List[tuple]:
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+            for shingle in shingles
+        ]
+        signature = [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self._perms]
+        return [
+            (scope, band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def _fingerprint(self, scope: str, text: str):
+        shingles = self._shingles(text)
+        return shingles, self._band_keys(scope, shingles)
+
+    def _remove(self, entry_id: int) -> None:
+        _, _, band_keys, _ = self._entries.pop(entry_id)
+        for band_key in band_keys:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    async def get(self, scope: str, text: str) -> Optional[Tuple[Dict[str, Any], float]]:
+        """返回 (缓存值, 相似度)，没有达到阈值的条目时返回 None"""
+        # 签名计算是纯 CPU 操作，放到线程中避免阻塞事件循环
+        shingles, band_keys = await asyncio.to_thread(self._fingerprint, scope, text)
+        candidates = set()
+        for band_key in band_keys:
+            candidates.update(self._buckets.get(band_key, ()))
+
+        now = time.time()
+        best_id, best_score = None, 0.0
+        for entry_id in candidates:
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                continue
+            if entry[0] <= now:
+                self._remove(entry_id)
+                continue
+            score = len(shingles & entry[1]) / len(shingles | entry[1])
+            if score > best_score:
+                best_id, best_score = entry_id, score
+
+        if best_id is None or best_score < self.threshold:
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(best_id)
+        self.stats["hits"] += 1
+        return self._entries[best_id][3], best_score
+
+    async def set(self, scope: str, text: str, value: Dict[str, Any], ttl: int) -> None:
+        if ttl <= 0:
+            return
+        shingles, band_keys = await asyncio.to_thread(self._fingerprint, scope, text)
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (time.time() + ttl, shingles, band_keys, value)
+        for band_key in band_keys:
+            self._buckets.setdefault(band_key, set()).add(entry_id)
+        self.stats["stores"] += 1
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+
+similarity_cache = SimilarityCache(
+    SIMILARITY_CACHE_MAX_ENTRIES,
+    SIMILARITY_CACHE_THRESHOLD,
+    num_perm=SIMILARITY_CACHE_NUM_PERM,
+    bands=SIMILARITY_CACHE_BANDS,
+    shingle_size=SIMILARITY_CACHE_SHINGLE_SIZE,
+)
+
+
+def _similarity_scope(request: Optional[Request], skill_request: SkillRequest) -> Optional[str]:
+    """
+    返回近似缓存的分组 key，不可使用近似缓存时返回 None
+
+    只有请求中的 Skill 全部启用了近似缓存时才使用；Skill 组合、max_tokens 和模型
+    必须完全相同，只有提示词允许近似。提示词中的数字（预算、面积、日期等）也必须
+    相同，避免"预算 200 万"的请求拿到"预算 300 万"的报告。
+    """
+    if not SIMILARITY_CACHE_ENABLED or skill_request.container_id:
+        return None
+    if not set(skill_request.skill_ids) <= SIMILARITY_CACHE_SKILLS:
+        return None
+    if request is not None and "no-" in request.headers.get("cache-control", ""):
+        return None
+    if _skill_cache_ttl(skill_request.skill_ids) <= 0:
+        return None
+    numbers = sorted(_NUMBER_PATTERN.findall(unicodedata.normalize("NFKC", skill_request.message)))
+    scope = [sorted(set(skill_request.skill_ids)), skill_request.max_tokens, SKILL_MODEL, numbers]
+    if skill_request.parallel:
+        scope.append("parallel")
+    return json.dumps(scope)
+
+
+async def _store_skill_result(
+    skill_request: SkillRequest,
+    cache_key: Optional[str],
+    similarity_scope: Optional[str],
+    value: Dict[str, Any],
+) -> None:
+    """把成功结束的 Skill 结果写入精确缓存和近似缓存"""
+    ttl = _skill_cache_ttl(skill_request.skill_ids)
+    if cache_key:
+        await result_cache.set(cache_key, value, ttl)
+    if similarity_scope:
+        await similarity_cache.set(similarity_scope, skill_request.message, value, ttl)
+
+
+# ============================================================================
+# 请求合并 (single-flight)：相同请求同时在执行时共享同一次上游调用
+# ============================================================================
+
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+# 执行中的 /invoke 调用：合并 key -> 上游调用任务
+_inflight_invokes: Dict[str, asyncio.Task] = {}
+# 执行中的 /stream/invoke 调用：合并 key -> stream_id
+_inflight_streams: Dict[str, str] = {}
+
+COALESCE_STATS: Dict[str, int] = {"invoke_started": 0, "invoke_joined": 0, "stream_joined": 0}
+
+
+def _flight_key(request: Request, skill_request: SkillRequest) -> Optional[str]:
+    """
+    返回请求合并 key，不合并时返回 None
+
+    与缓存 key 的规范化方式相同，但包含 container_id：同一容器上的重复请求
+    （如客户端重试）同样只执行一次。Cache-Control: no-cache / no-store 跳过合并；
+    带 Idempotency-Key 的请求由幂等记录去重，也不参与合并。
+    """
+    if not SINGLE_FLIGHT_ENABLED or request.headers.get("idempotency-key"):
+        return None
+    if "no-" in request.headers.get("cache-control", ""):
+        return None
+    return _cache_key(
+        "flight",
+        skill_ids=sorted(set(skill_request.skill_ids)),
+        message=skill_request.message.strip(),
+        max_tokens=skill_request.max_tokens,
+        container_id=skill_request.container_id or "",
+        model=SKILL_MODEL,
+        **({"parallel": True} if skill_request.parallel else {}),
+    )
+
+
+def _coalesce_metrics() -> Dict[str, Any]:
+    return {
+        **COALESCE_STATS,
+        "enabled": SINGLE_FLIGHT_ENABLED,
+        "invokes_in_flight": len(_inflight_invokes),
+        "streams_in_flight": len(_inflight_streams),
+    }
+
+
+# ============================================================================
+# 幂等键：携带 Idempotency-Key 的重试请求返回或重新订阅原来的执行
+# ============================================================================
+
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", "86400"))  # 幂等记录保留 24 小时
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", "1024"))
+
+# 已完成的执行结果（设置了 SKILLS_REDIS_URL 时在多 worker 间共享）
+idempotency_store = ResultCache(IDEMPOTENCY_MAX_ENTRIES, RedisCacheTier() if SKILLS_REDIS_URL else None)
+# 本 worker 中执行中的调用：记录 key -> (请求指纹, 上游调用任务 / stream_id)
+_idempotent_invokes: Dict[str, Tuple[str, asyncio.Task]] = {}
+_idempotent_streams: Dict[str, Tuple[str, str]] = {}
+
+
+def _idempotency_record_key(endpoint: str, idempotency_key: str) -> str:
+    digest = hashlib.sha256(idempotency_key.strip().encode("utf-8")).hexdigest()
+    return f"skills:idempotency:{endpoint}:{digest}"
+
+
+def _request_fingerprint(skill_request: SkillRequest) -> str:
+    """请求体指纹，用于发现同一个 Idempotency-Key 被用于不同的请求"""
+    payload = json.dumps(skill_request.model_dump(), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _check_fingerprint(stored: str, fingerprint: str) -> None:
+    if stored != fingerprint:
+        raise HTTPException(
+            status_code=422,
+            detail="Idempotency-Key has already been used with a different request",
+        )
+
+
+async def _run_idempotent_invoke(record_key: str, fingerprint: str, invocation) -> SkillResponse:
+    """执行 /invoke 并保存结果；失败的调用不保存，重试时会重新执行"""
+    skill_response = await invocation
+    await idempotency_store.set(
+        record_key,
+        {"fingerprint": fingerprint, "response": skill_response.model_dump()},
+        IDEMPOTENCY_TTL,
+    )
+    return skill_response
+
+
+async def _idempotent_skill_events(events, record_key: str, fingerprint: str, final_response: List[SkillResponse]):
+    """转发流式事件，执行结束后保存完整的事件序列，供重试请求回放"""
+    recorded = []
+    async with aclosing(events):
+        async for event in events:
+            if event.get("type") not in _LIVE_ONLY_EVENT_TYPES:
+                recorded.append(event)
+            yield event
+            if event.get("type") == "done":
+                value = {"fingerprint": fingerprint, "events": recorded}
+                if final_response:
+                    value["response"] = final_response[0].model_dump()
+                await idempotency_store.set(record_key, value, IDEMPOTENCY_TTL)
+
+
+def _idempotency_metrics() -> Dict[str, int]:
+    return {
+        **idempotency_store.stats,
+        "entries": len(idempotency_store._entries),
+        "invokes_in_flight": len(_idempotent_invokes),
+        "streams_in_flight": sum(
+            1 for _, stream_id in _idempotent_streams.values()
+            if stream_id in _stream_runs and not _stream_runs[stream_id].finished
+        ),
+    }
+
+
+# ============================================================================
+# 容器预热池：提前为常用的 Skill 组合创建容器，新请求直接使用，省去冷启动时间
+# ============================================================================
+
+CONTAINER_POOL_ENABLED = os.environ.get("CONTAINER_POOL_ENABLED", "false").lower() == "true"
+# 预热的 Skill 组合，组合之间用逗号分隔，组合内用 + 连接；默认每个自定义 Skill 单独一组
+CONTAINER_POOL_SKILL_SETS = [
+    sorted(set(skill_set.split("+")))
+    for skill_set in os.environ.get(
+        "CONTAINER_POOL_SKILL_SETS",
+        ",".join(sid for sid, metadata in SKILLS_METADATA.items() if metadata["type"] == "custom"),
+    ).split(",")
+    if skill_set.strip()
+]
+CONTAINER_POOL_SIZE = int(os.environ.get("CONTAINER_POOL_SIZE", "2"))  # 每个组合保持的空闲容器数
+CONTAINER_POOL_REFRESH_INTERVAL = float(os.environ.get("CONTAINER_POOL_REFRESH_INTERVAL", "60"))
+# 距离过期不足该时间（秒）的容器不再分配，并由新容器替换
+CONTAINER_POOL_EXPIRY_MARGIN = float(os.environ.get("CONTAINER_POOL_EXPIRY_MARGIN", "300"))
+# 上游未返回过期时间时容器的最长保留时间（秒）
+CONTAINER_POOL_MAX_AGE = float(os.environ.get("CONTAINER_POOL_MAX_AGE", "1800"))
+
+
+def _skill_set_key(skill_ids: List[str]) -> str:
+    return "+".join(sorted(set(skill_ids)))
+
+
+class ContainerPool:
+    """
+    按 Skill 组合维护的空闲容器池（每个 worker 独立）
+
+    后台任务为每个组合补足 CONTAINER_POOL_SIZE 个容器：以最小的上游调用
+    （max_tokens=1）创建加载好 Skills 的容器，临近过期的容器被丢弃并替换。
+    没有 container_id 的请求取走一个容器使用，取走后立即在后台补充。
+    """
+
+    def __init__(self, skill_sets: List[List[str]], size: int):
+        self.skill_sets = {_skill_set_key(skill_set): skill_set for skill_set in skill_sets}
+        self.size = size
+        self._idle: Dict[str, deque] = {key: deque() for key in self.skill_sets}  # (container_id, expires_at)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "created": 0, "expired": 0, "failed": 0}
+
+    def start(self) -> None:
+        for skill_set in self.skill_sets.values():
+            try:
+                _build_skills_config(skill_set)
+            except HTTPException as e:
+                raise ValueError(f"Invalid CONTAINER_POOL_SKILL_SETS: {e.detail}") from e
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait({self._task})
+            self._task = None
+
+    def acquire(self, skill_ids: List[str]) -> Optional[str]:
+        """取走一个可用的预热容器，该组合不在池中或暂无空闲容器时返回 None"""
+        idle = self._idle.get(_skill_set_key(skill_ids))
+        if idle is None or self._task is None:
+            return None
+        deadline = time.time() + CONTAINER_POOL_EXPIRY_MARGIN
+        while idle:
+            container_id, expires_at = idle.popleft()
+            if expires_at > deadline:
+                self.stats["hits"] += 1
+                self._wakeup.set()
+                return container_id
+            self.stats["expired"] += 1
+        self.stats["misses"] += 1
+        self._wakeup.set()
+        return None
+
+    async def _create(self, key: str) -> None:
+        kwargs = {
+            "model": SKILL_MODEL,
+            "max_tokens": 1,
+            "betas": BETA_HEADERS,
+            "container": {"skills": _build_skills_config(self.skill_sets[key])},
+            "messages": [{"role": "user", "content": "Reply with OK."}],
+            "tools": [{"type": "code_execution_20250825", "name": "code_execution"}],
+        }
+        try:
+            await upstream_budget.acquire(kwargs)
+            message = await _upstream_call("messages", lambda: client.beta.messages.create(**kwargs))
+        except Exception:
+            self.stats["failed"] += 1
+            logger.exception("failed to pre-warm container for %s", key)
+            return
+        _record_usage("/container-pool", _usage_dict(message.usage), "completed")
+        container = getattr(message, "container", None)
+        if container is None:
+            self.stats["failed"] += 1
+            return
+        expires_at = getattr(container, "expires_at", None)
+        self._idle[key].append((
+            container.id,
+            expires_at.timestamp() if expires_at else time.time() + CONTAINER_POOL_MAX_AGE,
+        ))
+        self.stats["created"] += 1
+
+    async def _refill(self) -> None:
+        deadline = time.time() + CONTAINER_POOL_EXPIRY_MARGIN
+        creations = []
+        for key, idle in self._idle.items():
+            fresh = [item for item in idle if item[1] > deadline]
+            self.stats["expired"] += len(idle) - len(fresh)
+            self._idle[key] = deque(fresh)
+            creations.extend(self._create(key) for _ in range(self.size - len(fresh)))
+        if creations:
+            await asyncio.gather(*creations)
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            await self._refill()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=CONTAINER_POOL_REFRESH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": CONTAINER_POOL_ENABLED,
+            "idle": {key: len(idle) for key, idle in self._idle.items()},
+        }
+
+
+container_pool = ContainerPool(CONTAINER_POOL_SKILL_SETS, CONTAINER_POOL_SIZE)
+
+
+def _container_config(skill_request: SkillRequest, skills_config: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """构建 container 参数：复用请求指定的容器，否则尝试从预热池取一个"""
+    container = {"skills": skills_config}
+    container_id = skill_request.container_id or container_pool.acquire(skill_request.skill_ids)
+    if container_id:
+        container["id"] = container_id
+    return container
+
+
+# ============================================================================
+# 准入调度：限制同时进行的上游 Skills 调用数，排队的请求按租户加权公平、
+# 同一时刻短任务优先的顺序放行
+# ============================================================================
+
+# 每个 worker 同时进行的上游 Skills 调用数上限，0 表示不限制（不排队）
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", "0"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "1000"))
+# 租户权重（API key=权重），未配置的租户权重为 1；后台任务（预生成、容器预热）使用 internal 权重
+ADMISSION_TENANT_WEIGHTS = {
+    "key:" + hashlib.sha256(key.strip().encode("utf-8")).hexdigest()[:16]: float(weight)
+    for key, _, weight in (
+        item.partition("=") for item in os.environ.get("ADMISSION_TENANT_WEIGHTS", "").split(",") if "=" in item
+    )
+}
+ADMISSION_INTERNAL_WEIGHT = float(os.environ.get("ADMISSION_INTERNAL_WEIGHT", "0.5"))
+# Skill 的基础成本（相对值，skill_id=成本），默认自定义 Skill 为 8、官方文档类 Skill 为 1
+ADMISSION_SKILL_COSTS = {
+    skill_id: 8.0 if metadata["type"] == "custom" else 1.0 for skill_id, metadata in SKILLS_METADATA.items()
+}
+ADMISSION_SKILL_COSTS.update({
+    skill_id.strip(): float(cost)
+    for skill_id, _, cost in (
+        item.partition("=") for item in os.environ.get("ADMISSION_SKILL_COSTS", "").split(",") if "=" in item
+    )
+})
+
+# 当前请求的租户（限流使用的客户端标识），由中间件设置；后台任务创建时继承
+_current_tenant: ContextVar[str] = ContextVar("skills_tenant", default="internal")
+
+
+class TenantContextMiddleware:
+    """为每个请求设置当前租户"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            _current_tenant.set(_client_identity(Request(scope)))
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(TenantContextMiddleware)
+
+
+def _skill_cost(skill_ids: List[str], max_tokens: int) -> float:
+    """预估成本：最重的 Skill 的基础成本（不带 Skill 时为 1），按 max_tokens 放大（默认 16384 时为 1 倍）"""
+    base = max((ADMISSION_SKILL_COSTS.get(skill_id, 1.0) for skill_id in skill_ids), default=1.0)
+    return base * (1 + max_tokens / 16384) / 2
+
+
+def _tenant_weight(tenant: str) -> float:
+    if tenant == "internal":
+        return ADMISSION_INTERNAL_WEIGHT
+    return ADMISSION_TENANT_WEIGHTS.get(tenant, 1.0)
+
+
+class AdmissionTicket:
+    """一次准入：排队时的位置和预计等待时间，放行后占用一个并发名额直到 release"""
+
+    def __init__(self, tenant: str, cost: float, seq: int, tag: float):
+        self.tenant = tenant
+        self.cost = cost
+        self.seq = seq
+        self.tag = tag  # 虚拟完成时间，越小越先放行
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self.released = False
+        self.position = 0
+        self.expected_wait: Optional[float] = 0.0  # 还没有耗时观测数据时为 None
+
+    def __lt__(self, other: "AdmissionTicket") -> bool:
+        return (self.tag, self.seq) < (other.tag, other.seq)
+
+    async def wait(self) -> None:
+        await self.future
+
+
+class AdmissionScheduler:
+    """
+    有界并发 + 加权公平队列（每个 worker 独立）
+
+    每个请求进入时得到虚拟完成时间 max(V, 该租户上一个请求的完成时间) + 成本 / 权重，
+    V 为最近放行的请求的完成时间（自计时公平排队 SCFQ）；有空闲名额时放行完成时间
+    最小的请求，相同时先到先放行。一个租户积压的大量请求完成时间依次累加，
+    后到的其他租户的请求会插在它们中间，不会被饿死；权重高的租户累加得慢，
+    得到更多名额；成本低的请求完成时间小，先于同时到达的长任务执行。
+    预计等待时间按排在前面的成本之和 × 观测到的每单位成本耗时 / 并发数估算。
+    """
+
+    def __init__(self, capacity: int, max_queue: int):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self._active = 0
+        self._waiting = 0
+        self._seq = 0
+        self._queue: List[AdmissionTicket] = []  # 按 (完成时间, 序号) 的堆，已释放的惰性删除
+        self._last_finish: Dict[str, float] = {}
+        self._vtime = 0.0
+        self._seconds_per_cost: Optional[float] = None  # 每单位成本的平均耗时（指数移动平均）
+        self.stats: Dict[str, Any] = {
+            "admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0, "wait_seconds": 0.0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def _admit(self, ticket: AdmissionTicket) -> None:
+        self._active += 1
+        self._vtime = max(self._vtime, ticket.tag)
+        ticket.admitted_at = time.monotonic()
+        self.stats["admitted"] += 1
+        self.stats["wait_seconds"] += ticket.admitted_at - ticket.enqueued_at
+        ticket.future.set_result(None)
+
+    def _dispatch(self) -> None:
+        while self._active < self.capacity and self._queue:
+            ticket = heapq.heappop(self._queue)
+            if ticket.released:
+                continue
+            self._waiting -= 1
+            if ticket.future.done():
+                # 等待者已被取消（超时、客户端断开），还没来得及 release
+                ticket.released = True
+                continue
+            self._admit(ticket)
+        # 完成时间不晚于当前虚拟时间的租户与新租户等价，不再保留
+        self._last_finish = {t: f for t, f in self._last_finish.items() if f > self._vtime}
+
+    def _predict(self, tag: float, seq: int, cost: float) -> Tuple[int, Optional[float]]:
+        """
+        按当前队列估算 (排队位置, 预计等待秒数)，之后到达的请求可能插到前面；
+        还没有耗时观测数据时预计等待为 None
+        """
+        ahead = [t for t in self._queue if not t.released and (t.tag, t.seq) < (tag, seq)]
+        if self._seconds_per_cost is None:
+            return len(ahead) + 1, None
+        ahead_cost = sum(t.cost for t in ahead)
+        return len(ahead) + 1, round((ahead_cost + cost) * self._seconds_per_cost / self.capacity, 1)
+
+    def _estimate(self, ticket: AdmissionTicket) -> None:
+        ticket.position, ticket.expected_wait = self._predict(ticket.tag, ticket.seq, ticket.cost)
+
+    def predict_wait(self, tenant: str, cost: float) -> Optional[float]:
+        """不入队，估算现在申请名额需要等待的时间；队列已满时返回 503"""
+        if not self.enabled or (self._active < self.capacity and self._waiting == 0):
+            return 0.0
+        if self._waiting >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=503, detail="Server is busy, please retry later")
+        tag = max(self._vtime, self._last_finish.get(tenant, 0.0)) + cost / _tenant_weight(tenant)
+        return self._predict(tag, self._seq + 1, cost)[1]
+
+    def enqueue(self, tenant: str, cost: float) -> AdmissionTicket:
+        """申请一个并发名额：有空闲时立即放行，否则排队；队列已满时返回 503"""
+        self._seq += 1
+        tag = max(self._vtime, self._last_finish.get(tenant, 0.0)) + cost / _tenant_weight(tenant)
+        ticket = AdmissionTicket(tenant, cost, self._seq, tag)
+        if not self.enabled:
+            ticket.future.set_result(None)
+            return ticket
+        if self._active < self.capacity and self._waiting == 0:
+            self._last_finish[tenant] = tag
+            self._admit(ticket)
+            return ticket
+        if self._waiting >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=503, detail="Server is busy, please retry later")
+        self._last_finish[tenant] = tag
+        heapq.heappush(self._queue, ticket)
+        self._waiting += 1
+        self.stats["queued"] += 1
+        self._estimate(ticket)
+        return ticket
+
+    def release(self, ticket: AdmissionTicket) -> None:
+        """调用结束（或排队时被取消）后释放名额"""
+        if ticket.released or not self.enabled:
+            return
+        ticket.released = True
+        if ticket.admitted_at is None:
+            # 仍在排队：从队列中惰性删除
+            self._waiting -= 1
+            return
+        self._active -= 1
+        if ticket.cost > 0:
+            sample = (time.monotonic() - ticket.admitted_at) / ticket.cost
+            self._seconds_per_cost = (
+                sample if self._seconds_per_cost is None else 0.8 * self._seconds_per_cost + 0.2 * sample
+            )
+        self._dispatch()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "capacity": self.capacity,
+            "active": self._active,
+            "waiting": self._waiting,
+            "tenants_waiting": len({t.tenant for t in self._queue if not t.released}),
+            "seconds_per_cost": self._seconds_per_cost,
+        }
+
+
+admission = AdmissionScheduler(ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE)
+
+
+# ============================================================================
+# 负载保护：客户端通过 X-Request-Timeout 给出截止时间，预计排队时间超过剩余时间的
+# 请求直接返回 503 + Retry-After，已过期的请求在调用上游之前丢弃
+# ============================================================================
+
+REQUEST_DEADLINE_HEADER = "X-Request-Timeout"
+# 客户端没有给出截止时间时使用的默认值（秒），0 表示不限制
+REQUEST_DEADLINE_DEFAULT = float(os.environ.get("REQUEST_DEADLINE_DEFAULT", "0"))
+
+# 当前请求的截止时间（time.monotonic()），None 表示不限制
+_request_deadline: ContextVar[Optional[float]] = ContextVar("skills_request_deadline", default=None)
+
+SHED_STATS = {"shed": 0, "expired": 0}
+
+
+class DeadlineMiddleware:
+    """从 X-Request-Timeout（剩余秒数）计算当前请求的截止时间"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            timeout = REQUEST_DEADLINE_DEFAULT
+            try:
+                timeout = float(Request(scope).headers.get(REQUEST_DEADLINE_HEADER, timeout))
+            except ValueError:
+                pass
+            _request_deadline.set(time.monotonic() + timeout if timeout > 0 else None)
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(DeadlineMiddleware)
+
+
+def _remaining_time() -> Optional[float]:
+    deadline = _request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def _shed_if_late(expected_wait: Optional[float]) -> None:
+    """预计等待时间（按当前队列深度和观测到的耗时估算）超过剩余时间时拒绝请求"""
+    remaining = _remaining_time()
+    if remaining is None or expected_wait is None or expected_wait <= remaining:
+        return
+    SHED_STATS["shed"] += 1
+    raise HTTPException(
+        status_code=503,
+        detail=f"Predicted queue wait of {expected_wait:.0f}s exceeds the request deadline",
+        headers={"Retry-After": str(max(1, math.ceil(expected_wait)))},
+    )
+
+
+def _check_deadline() -> None:
+    """调用上游之前：截止时间已过（客户端已放弃）的请求直接丢弃"""
+    remaining = _remaining_time()
+    if remaining is not None and remaining <= 0:
+        SHED_STATS["expired"] += 1
+        raise HTTPException(status_code=504, detail="Request deadline exceeded before the upstream call")
+
+
+# ============================================================================
+# Skill 隔离舱 (bulkhead)：按 Skill 类别分配独立的并发数、队列和超时，
+# 长时间运行的 Skill 排满时不影响秒级完成的文档类 Skill
+# ============================================================================
+
+BULKHEADS_ENABLED = os.environ.get("BULKHEADS_ENABLED", "false").lower() == "true"
+# skill_id=隔离舱，默认按 SKILLS_METADATA 的 type 分为 anthropic（文档类）和 custom 两个舱
+BULKHEAD_SKILL_POOLS = {skill_id: metadata["type"] for skill_id, metadata in SKILLS_METADATA.items()}
+BULKHEAD_SKILL_POOLS.update({
+    skill_id.strip(): pool.strip()
+    for skill_id, _, pool in (
+        item.partition("=") for item in os.environ.get("BULKHEAD_SKILL_POOLS", "").split(",") if "=" in item
+    )
+})
+# 隔离舱=并发数/队列上限/排队超时秒/上游调用超时秒（超时为 0 表示不限制）
+BULKHEAD_LIMITS = os.environ.get(
+    "BULKHEAD_LIMITS", f"anthropic=16/200/30/120,custom=4/50/300/{ANTHROPIC_TIMEOUT:g}"
+)
+
+
+class Bulkhead(AdmissionScheduler):
+    """一个 Skill 隔离舱：在全局准入之前申请，名额和队列与其他舱互不影响"""
+
+    def __init__(self, name: str, capacity: int, max_queue: int, queue_timeout: float, call_timeout: float):
+        super().__init__(capacity, max_queue)
+        self.name = name
+        self.queue_timeout = queue_timeout or None
+        self.call_timeout = call_timeout or None
+
+    def metrics(self) -> Dict[str, Any]:
+        return {**super().metrics(), "queue_timeout": self.queue_timeout, "call_timeout": self.call_timeout}
+
+
+def _load_bulkheads() -> Dict[str, Bulkhead]:
+    bulkheads = {}
+    for item in BULKHEAD_LIMITS.split(","):
+        if "=" not in item:
+            continue
+        name, _, limits = item.partition("=")
+        capacity, max_queue, queue_timeout, call_timeout = limits.split("/")
+        bulkheads[name.strip()] = Bulkhead(
+            name.strip(), int(capacity), int(max_queue), float(queue_timeout), float(call_timeout)
+        )
+    missing = set(BULKHEAD_SKILL_POOLS.values()) - set(bulkheads)
+    if BULKHEADS_ENABLED and missing:
+        raise ValueError(f"BULKHEAD_LIMITS has no entry for: {', '.join(sorted(missing))}")
+    return bulkheads
+
+
+bulkheads = _load_bulkheads()
+
+
+def _bulkhead_for(skill_ids: List[str]) -> Optional[Bulkhead]:
+    """多个 Skill 时使用其中最重（ADMISSION_SKILL_COSTS 最大）的 Skill 所在的舱；不带 Skill 时不进舱"""
+    if not BULKHEADS_ENABLED or not skill_ids:
+        return None
+    skill_id = max(skill_ids, key=lambda sid: ADMISSION_SKILL_COSTS.get(sid, 1.0))
+    return bulkheads.get(BULKHEAD_SKILL_POOLS.get(skill_id, ""))
+
+
+class SkillSlot:
+    """一次上游 Skills（或 chat/completions）调用占用的名额：先进入 Skill 隔离舱，再进入全局准入队列"""
+
+    def __init__(self, skill_ids: List[str], max_tokens: int):
+        self.tenant = _current_tenant.get()
+        self.cost = _skill_cost(skill_ids, max_tokens)
+        self.bulkhead = _bulkhead_for(skill_ids)
+        self._tickets: List[Tuple[AdmissionScheduler, AdmissionTicket]] = []
+
+    def _stages(self) -> List[Tuple[AdmissionScheduler, str]]:
+        stages = [(self.bulkhead, self.bulkhead.name)] if self.bulkhead is not None else []
+        return [(scheduler, pool) for scheduler, pool in [*stages, (admission, "global")] if scheduler.enabled]
+
+    def check_admission(self) -> None:
+        """
+        返回响应之前检查：队列已满，或预计等待（各级之和）超过请求的截止时间时直接返回 503；
+        流式响应开始之后只能以 error 事件报告
+        """
+        waits = [scheduler.predict_wait(self.tenant, self.cost) for scheduler, _ in self._stages()]
+        if any(wait is not None for wait in waits):
+            _shed_if_late(sum(wait for wait in waits if wait is not None))
+
+    @property
+    def timeout(self) -> float:
+        """上游调用的超时时间（传给 Anthropic SDK）"""
+        if self.bulkhead is not None and self.bulkhead.call_timeout:
+            return self.bulkhead.call_timeout
+        return ANTHROPIC_TIMEOUT
+
+    async def acquire(self):
+        """依次申请各级名额，每进入一个启用的队列产生一个 queued 事件（排队位置、预计等待秒数）"""
+        for scheduler, pool in self._stages():
+            ticket = scheduler.enqueue(self.tenant, self.cost)
+            self._tickets.append((scheduler, ticket))
+            _shed_if_late(ticket.expected_wait)
+            yield {"type": "queued", "pool": pool, "position": ticket.position, "expected_wait": ticket.expected_wait}
+            queue_timeout = getattr(scheduler, "queue_timeout", None)
+            remaining = _remaining_time()
+            try:
+                await asyncio.wait_for(
+                    ticket.wait(), min(t for t in (queue_timeout, remaining, math.inf) if t is not None)
+                )
+            except asyncio.TimeoutError:
+                # 先计数：超过截止时间（504）和队列超时（503）都算排队超时
+                scheduler.stats["timed_out"] += 1
+                _check_deadline()
+                raise HTTPException(
+                    status_code=503, detail=f"Skill pool '{pool}' is busy, please retry later"
+                )
+
+    async def before_call(self, kwargs: Dict[str, Any]) -> None:
+        """每次调用上游之前：等待上游额度，丢弃已过期的请求，设置本次调用的超时"""
+        await upstream_budget.acquire(kwargs)
+        _check_deadline()
+        kwargs["timeout"] = self.timeout
+
+    async def wait(self) -> None:
+        """非流式调用：等待取得全部名额"""
+        async with aclosing(self.acquire()) as queued:
+            async for _ in queued:
+                pass
+
+    def release(self) -> None:
+        for scheduler, ticket in reversed(self._tickets):
+            scheduler.release(ticket)
+        self._tickets = []
+
+
+# API 路由
+
+
+@app.get("/")
+async def root():
+    """API 根路径"""
+    return {
+        "message": "Anthropic Skills API Server",
+        "version": "1.0.0",
+        "rate_limit": "5 requests per second",
+        "docs": "/docs",
+    }
+
+
+@app.get("/skills")
+async def list_skills():
+    """列出所有可用的 Skills"""
+    return {"total": len(SKILLS_METADATA), "skills": SKILLS_METADATA}
+
+
+def _build_skills_config(skill_ids: List[str]) -> List[Dict[str, Any]]:
+    """验证 skill_ids 并构建 container 的 skills 配置"""
+    # 验证 skill_ids 数量
+    if len(skill_ids) > 8:
+        raise HTTPException(
+            status_code=400, detail="Maximum 8 skills allowed per request"
+        )
+
+    # 验证 skill_ids 是否存在
+    invalid_skills = [
+        sid for sid in skill_ids if sid not in SKILLS_METADATA
+    ]
+    if invalid_skills:
+        raise HTTPException(
+            status_code=400, detail=f"Invalid skill IDs: {invalid_skills}"
+        )
+
+    # 构建 skills 配置
+    skills_config = []
+    for skill_id in skill_ids:
+        metadata = SKILLS_METADATA[skill_id]
+        skills_config.append(
+            {"type": metadata["type"], "skill_id": skill_id, "version": "latest"}
+        )
+
+    return skills_config
+
+
+def _should_continue(message, continuations: int) -> bool:
+    """上游因 pause_turn 暂停且未达到自动继续次数上限"""
+    return message.stop_reason == "pause_turn" and continuations < PAUSE_TURN_MAX_CONTINUATIONS
+
+
+def _assistant_message(message) -> Dict[str, Any]:
+    """把上游返回的消息转换为可重发、可序列化的 assistant 消息（内容块转为 dict）"""
+    return {
+        "role": "assistant",
+        "content": [block.model_dump(mode="json", exclude_none=True) for block in message.content],
+    }
+
+
+def _merge_continued_messages(messages: List[Any]):
+    """把 pause_turn 自动继续的各段消息合并为一条：内容依次拼接，用量累加"""
+    if len(messages) == 1:
+        return messages[0]
+    last = messages[-1]
+    usage = last.usage.model_copy(update={
+        key: sum(getattr(message.usage, key, 0) or 0 for message in messages)
+        for key in USAGE_TOKEN_KEYS
+    })
+    return last.model_copy(update={
+        "content": [block for message in messages for block in message.content],
+        "usage": usage,
+    })
+
+
+def _skill_response_from_message(message) -> SkillResponse:
+    """把上游返回的完整消息转换为 SkillResponse"""
+    # 处理响应内容并提取 file_ids
+    response_content = []
+    file_ids = []
+
+    for content in message.content:
+        if hasattr(content, "text"):
+            response_content.append({"type": "text", "text": content.text})
+        elif content.type == "bash_code_execution_tool_result":
+            # 从 bash 结果中提取 file_ids
+            result_content = getattr(content, "content", None)
+            if result_content and hasattr(result_content, "type"):
+                if result_content.type == "bash_code_execution_result":
+                    for item in getattr(result_content, "content", []):
+                        if hasattr(item, "file_id") and item.file_id:
+                            file_ids.append(item.file_id)
+            response_content.append({"type": content.type, "data": str(content)})
+        else:
+            response_content.append({"type": content.type, "data": str(content)})
+
+    return SkillResponse(
+        status="success",
+        container_id=message.container.id
+        if hasattr(message, "container") and message.container
+        else "",
+        stop_reason=message.stop_reason,
+        model=message.model,
+        response=response_content,
+        usage=_usage_dict(message.usage),
+        file_ids=file_ids,
+    )
+
+
+@app.post("/invoke", response_model=SkillResponse)
+@limiter.limit("5/second")
+async def invoke_skills(request: Request, response: Response, skill_request: SkillRequest):
+    """
+    调用指定的 Skills
+
+    Rate Limit: 5 requests per second
+    启用结果缓存时，响应头 X-Cache 为 HIT / MISS
+    parallel=true 时每个 Skill 在各自的容器中并行执行，结果合并为一个 SkillResponse
+    相同请求正在执行时不再调用上游，而是共享其结果（响应头 X-Coalesced: true）
+    携带 Idempotency-Key 头重试时返回原来那次执行的结果（响应头 Idempotent-Replayed: true）
+    """
+    skills_config = _build_skills_config(skill_request.skill_ids)
+
+    idempotency_key = request.headers.get("idempotency-key")
+    if not idempotency_key:
+        return await _invoke_skills(request, response, skill_request, skills_config)
+
+    record_key = _idempotency_record_key("invoke", idempotency_key)
+    fingerprint = _request_fingerprint(skill_request)
+    record = await idempotency_store.get(record_key)
+    if record is not None:
+        _check_fingerprint(record["fingerprint"], fingerprint)
+        response.headers["Idempotent-Replayed"] = "true"
+        return SkillResponse(**record["response"])
+
+    # 原来的执行仍在进行时等待它完成
+    inflight = _idempotent_invokes.get(record_key)
+    if inflight is not None:
+        _check_fingerprint(inflight[0], fingerprint)
+        response.headers["Idempotent-Replayed"] = "true"
+        task = inflight[1]
+    else:
+        task = asyncio.create_task(
+            _run_idempotent_invoke(
+                record_key,
+                fingerprint,
+                _invoke_skills(request, response, skill_request, skills_config),
+            )
+        )
+        _idempotent_invokes[record_key] = (fingerprint, task)
+        task.add_done_callback(lambda _: _idempotent_invokes.pop(record_key, None))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return await asyncio.shield(task)
+
+
+async def _invoke_skills(
+    request: Request, response: Response, skill_request: SkillRequest, skills_config: List[Dict[str, Any]]
+) -> SkillResponse:
+    """查结果缓存（精确 / 近似）、合并相同请求，都未命中时调用上游"""
+    cache_key = _skill_cache_key(request, skill_request)
+    if cache_key:
+        cached = await result_cache.get(cache_key)
+        if cached is not None and "response" in cached:
+            response.headers["X-Cache"] = "HIT"
+            return SkillResponse(**cached["response"])
+        response.headers["X-Cache"] = "MISS"
+
+    similarity_scope = _similarity_scope(request, skill_request)
+    if similarity_scope:
+        similar = await similarity_cache.get(similarity_scope, skill_request.message)
+        if similar is not None and "response" in similar[0]:
+            response.headers["X-Cache"] = "SIMILAR"
+            response.headers["X-Cache-Similarity"] = f"{similar[1]:.3f}"
+            return SkillResponse(**similar[0]["response"])
+        response.headers["X-Cache"] = "MISS"
+
+    invocation = _invoke_fan_out if _is_fan_out(skill_request) else _invoke_upstream
+    flight_key = _flight_key(request, skill_request)
+    if not flight_key:
+        return await invocation(skill_request, skills_config, cache_key, similarity_scope)
+
+    # 相同请求正在执行时等待同一个上游调用的结果
+    task = _inflight_invokes.get(flight_key)
+    if task is None:
+        task = asyncio.create_task(
+            invocation(skill_request, skills_config, cache_key, similarity_scope)
+        )
+        _inflight_invokes[flight_key] = task
+        task.add_done_callback(lambda _: _inflight_invokes.pop(flight_key, None))
+        # 所有等待者都已断开时，避免 "exception was never retrieved" 警告
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        COALESCE_STATS["invoke_started"] += 1
+    else:
+        COALESCE_STATS["invoke_joined"] += 1
+        response.headers["X-Coalesced"] = "true"
+    # shield：某个客户端断开不会取消其他请求共享的上游调用
+    return await asyncio.shield(task)
+
+
+async def _invoke_upstream(
+    skill_request: SkillRequest,
+    skills_config: List[Dict[str, Any]],
+    cache_key: Optional[str],
+    similarity_scope: Optional[str] = None,
+) -> SkillResponse:
+    """执行一次非流式上游调用，记录用量并写入结果缓存"""
+    slot = SkillSlot(skill_request.skill_ids, skill_request.max_tokens)
+    try:
+        await slot.wait()
+
+        # 构建容器配置
+        container = _container_config(skill_request, skills_config)
+
+        messages = [{"role": "user", "content": skill_request.message}]
+        segments = []  # 因 pause_turn 自动继续之前的各段消息
+        while True:
+            # 调用 Anthropic API（上游额度不足时先等待）
+            kwargs = _with_prompt_cache({
+                "model": SKILL_MODEL,
+                "max_tokens": skill_request.max_tokens,
+                "betas": BETA_HEADERS,
+                "container": container,
+                "messages": messages,
+                "tools": [{"type": "code_execution_20250825", "name": "code_execution"}],
+            })
+            await slot.before_call(kwargs)
+            message = await _upstream_call("messages", lambda: client.beta.messages.create(**kwargs))
+            _record_usage("/invoke", _usage_dict(message.usage), "completed")
+
+            # pause_turn：在同一容器中自动继续，调用方只需一次请求
+            if not _should_continue(message, len(segments)):
+                break
+            segments.append(message)
+            if getattr(message, "container", None):
+                container["id"] = message.container.id
+            messages = [*messages, _assistant_message(message)]
+
+        skill_response = _skill_response_from_message(_merge_continued_messages([*segments, message]))
+
+        if skill_response.stop_reason in CACHEABLE_STOP_REASONS:
+            await _store_skill_result(
+                skill_request, cache_key, similarity_scope, {"response": skill_response.model_dump()}
+            )
+        return skill_response
+
+    except anthropic.APIError as e:
+        _record_usage("/invoke", None, "failed")
+        raise HTTPException(status_code=500, detail=f"Anthropic API Error: {str(e)}")
+    except HTTPException:
+        # 隔离舱 / 准入队列已满、排队超时或超过请求的截止时间
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+    finally:
+        slot.release()
+
+
+# ============================================================================
+# 批量调用：一次提交多个 SkillRequest，在线并发执行或通过 Message Batches API 离线处理
+# （路由需注册在 /invoke/{skill_name} 之前）
+# ============================================================================
+
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "100"))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "4"))
+
+
+class BatchMode(str, Enum):
+    ONLINE = "online"  # 在本服务中并发执行，按完成顺序以 NDJSON 返回
+    OFFLINE = "offline"  # 提交到 Message Batches API，之后查询结果
+
+
+class BatchInvokeRequest(BaseModel):
+    requests: List[SkillRequest] = Field(..., min_length=1, description="Skill requests to run")
+    concurrency: Optional[int] = Field(
+        None, ge=1, description="Online mode: items run at the same time (capped by BATCH_MAX_CONCURRENCY)"
+    )
+    mode: BatchMode = Field(
+        default=BatchMode.ONLINE,
+        description="online: stream NDJSON results; offline: submit to the Message Batches API",
+    )
+
+
+class MessageBatchResponse(BaseModel):
+    batch_id: str
+    processing_status: str
+    request_counts: Dict[str, int]
+    created_at: str
+    expires_at: str
+    ended_at: Optional[str] = None
+
+
+def _message_batch_response(batch) -> MessageBatchResponse:
+    return MessageBatchResponse(
+        batch_id=batch.id,
+        processing_status=batch.processing_status,
+        request_counts=batch.request_counts.model_dump(),
+        created_at=batch.created_at.isoformat(),
+        expires_at=batch.expires_at.isoformat(),
+        ended_at=batch.ended_at.isoformat() if batch.ended_at else None,
+    )
+
+
+async def _message_batch_call(method, batch_id: str):
+    """调用 Message Batches API 的查询 / 取消接口，把上游错误转换为 HTTP 错误"""
+    try:
+        return await _upstream_call("messages", lambda: method(batch_id, betas=BETA_HEADERS), idempotent=True)
+    except anthropic.NotFoundError:
+        raise HTTPException(status_code=404, detail=f"Batch '{batch_id}' not found")
+    except anthropic.APIError as e:
+        raise HTTPException(status_code=500, detail=f"Anthropic API Error: {str(e)}")
+
+
+def _ndjson_response(request: Request, lines) -> StreamingResponse:
+    """以 NDJSON 返回结果，空闲时发送空行保持连接"""
+
+    async def generate():
+        async with aclosing(_with_keepalive(lines, request)) as results:
+            async for line in results:
+                yield "\n" if line is None else json.dumps(line, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson", headers=SSE_HEADERS)
+
+
+async def _iter_batch_results(request: Request, items: List[SkillRequest], concurrency: int):
+    """并发执行各项（最多 concurrency 个同时执行），按完成顺序产出结果行"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_item(index: int, skill_request: SkillRequest) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                skills_config = _build_skills_config(skill_request.skill_ids)
+                skill_response = await _invoke_skills(request, Response(), skill_request, skills_config)
+            except HTTPException as e:
+                return {"index": index, "status": "error", "status_code": e.status_code, "error": e.detail}
+        return {"index": index, "status": "success", "response": skill_response.model_dump()}
+
+    tasks = [asyncio.create_task(run_item(index, item)) for index, item in enumerate(items)]
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            yield await next_result
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+
+
+async def _submit_message_batch(items: List[SkillRequest]) -> MessageBatchResponse:
+    """
+    把各项提交到 Message Batches API（custom_id 为 item-{index}）
+
+    离线执行不使用容器预热池（容器可能在批处理开始前过期），也不会自动继续 pause_turn；
+    并行模式的请求不支持离线执行。
+    """
+    batch_requests = []
+    for index, skill_request in enumerate(items):
+        if _is_fan_out(skill_request):
+            raise HTTPException(
+                status_code=400, detail=f"requests[{index}]: parallel is not supported in offline mode"
+            )
+        try:
+            container = {"skills": _build_skills_config(skill_request.skill_ids)}
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"requests[{index}]: {e.detail}")
+        if skill_request.container_id:
+            container["id"] = skill_request.container_id
+        batch_requests.append({
+            "custom_id": f"item-{index}",
+            "params": _with_prompt_cache({
+                "model": SKILL_MODEL,
+                "max_tokens": skill_request.max_tokens,
+                "container": container,
+                "messages": [{"role": "user", "content": skill_request.message}],
+                "tools": [{"type": "code_execution_20250825", "name": "code_execution"}],
+            }),
+        })
+
+    try:
+        batch = await _upstream_call(
+            "messages", lambda: client.beta.messages.batches.create(requests=batch_requests, betas=BETA_HEADERS)
+        )
+    except anthropic.APIError as e:
+        raise HTTPException(status_code=500, detail=f"Anthropic API Error: {str(e)}")
+    return _message_batch_response(batch)
+
+
+@app.post("/invoke/batch")
+@limiter.limit("5/second")
+async def invoke_skills_batch(request: Request, batch_request: BatchInvokeRequest):
+    """
+    批量调用 Skills
+
+    online（默认）：在服务端并发执行（最多 BATCH_MAX_CONCURRENCY 个同时执行），
+    每项完成后立即返回一行 NDJSON：{"index", "status", "response" | "status_code" + "error"}。
+    各项与 /invoke 一样使用结果缓存和请求合并；单项失败不影响其他项。
+    offline：提交到 Anthropic Message Batches API（费用减半，24 小时内完成），
+    返回 batch_id，之后通过 GET /invoke/batch/{batch_id} 查询状态、
+    GET /invoke/batch/{batch_id}/results 获取结果。
+    Rate Limit: 5 requests per second（整个批次计为一次请求）
+    """
+    if len(batch_request.requests) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400, detail=f"Maximum {BATCH_MAX_ITEMS} requests allowed per batch"
+        )
+
+    if batch_request.mode == BatchMode.OFFLINE:
+        batch = await _submit_message_batch(batch_request.requests)
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=batch.model_dump())
+
+    concurrency = min(batch_request.concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+    return _ndjson_response(request, _iter_batch_results(request, batch_request.requests, concurrency))
+
+
+@app.get("/invoke/batch/{batch_id}", response_model=MessageBatchResponse)
+async def get_message_batch(batch_id: str):
+    """查询离线批次的处理状态"""
+    return _message_batch_response(
+        await _message_batch_call(client.beta.messages.batches.retrieve, batch_id)
+    )
+
+
+@app.get("/invoke/batch/{batch_id}/results")
+async def get_message_batch_results(request: Request, batch_id: str):
+    """获取离线批次的结果（NDJSON，格式与在线模式相同），批次未结束时返回 409"""
+    batch = await _message_batch_call(client.beta.messages.batches.retrieve, batch_id)
+    if batch.processing_status != "ended":
+        raise HTTPException(status_code=409, detail=f"Batch is {batch.processing_status}")
+    results = await _message_batch_call(client.beta.messages.batches.results, batch_id)
+
+    async def result_lines():
+        try:
+            async for item in results:
+                index = int(item.custom_id.removeprefix("item-"))
+                if item.result.type == "succeeded":
+                    skill_response = _skill_response_from_message(item.result.message)
+                    yield {"index": index, "status": "success", "response": skill_response.model_dump()}
+                elif item.result.type == "errored":
+                    yield {"index": index, "status": "error", "status_code": 500,
+                           "error": f"Anthropic API Error: {item.result.error.error.message}"}
+                else:
+                    # canceled / expired
+                    yield {"index": index, "status": "error", "status_code": 409, "error": f"Request {item.result.type}"}
+        finally:
+            await results.close()
+
+    return _ndjson_response(request, result_lines())
+
+
+@app.delete("/invoke/batch/{batch_id}", response_model=MessageBatchResponse)
+async def cancel_message_batch(batch_id: str):
+    """取消离线批次，已完成的项仍会出现在结果中"""
+    return _message_batch_response(
+        await _message_batch_call(client.beta.messages.batches.cancel, batch_id)
+    )
+
+
+@app.post("/invoke/{skill_name}")
+@limiter.limit("5/second")
+async def invoke_single_skill(
+    request: Request, response: Response, skill_name: str, message: str, max_tokens: int = 4096
+):
+    """
+    调用单个 Skill (简化版接口)
+
+    Rate Limit: 5 requests per second
+    """
+    # 查找 skill ID
+    skill_id = None
+    for sid, metadata in SKILLS_METADATA.items():
+        if (
+            sid == skill_name
+            or metadata["name"].lower().replace(" ", "-") == skill_name.lower()
+        ):
+            skill_id = sid
+            break
+
+    if not skill_id:
+        raise HTTPException(status_code=404, detail=f"Skill '{skill_name}' not found")
+
+    # 复用 invoke_skills 逻辑
+    skill_request = SkillRequest(
+        skill_ids=[skill_id], message=message, max_tokens=max_tokens
+    )
+
+    return await invoke_skills(request, response, skill_request)
+
+
+# SSE keepalive 间隔（秒），Cloudflare / Render 会断开长时间空闲的连接
+KEEPALIVE_INTERVAL = float(os.environ.get("SSE_KEEPALIVE_INTERVAL", "15"))
+
+# 每个 SSE 客户端的待发送事件上限：客户端读取过慢时反压到事件源，而不是无限占用内存
+STREAM_SUBSCRIBER_QUEUE_SIZE = int(os.environ.get("STREAM_SUBSCRIBER_QUEUE_SIZE", "256"))
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+# 流结束标记
+_STREAM_END = object()
+
+
+async def _wait_for_disconnect(request: Request):
+    """等待客户端断开连接（请求体已被读取，之后 receive 只会返回 http.disconnect）"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _with_keepalive(
+    events, request: Optional[Request] = None, interval: float = KEEPALIVE_INTERVAL
+):
+    """
+    在后台任务中消费上游事件流，事件到达即转发
+
+    空闲超过 interval 秒时产出 None，调用方据此发送 keepalive 注释。
+    队列有界：客户端读取过慢时后台任务暂停读取事件源（反压）。
+    调用方关闭生成器或客户端断开连接（传入 request 时）都会取消后台任务，
+    从而中止上游调用并关闭连接。
+    """
+    event_queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_SUBSCRIBER_QUEUE_SIZE)
+
+    async def pump():
+        try:
+            async with aclosing(events):
+                async for event in events:
+                    await event_queue.put(event)
+        except asyncio.CancelledError:
+            # 已被取消（调用方离开或客户端断开），不再等待队列空位
+            if not event_queue.full():
+                event_queue.put_nowait(_STREAM_END)
+            raise
+        except Exception:
+            logger.exception("event source failed")
+        await event_queue.put(_STREAM_END)
+
+    pump_task = asyncio.create_task(pump())
+
+    def cancel_pump() -> bool:
+        # 只取消一次：重复取消会打断上游连接正在进行的关闭流程
+        if pump_task.done() or pump_task.cancelling():
+            return False
+        pump_task.cancel()
+        return True
+
+    watcher_task = None
+    if request is not None:
+        async def cancel_on_disconnect():
+            await _wait_for_disconnect(request)
+            if cancel_pump():
+                logger.info("client disconnected, cancelling upstream stream")
+
+        watcher_task = asyncio.create_task(cancel_on_disconnect())
+
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(event_queue.get(), timeout=interval)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+
+            if event is _STREAM_END:
+                break
+            yield event
+    finally:
+        if watcher_task is not None:
+            watcher_task.cancel()
+        cancel_pump()
+        if not pump_task.done():
+            # 使用 asyncio.wait 而非 gather：外层再次被取消时不会二次取消后台任务，
+            # 保证上游连接的关闭流程完整执行
+            await asyncio.wait({pump_task})
+
+
+async def _iter_skill_stream_events(
+    skill_request: SkillRequest,
+    skills_config: List[Dict[str, Any]],
+    on_final_message: Optional[Callable[[Any], None]] = None,
+    history: Optional[List[Dict[str, Any]]] = None,
+):
+    """
+    驱动 Anthropic 流式调用，把上游事件转换为前端使用的 SSE 事件字典
+
+    on_final_message 在发送 done 事件之前以完整的最终消息调用（后台任务用它构建 SkillResponse）
+    history 为之前的对话消息（会话），本次的 skill_request.message 作为新的 user 消息追加在后面
+    """
+    # 用于跟踪当前正在执行的内容块
+    current_blocks = {}
+    step_counter = 0
+    active_steps_info = {}  # 跟踪每个 block_index 对应的 step_number
+    collected_file_ids = []  # 收集执行过程中产生的文件ID
+
+    stream = None
+    slot = SkillSlot(skill_request.skill_ids, skill_request.max_tokens)
+    outcome = "cancelled"  # 未正常结束（客户端断开、任务被取消）时按已消耗用量记账
+    try:
+        # Skill 隔离舱 / 准入调度：最先的事件报告排队位置和预计等待时间（秒）
+        async with aclosing(slot.acquire()) as queued:
+            async for event in queued:
+                yield event
+
+        # 构建容器配置
+        container = _container_config(skill_request, skills_config)
+
+        messages = [*(history or []), {"role": "user", "content": skill_request.message}]
+        segments = []  # 因 pause_turn 自动继续之前的各段消息
+        while True:
+            # 调用 Anthropic API (流式，上游额度不足时先等待)
+            kwargs = _with_prompt_cache({
+                "model": SKILL_MODEL,
+                "max_tokens": skill_request.max_tokens,
+                "betas": BETA_HEADERS,
+                "container": container,
+                "messages": messages,
+                "tools": [{"type": "code_execution_20250825", "name": "code_execution"}],
+            })
+            await slot.before_call(kwargs)
+            async with _upstream_stream(lambda: client.beta.messages.stream(**kwargs)) as stream:
+                async for event in stream:
+                    # 处理不同类型的事件
+                    if hasattr(event, "type"):
+                        if event.type == "content_block_delta":
+                            if hasattr(event.delta, "text"):
+                                # 文本增量
+                                yield {"type": "text_delta", "text": event.delta.text}
+                            # 处理 code_execution 的输入增量
+                            elif hasattr(event.delta, "type"):
+                                if event.delta.type == "code_execution_input_json_delta":
+                                    # 代码输入增量
+                                    if hasattr(event.delta, "partial_json"):
+                                        yield {
+                                            "type": "code_input_delta",
+                                            "partial_json": event.delta.partial_json,
                                             "index": event.index
+                                        }
+
+                        elif event.type == "content_block_start":
+                            block = event.content_block
+                            block_type = getattr(block, "type", "unknown")
+                            block_index = event.index
+
+                            # 记录当前块，包括可能的结果内容
+                            current_blocks[block_index] = {
+                                "type": block_type,
+                                "id": getattr(block, "id", None),
+                                "name": getattr(block, "name", None),
+                                "content": []  # 用于收集结果内容
+                            }
+
+                            if block_type == "tool_use":
+                                # Claude 调用工具（如 code_execution）
+                                step_counter += 1
+                                # 记录此 block_index 对应的 step_number
+                                active_steps_info[block_index] = {"step_number": step_counter}
+                                yield {
+                                    "type": "step_start",
+                                    "step_type": "tool_use",
+                                    "step_number": step_counter,
+                                    "tool_name": getattr(block, "name", "unknown"),
+                                    "tool_id": getattr(block, "id", ""),
+                                    "index": block_index
+                                }
+                            elif block_type == "server_tool_use":
+                                # 服务器端工具调用（skill 执行）
+                                step_counter += 1
+                                # 记录此 block_index 对应的 step_number
+                                active_steps_info[block_index] = {"step_number": step_counter}
+                                yield {
+                                    "type": "step_start",
+                                    "step_type": "server_tool_use",
+                                    "step_number": step_counter,
+                                    "tool_name": getattr(block, "name", "skill"),
+                                    "tool_id": getattr(block, "id", ""),
+                                    "index": block_index
+                                }
+                            elif block_type == "code_execution_tool_result":
+                                # 代码执行结果 - 提取结果内容
+                                result_content = getattr(block, "content", [])
+                                result_data = []
+                                for item in result_content:
+                                    item_type = getattr(item, "type", "unknown")
+                                    if item_type == "text":
+                                        result_data.append({
+                                            "type": "text",
+                                            "text": getattr(item, "text", "")
+                                        })
+                                    elif item_type == "image":
+                                        # 图片结果（如图表）
+                                        result_data.append({
+                                            "type": "image",
+                                            "media_type": getattr(item.source, "media_type", "image/png") if hasattr(item, "source") else "image/png"
+                                        })
+
+                                yield {
+                                    "type": "code_result_start",
+                                    "index": block_index,
+                                    "tool_use_id": getattr(block, "tool_use_id", ""),
+                                    "result": result_data if result_data else None
+                                }
+                            elif block_type == "server_tool_result":
+                                # 服务器端工具结果 - 提取结果内容
+                                result_content = getattr(block, "content", [])
+                                result_data = []
+                                for item in result_content:
+                                    item_type = getattr(item, "type", "unknown")
+                                    if item_type == "text":
+                                        result_data.append({
+                                            "type": "text",
+                                            "text": getattr(item, "text", "")
                                         })
 
-                        elif event.type == "content_block_start":
-                            block = event.content_block
-                            block_type = getattr(block, "type", "unknown")
-                            block_index = event.index
+                                yield {
+                                    "type": "server_result_start",
+                                    "index": block_index,
+                                    "tool_use_id": getattr(block, "tool_use_id", ""),
+                                    "result": result_data if result_data else None
+                                }
+                            elif block_type == "text":
+                                # 文本块开始
+                                yield {
+                                    "type": "content_start",
+                                    "content_type": "text",
+                                    "index": block_index
+                                }
+                            elif block_type in ("text_editor_code_execution_tool_result", "bash_code_execution_tool_result"):
+                                # Skills 的代码执行结果 - 提取结果内容
+                                # block.content 是 BetaTextEditorCodeExecutionViewResultBlock 或类似对象
+                                result_content = getattr(block, "content", None)
+                                result_data = None
+
+                                if result_content:
+                                    # 获取内容类型
+                                    content_type = getattr(result_content, "type", "unknown")
+
+                                    if content_type == "text_editor_code_execution_view_result":
+                                        # 文件查看结果
+                                        result_data = {
+                                            "type": "file_view",
+                                            "content": getattr(result_content, "content", ""),
+                                            "file_type": getattr(result_content, "file_type", "text"),
+                                            "num_lines": getattr(result_content, "num_lines", 0),
+                                            "start_line": getattr(result_content, "start_line", 1),
+                                            "total_lines": getattr(result_content, "total_lines", 0)
+                                        }
+                                    elif content_type == "text_editor_code_execution_edit_result":
+                                        # 文件编辑结果
+                                        result_data = {
+                                            "type": "file_edit",
+                                            "path": getattr(result_content, "path", ""),
+                                            "old_content": getattr(result_content, "old_content", ""),
+                                            "new_content": getattr(result_content, "new_content", "")
+                                        }
+                                    elif content_type == "bash_code_execution_result":
+                                        # Bash 执行结果 - 也检查是否有文件输出
+                                        file_ids_in_result = []
+                                        result_items = getattr(result_content, "content", [])
+                                        for item in result_items:
+                                            if hasattr(item, "file_id") and item.file_id:
+                                                file_ids_in_result.append(item.file_id)
+                                                collected_file_ids.append(item.file_id)
+
+                                        result_data = {
+                                            "type": "bash_result",
+                                            "stdout": getattr(result_content, "stdout", ""),
+                                            "stderr": getattr(result_content, "stderr", ""),
+                                            "exit_code": getattr(result_content, "exit_code", 0),
+                                            "file_ids": file_ids_in_result if file_ids_in_result else None
+                                        }
+                                    else:
+                                        # 其他类型，尝试提取通用信息
+                                        result_data = {
+                                            "type": content_type,
+                                            "content": str(result_content)[:500]  # 截断以避免过长
+                                        }
+
+                                yield {
+                                    "type": "skill_result_start",
+                                    "result_type": block_type.replace("_tool_result", ""),
+                                    "index": block_index,
+                                    "tool_use_id": getattr(block, "tool_use_id", ""),
+                                    "result": result_data
+                                }
+                            else:
+                                # 其他类型
+                                yield {
+                                    "type": "content_start",
+                                    "content_type": block_type,
+                                    "index": block_index
+                                }
+
+                        elif event.type == "content_block_stop":
+                            block_index = event.index
+                            block_info = current_blocks.get(block_index, {})
+                            block_type = block_info.get("type", "unknown")
+
+                            if block_type in ("tool_use", "server_tool_use"):
+                                # 步骤完成 - 查找对应的 step_number
+                                # 通过 index 或 tool_id 匹配步骤
+                                step_num = active_steps_info.get(block_index, {}).get("step_number", block_index + 1)
+                                yield {
+                                    "type": "step_complete",
+                                    "step_type": block_type,
+                                    "step_number": step_num,
+                                    "tool_name": block_info.get("name", "unknown"),
+                                    "tool_id": block_info.get("id", ""),
+                                    "index": block_index
+                                }
+                            elif block_type == "code_execution_tool_result":
+                                # 代码执行结果完成
+                                yield {
+                                    "type": "code_result_complete",
+                                    "index": block_index
+                                }
+                            elif block_type in ("text_editor_code_execution_tool_result", "bash_code_execution_tool_result"):
+                                # Skills 代码执行结果完成
+                                yield {
+                                    "type": "skill_result_complete",
+                                    "result_type": block_type.replace("_tool_result", ""),
+                                    "index": block_index
+                                }
+                            else:
+                                yield {
+                                    "type": "content_stop",
+                                    "content_type": block_type,
+                                    "index": block_index
+                                }
+
+                            # 清理
+                            if block_index in current_blocks:
+                                del current_blocks[block_index]
+
+                        elif event.type == "message_start":
+                            # 自动继续的后续调用不再发送 message_start / message_stop，
+                            # 前端收到的仍是一条完整的消息
+                            if not segments:
+                                yield {"type": "message_start"}
+                        elif event.type == "message_stop":
+                            if not _should_continue(stream.current_message_snapshot, len(segments)):
+                                yield {
+                                    "type": "message_stop",
+                                    "total_steps": step_counter
+                                }
+
+                final_message = await stream.get_final_message()
+
+            # pause_turn：在同一容器中自动继续，后续事件接在同一个 SSE 响应中
+            if not _should_continue(final_message, len(segments)):
+                break
+            segments.append(final_message)
+            _record_usage("/stream/invoke", _usage_dict(final_message.usage), "completed")
+            stream = None
+            if getattr(final_message, "container", None):
+                container["id"] = final_message.container.id
+            messages = [*messages, _assistant_message(final_message)]
+            yield {"type": "continuation", "continuation": len(segments)}
+
+        # 获取最终响应（合并自动继续的各段）
+        final_message = _merge_continued_messages([*segments, final_message])
+        container_id = ""
+        if hasattr(final_message, "container") and final_message.container:
+            container_id = final_message.container.id
+        if on_final_message is not None:
+            on_final_message(final_message)
+
+        # 从最终消息中再次提取file_ids（以防流式处理时遗漏）
+        for content in final_message.content:
+            if hasattr(content, "type") and content.type == "bash_code_execution_tool_result":
+                result_content = getattr(content, "content", None)
+                if result_content and hasattr(result_content, "type"):
+                    if result_content.type == "bash_code_execution_result":
+                        for item in getattr(result_content, "content", []):
+                            if hasattr(item, "file_id") and item.file_id:
+                                if item.file_id not in collected_file_ids:
+                                    collected_file_ids.append(item.file_id)
+
+        outcome = "completed"
+
+        # 发送完成事件
+        yield {
+            "type": "done",
+            "container_id": container_id,
+            "stop_reason": final_message.stop_reason,
+            "usage": _usage_dict(final_message.usage),
+            "file_ids": collected_file_ids if collected_file_ids else None
+        }
+
+    except anthropic.APIError as e:
+        outcome = "failed"
+        yield {"type": "error", "error": f"Anthropic API Error: {str(e)}"}
+    except HTTPException as e:
+        # 隔离舱 / 准入队列已满、排队超时或超过请求的截止时间
+        outcome = "failed"
+        yield {
+            "type": "error",
+            "status_code": e.status_code,
+            "error": e.detail,
+            **({"retry_after": int(e.headers["Retry-After"])} if e.headers and "Retry-After" in e.headers else {}),
+        }
+    except Exception as e:
+        outcome = "failed"
+        yield {"type": "error", "error": f"Internal Server Error: {str(e)}"}
+    finally:
+        slot.release()
+        _record_usage(
+            "/stream/invoke", _partial_usage(stream) if stream is not None else None, outcome
+        )
+
+
+# ============================================================================
+# 多 Skill 并行 (fan-out)：每个 Skill 在各自的容器中执行，结果合并
+# ============================================================================
+
+# 单个 fan-out 请求同时执行的 Skill 数上限
+FAN_OUT_MAX_PARALLEL = int(os.environ.get("FAN_OUT_MAX_PARALLEL", "4"))
+
+
+def _is_fan_out(skill_request: SkillRequest) -> bool:
+    return skill_request.parallel and len(set(skill_request.skill_ids)) > 1
+
+
+def _fan_out_branches(skill_request: SkillRequest) -> List[Tuple[str, SkillRequest]]:
+    """拆分为每个 Skill 一个子请求（去重并保持顺序），提示词和 max_tokens 不变"""
+    return [
+        (skill_id, skill_request.model_copy(update={"skill_ids": [skill_id], "parallel": False}))
+        for skill_id in dict.fromkeys(skill_request.skill_ids)
+    ]
+
+
+def _merge_fan_out_responses(skill_ids: List[str], responses: List[SkillResponse]) -> SkillResponse:
+    """
+    把各分支的 SkillResponse 合并为一个
+
+    内容按 Skill 顺序拼接并标注 skill_id，用量累加；各分支的容器不同，
+    container_id 为空，每个分支的容器和结束原因见 branches。
+    任一分支未正常结束时 stop_reason 取该分支的结束原因。
+    """
+    return SkillResponse(
+        status="success",
+        container_id="",
+        stop_reason=next(
+            (r.stop_reason for r in responses if r.stop_reason not in CACHEABLE_STOP_REASONS),
+            responses[0].stop_reason,
+        ),
+        model=responses[0].model,
+        response=[
+            {**block, "skill_id": skill_id}
+            for skill_id, r in zip(skill_ids, responses)
+            for block in r.response
+        ],
+        usage={key: sum(r.usage.get(key, 0) for r in responses) for key in USAGE_TOKEN_KEYS},
+        file_ids=[file_id for r in responses for file_id in r.file_ids],
+        branches=[
+            {
+                "skill_id": skill_id,
+                "container_id": r.container_id,
+                "stop_reason": r.stop_reason,
+                "usage": r.usage,
+                "file_ids": r.file_ids,
+            }
+            for skill_id, r in zip(skill_ids, responses)
+        ],
+    )
+
 
-                            # 记录当前块，包括可能的结果内容
-                            current_blocks[block_index] = {
-                                "type": block_type,
-                                "id": getattr(block, "id", None),
-                                "name": getattr(block, "name", None),
-                                "content": []  # 用于收集结果内容
-                            }
+async def _invoke_fan_out(
+    skill_request: SkillRequest,
+    skills_config: List[Dict[str, Any]],
+    cache_key: Optional[str],
+    similarity_scope: Optional[str] = None,
+) -> SkillResponse:
+    """并行执行各分支的非流式调用，任一分支失败时取消其余分支"""
+    branches = _fan_out_branches(skill_request)
+    semaphore = asyncio.Semaphore(FAN_OUT_MAX_PARALLEL)
 
-                            if block_type == "tool_use":
-                                # Claude 调用工具（如 code_execution）
-                                step_counter[0] += 1
-                                # 记录此 block_index 对应的 step_number
-                                active_steps_info[block_index] = {"step_number": step_counter[0]}
-                                event_queue.put({
-                                    "type": "step_start",
-                                    "step_type": "tool_use",
-                                    "step_number": step_counter[0],
-                                    "tool_name": getattr(block, "name", "unknown"),
-                                    "tool_id": getattr(block, "id", ""),
-                                    "index": block_index
-                                })
-                            elif block_type == "server_tool_use":
-                                # 服务器端工具调用（skill 执行）
-                                step_counter[0] += 1
-                                # 记录此 block_index 对应的 step_number
-                                active_steps_info[block_index] = {"step_number": step_counter[0]}
-                                event_queue.put({
-                                    "type": "step_start",
-                                    "step_type": "server_tool_use",
-                                    "step_number": step_counter[0],
-                                    "tool_name": getattr(block, "name", "skill"),
-                                    "tool_id": getattr(block, "id", ""),
-                                    "index": block_index
-                                })
-                            elif block_type == "code_execution_tool_result":
-                                # 代码执行结果 - 提取结果内容
-                                result_content = getattr(block, "content", [])
-                                result_data = []
-                                for item in result_content:
-                                    item_type = getattr(item, "type", "unknown")
-                                    if item_type == "text":
-                                        result_data.append({
-                                            "type": "text",
-                                            "text": getattr(item, "text", "")
-                                        })
-                                    elif item_type == "image":
-                                        # 图片结果（如图表）
-                                        result_data.append({
-                                            "type": "image",
-                                            "media_type": getattr(item.source, "media_type", "image/png") if hasattr(item, "source") else "image/png"
-                                        })
+    async def run_branch(skill_id: str, branch_request: SkillRequest) -> SkillResponse:
+        async with semaphore:
+            return await _invoke_upstream(branch_request, _build_skills_config([skill_id]), None)
+
+    tasks = [asyncio.create_task(run_branch(*branch)) for branch in branches]
+    try:
+        responses = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # 等待被取消的分支执行完 finally（释放名额、记录用量）之后再返回
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    skill_response = _merge_fan_out_responses([skill_id for skill_id, _ in branches], responses)
+    if skill_response.stop_reason in CACHEABLE_STOP_REASONS:
+        await _store_skill_result(
+            skill_request, cache_key, similarity_scope, {"response": skill_response.model_dump()}
+        )
+    return skill_response
+
+
+async def _iter_fan_out_events(
+    skill_request: SkillRequest,
+    on_final_response: Optional[Callable[[SkillResponse], None]] = None,
+):
+    """
+    并行驱动各分支的流式调用，把事件交错合并为一个 SSE 事件流
+
+    分支事件带 skill_id / branch 字段；各分支的 message_start / message_stop 合并为一对，
+    分支结束时发送 branch_done，全部结束后发送合并后的 done。
+    任一分支出错时转发其 error 事件并取消其余分支。
+    """
+    branches = _fan_out_branches(skill_request)
+    skill_ids = [skill_id for skill_id, _ in branches]
+    semaphore = asyncio.Semaphore(FAN_OUT_MAX_PARALLEL)
+    event_queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_SUBSCRIBER_QUEUE_SIZE)
+    responses: Dict[int, SkillResponse] = {}
+
+    async def run_branch(index: int, skill_id: str, branch_request: SkillRequest):
+        def on_final_message(message):
+            responses[index] = _skill_response_from_message(message)
+
+        try:
+            async with semaphore:
+                events = _iter_skill_stream_events(
+                    branch_request, _build_skills_config([skill_id]), on_final_message
+                )
+                async with aclosing(events):
+                    async for event in events:
+                        await event_queue.put((index, event))
+        except Exception as e:
+            await event_queue.put((index, {"type": "error", "error": f"Internal Server Error: {str(e)}"}))
+        await event_queue.put((index, _STREAM_END))
+
+    tasks = [
+        asyncio.create_task(run_branch(index, *branch)) for index, branch in enumerate(branches)
+    ]
+    try:
+        yield {"type": "message_start", "skill_ids": skill_ids}
+        pending = len(tasks)
+        total_steps = 0
+        while pending:
+            index, event = await event_queue.get()
+            if event is _STREAM_END:
+                pending -= 1
+                continue
+            branch_fields = {"skill_id": skill_ids[index], "branch": index}
+            event_type = event.get("type")
+            if event_type == "message_start":
+                continue
+            if event_type == "message_stop":
+                total_steps += event.get("total_steps", 0)
+                continue
+            if event_type == "done":
+                yield {**event, **branch_fields, "type": "branch_done"}
+                continue
+            yield {**event, **branch_fields}
+            if event_type == "error":
+                return
+
+        skill_response = _merge_fan_out_responses(
+            skill_ids, [responses[index] for index in range(len(branches))]
+        )
+        if on_final_response is not None:
+            on_final_response(skill_response)
+        yield {"type": "message_stop", "total_steps": total_steps}
+        yield {
+            "type": "done",
+            "container_id": "",
+            "stop_reason": skill_response.stop_reason,
+            "usage": skill_response.usage,
+            "file_ids": skill_response.file_ids or None,
+            "branches": skill_response.branches,
+        }
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+
+
+def _skill_events(
+    skill_request: SkillRequest, skills_config: List[Dict[str, Any]], final_response: List[SkillResponse]
+):
+    """按请求模式选择事件源，结束时把最终的 SkillResponse 追加到 final_response"""
+    if _is_fan_out(skill_request):
+        return _iter_fan_out_events(skill_request, final_response.append)
+    return _iter_skill_stream_events(
+        skill_request,
+        skills_config,
+        on_final_message=lambda message: final_response.append(_skill_response_from_message(message)),
+    )
+
+
+# ============================================================================
+# 可恢复的流式执行：带序号的事件 + 有界回放缓冲区，支持 Last-Event-ID 断线续传
+# ============================================================================
+
+STREAM_REPLAY_BUFFER_SIZE = int(os.environ.get("STREAM_REPLAY_BUFFER_SIZE", "2000"))
+# 最后一个订阅者断开后等待重连的时间（秒），超时仍无人重连则取消上游调用
+STREAM_RESUME_GRACE = float(os.environ.get("STREAM_RESUME_GRACE", "30"))
+# 执行结束后保留回放缓冲区的时间（秒）
+STREAM_RETENTION_SECONDS = float(os.environ.get("STREAM_RETENTION_SECONDS", "300"))
+
+
+class SkillStreamRun:
+    """
+    一次流式 Skill 执行
+
+    上游事件由后台任务写入带单调序号的有界回放缓冲区，订阅者各自按序号游标读取。
+    执行与客户端连接解耦：断线后可凭 Last-Event-ID 续传，无需再次调用 Anthropic。
+    """
+
+    def __init__(
+        self,
+        events,
+        key: Optional[str] = None,
+        flight_key: Optional[str] = None,
+        idempotency_key: Optional[str] = None,
+    ):
+        self.stream_id = f"stream_{uuid.uuid4().hex}"
+        self.key = key
+        self.flight_key = flight_key
+        self.idempotency_key = idempotency_key
+        self.buffer: deque = deque(maxlen=STREAM_REPLAY_BUFFER_SIZE)  # (seq, event)
+        self.last_seq = 0
+        self.finished = False
+        self.completed = False  # 以 done 事件结束（而不是 error 或被取消）
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+        self._task = asyncio.create_task(self._pump(events))
+
+    async def _pump(self, events):
+        try:
+            async with aclosing(events):
+                async for event in events:
+                    self.last_seq += 1
+                    self.buffer.append((self.last_seq, event))
+                    self.completed = event.get("type") == "done"
+                    self._notify()
+        finally:
+            self.finished = True
+            if self.flight_key is not None and _inflight_streams.get(self.flight_key) == self.stream_id:
+                del _inflight_streams[self.flight_key]
+            if not self.completed:
+                # 失败的执行不保留给幂等重试，重试时重新调用上游
+                self._forget_idempotency_key()
+            self._cancel_idle_timer()
+            self._notify()
+            asyncio.get_running_loop().call_later(STREAM_RETENTION_SECONDS, self._evict)
+
+    def _evict(self) -> None:
+        _stream_runs.pop(self.stream_id, None)
+        if self.key is not None and _stream_keys.get(self.key) == self.stream_id:
+            del _stream_keys[self.key]
+        self._forget_idempotency_key()
+
+    def _forget_idempotency_key(self) -> None:
+        if (
+            self.idempotency_key is not None
+            and _idempotent_streams.get(self.idempotency_key, ("", ""))[1] == self.stream_id
+        ):
+            del _idempotent_streams[self.idempotency_key]
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _cancel_idle_timer(self) -> None:
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _cancel_if_idle(self) -> None:
+        self._idle_handle = None
+        if self.subscribers == 0 and not self.finished:
+            logger.info("no subscriber reattached to %s, cancelling upstream", self.stream_id)
+            self._task.cancel()
+
+    @property
+    def first_seq(self) -> int:
+        """回放缓冲区中最早事件的序号"""
+        return self.buffer[0][0] if self.buffer else self.last_seq + 1
+
+    def can_resume_from(self, after_seq: int) -> bool:
+        """after_seq 之后的事件是否仍全部在回放缓冲区中"""
+        return self.first_seq <= after_seq + 1
+
+    async def subscribe(self, after_seq: int = 0):
+        """
+        按序产出 (seq, event)：先回放 after_seq 之后的缓冲事件，再实时推送直到执行结束
+
+        每个订阅者有独立游标，读取快慢互不影响；落后超出回放缓冲区的订阅者
+        会收到 error 事件并被断开。
+        """
+        self.subscribers += 1
+        self._cancel_idle_timer()
+        try:
+            cursor = after_seq
+            while True:
+                changed = self._changed
+                if not self.can_resume_from(cursor):
+                    STREAM_STATS["dropped_subscribers"] += 1
+                    logger.info("subscriber of %s fell behind the replay buffer", self.stream_id)
+                    yield cursor, {
+                        "type": "error",
+                        "error": "Events are no longer in the replay buffer",
+                    }
+                    return
+
+                pending = [item for item in self.buffer if item[0] > cursor]
+                for seq, event in pending:
+                    yield seq, event
+                    cursor = seq
+
+                if self.finished and cursor >= self.last_seq:
+                    return
+                if not pending:
+                    await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.finished:
+                self._idle_handle = asyncio.get_running_loop().call_later(
+                    STREAM_RESUME_GRACE, self._cancel_if_idle
+                )
+
+
+# 本 worker 中的流式执行（多 worker 部署时续传请求需要粘性会话路由到同一 worker）
+_stream_runs: Dict[str, SkillStreamRun] = {}
+# 共享 key（如对话 / 报告 ID）到 stream_id 的映射，供分享页、多个标签页订阅同一次执行；
+# key 由客户端选择，按调用方（API key，没有时按 IP）隔离，见 _scoped_stream_key
+_stream_keys: Dict[str, str] = {}
+
+STREAM_STATS: Dict[str, int] = {"started": 0, "attached": 0, "dropped_subscribers": 0}
+
+
+def _scoped_stream_key(stream_key: str) -> str:
+    """共享 key 只在同一调用方内有效，其他调用方猜到 key 也无法订阅别人的执行"""
+    return f"{_current_tenant.get()}:{stream_key}"
+
+
+def _stream_metrics() -> Dict[str, int]:
+    running = [run for run in _stream_runs.values() if not run.finished]
+    return {
+        **STREAM_STATS,
+        "running": len(running),
+        "retained": len(_stream_runs) - len(running),
+        "subscribers": sum(run.subscribers for run in _stream_runs.values()),
+    }
+
+
+async def _shutdown_stream_runs():
+    """关闭服务时取消仍在执行的流式调用"""
+    tasks = [run._task for run in _stream_runs.values() if not run.finished]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+def _parse_last_event_id(last_event_id: str):
+    """解析 Last-Event-ID（格式为 {stream_id}:{seq}）"""
+    stream_id, sep, seq = last_event_id.strip().rpartition(":")
+    if not sep or not stream_id or not seq.isdigit():
+        raise HTTPException(status_code=400, detail=f"Invalid Last-Event-ID: {last_event_id}")
+    return stream_id, int(seq)
+
+
+def _get_resumable_run(stream_id: str, after_seq: int) -> SkillStreamRun:
+    run = _stream_runs.get(stream_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' not found or expired")
+    if not run.can_resume_from(after_seq):
+        raise HTTPException(
+            status_code=410, detail="Requested events are no longer in the replay buffer"
+        )
+    return run
+
+
+def _stream_run_response(
+    request: Request,
+    run: SkillStreamRun,
+    after_seq: int = 0,
+    headers: Optional[Dict[str, str]] = None,
+):
+    """把流式执行的订阅转换为 SSE 响应，每个事件带 id: {stream_id}:{seq}"""
+
+    async def generate_stream():
+        """异步生成器，转发事件并在空闲时发送keepalive"""
+        async with aclosing(_with_keepalive(run.subscribe(after_seq), request)) as events:
+            async for item in events:
+                if item is None:
+                    # 发送SSE keepalive注释（以:开头的行被SSE客户端忽略但保持连接）
+                    yield f": keepalive {int(time.time())}\n\n"
+                    continue
+
+                seq, event = item
+                yield f"id: {run.stream_id}:{seq}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+                # 如果是结束事件，退出循环
+                if event.get("type") in ("done", "error"):
+                    break
+
+    return StreamingResponse(
+        generate_stream(),
+        media_type="text/event-stream",
+        headers={**SSE_HEADERS, "X-Stream-Id": run.stream_id, **(headers or {})},
+    )
+
+
+@app.post("/stream/invoke")
+@limiter.limit("5/second")
+async def invoke_skills_stream(request: Request, skill_request: SkillRequest):
+    """
+    调用指定的 Skills (流式响应)
+
+    返回 Server-Sent Events (SSE) 格式的流式响应
+    Rate Limit: 5 requests per second
+
+    上游事件由后台任务推入 asyncio.Queue，空闲时按定时器发送 keepalive heartbeat，
+    避免长时间无事件导致连接超时。
+    每个事件带 id: {stream_id}:{seq}；断线后携带 Last-Event-ID 头重新请求
+    即可从断点续传，不会再次调用 Anthropic。
+    parallel=true 时各 Skill 并行执行，事件交错发送并带 skill_id / branch 字段。
+    携带 X-Stream-Key 头（如对话 ID）时，同 key 的执行若仍在进行则直接订阅它。
+    内容相同的请求正在执行时同样直接订阅它（响应头 X-Coalesced: true）。
+    携带 Idempotency-Key 头重试时重新订阅或回放原来那次执行（响应头 Idempotent-Replayed: true）。
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id:
+        stream_id, after_seq = _parse_last_event_id(last_event_id)
+        return _stream_run_response(request, _get_resumable_run(stream_id, after_seq), after_seq)
+
+    skills_config = _build_skills_config(skill_request.skill_ids)
+
+    # 带共享 key 且同 key 的执行仍在进行时，直接订阅它而不是再次调用上游
+    stream_key = request.headers.get("x-stream-key")
+    if stream_key:
+        stream_key = _scoped_stream_key(stream_key)
+        run = _stream_runs.get(_stream_keys.get(stream_key, ""))
+        if run is not None and not run.finished:
+            STREAM_STATS["attached"] += 1
+            return _stream_run_response(request, run, run.first_seq - 1)
+
+    # 幂等重试：原来的执行仍在本 worker 中时重新订阅，已完成时回放保存的事件
+    record_key = None
+    idempotency_key = request.headers.get("idempotency-key")
+    if idempotency_key:
+        record_key = _idempotency_record_key("stream", idempotency_key)
+        fingerprint = _request_fingerprint(skill_request)
+        replayed_headers = {"Idempotent-Replayed": "true"}
+        inflight = _idempotent_streams.get(record_key)
+        run = _stream_runs.get(inflight[1]) if inflight else None
+        if run is not None and not run.finished:
+            _check_fingerprint(inflight[0], fingerprint)
+            STREAM_STATS["attached"] += 1
+            return _stream_run_response(request, run, run.first_seq - 1, replayed_headers)
+        record = await idempotency_store.get(record_key)
+        if record is not None:
+            _check_fingerprint(record["fingerprint"], fingerprint)
+            run = SkillStreamRun(
+                _replay_events(record.get("events") or _events_from_skill_response(record["response"]))
+            )
+            _stream_runs[run.stream_id] = run
+            return _stream_run_response(request, run, headers=replayed_headers)
+
+    # 命中结果缓存时以相同的 SSE 格式回放，前端无需区分
+    cache_headers = {}
+    events = None
+    final_response: List[SkillResponse] = []
+    cache_key = _skill_cache_key(request, skill_request)
+    if cache_key:
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            cache_headers["X-Cache"] = "HIT"
+            events = _replay_events(
+                cached.get("events") or _events_from_skill_response(cached["response"])
+            )
+        else:
+            cache_headers["X-Cache"] = "MISS"
+
+    similarity_scope = None
+    if events is None:
+        similarity_scope = _similarity_scope(request, skill_request)
+        if similarity_scope:
+            similar = await similarity_cache.get(similarity_scope, skill_request.message)
+            if similar is not None:
+                cache_headers["X-Cache"] = "SIMILAR"
+                cache_headers["X-Cache-Similarity"] = f"{similar[1]:.3f}"
+                events = _replay_events(
+                    similar[0].get("events") or _events_from_skill_response(similar[0]["response"])
+                )
+            else:
+                cache_headers["X-Cache"] = "MISS"
+
+    flight_key = None
+    if events is None:
+        # 相同请求正在执行且回放缓冲区仍保留完整事件时，从头订阅它
+        flight_key = _flight_key(request, skill_request)
+        run = _stream_runs.get(_inflight_streams.get(flight_key or "", ""))
+        if run is not None and not run.finished and run.first_seq == 1:
+            COALESCE_STATS["stream_joined"] += 1
+            return _stream_run_response(
+                request, run, headers={**cache_headers, "X-Coalesced": "true"}
+            )
+
+        # 队列已满或预计等待超过截止时间：在返回流式响应之前以 503 拒绝
+        SkillSlot(skill_request.skill_ids, skill_request.max_tokens).check_admission()
+        events = _skill_events(skill_request, skills_config, final_response)
+        if cache_key or similarity_scope:
+            events = _caching_skill_events(
+                events,
+                final_response,
+                lambda value: _store_skill_result(skill_request, cache_key, similarity_scope, value),
+            )
+
+    if record_key:
+        events = _idempotent_skill_events(events, record_key, fingerprint, final_response)
+
+    run = SkillStreamRun(events, stream_key, flight_key, record_key)
+    _stream_runs[run.stream_id] = run
+    if stream_key:
+        _stream_keys[stream_key] = run.stream_id
+    if flight_key:
+        _inflight_streams[flight_key] = run.stream_id
+    if record_key:
+        _idempotent_streams[record_key] = (fingerprint, run.stream_id)
+    STREAM_STATS["started"] += 1
+    return _stream_run_response(request, run, headers=cache_headers)
+
+
+@app.get("/stream/by-key/{stream_key}")
+async def watch_skills_stream_by_key(request: Request, stream_key: str):
+    """
+    按共享 key 订阅最近一次流式执行（分享页、多个标签页观看同一份报告）
+
+    从回放缓冲区中最早的事件开始推送，之后实时跟随直到执行结束。
+    只能订阅同一调用方（相同的 API key，没有时相同的 IP）发起的执行。
+    """
+    run = _stream_runs.get(_stream_keys.get(_scoped_stream_key(stream_key), ""))
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"No stream for key '{stream_key}'")
+    STREAM_STATS["attached"] += 1
+    return _stream_run_response(request, run, run.first_seq - 1)
+
+
+@app.get("/stream/{stream_id}")
+async def resume_skills_stream(
+    request: Request, stream_id: str, last_event_id: Optional[str] = None
+):
+    """
+    续传或观看流式执行（支持多个客户端同时订阅）
+
+    断点通过 Last-Event-ID 头或 last_event_id 查询参数指定（完整事件 id 或序号），
+    省略时从回放缓冲区中最早的事件开始推送。
+    """
+    last_event_id = request.headers.get("last-event-id") or last_event_id
+    if not last_event_id:
+        run = _stream_runs.get(stream_id)
+        if run is None:
+            raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' not found or expired")
+        STREAM_STATS["attached"] += 1
+        return _stream_run_response(request, run, run.first_seq - 1)
+
+    if last_event_id.isdigit():
+        after_seq = int(last_event_id)
+    else:
+        event_stream_id, after_seq = _parse_last_event_id(last_event_id)
+        if event_stream_id != stream_id:
+            raise HTTPException(status_code=400, detail="Last-Event-ID belongs to another stream")
+
+    return _stream_run_response(request, _get_resumable_run(stream_id, after_seq), after_seq)
+
+
+# ============================================================================
+# 后台任务 (Jobs)：长时间运行的 Skills 与客户端连接解耦
+# ============================================================================
+
+JOB_STORE_BACKEND = os.environ.get("JOB_STORE", "redis" if SKILLS_REDIS_URL else "memory")
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", "86400"))  # 任务结果保留 24 小时
+JOB_EVENTS_POLL_INTERVAL = float(os.environ.get("JOB_EVENTS_POLL_INTERVAL", "0.5"))
+
+JOB_FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: JobStatus
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    event_count: int = 0
+    result: Optional[SkillResponse] = None
+    error: Optional[str] = None
+
+
+class JobStore(ABC):
+    """
+    任务存储接口：任务记录 + 有序事件日志
+
+    同一 worker 内追加事件时会立即唤醒订阅者；跨 worker 的订阅者按
+    JOB_EVENTS_POLL_INTERVAL 轮询存储。
+    """
+
+    def __init__(self):
+        self._signals: Dict[str, asyncio.Event] = {}
+
+    @abstractmethod
+    async def create(self, job: Dict[str, Any]) -> None:
+        """保存新任务"""
+
+    @abstractmethod
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """读取任务，不存在时返回 None"""
+
+    @abstractmethod
+    async def update(self, job_id: str, **fields) -> None:
+        """更新任务的部分字段"""
+
+    @abstractmethod
+    async def _append_event(self, job_id: str, event: Dict[str, Any]) -> None:
+        """在任务的事件日志末尾追加一个事件"""
+
+    @abstractmethod
+    async def read_events(self, job_id: str, start: int = 0) -> List[Dict[str, Any]]:
+        """读取第 start 个及之后的事件"""
+
+    async def append_event(self, job_id: str, event: Dict[str, Any]) -> None:
+        await self._append_event(job_id, event)
+        self._notify(job_id)
+
+    def _notify(self, job_id: str) -> None:
+        signal = self._signals.pop(job_id, None)
+        if signal is not None:
+            signal.set()
+
+    async def wait_for_events(
+        self, job_id: str, start: int, timeout: float = JOB_EVENTS_POLL_INTERVAL
+    ) -> List[Dict[str, Any]]:
+        """读取 start 之后的事件，暂无新事件时最多等待 timeout 秒"""
+        events = await self.read_events(job_id, start)
+        if events:
+            return events
+        signal = self._signals.setdefault(job_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(signal.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        return await self.read_events(job_id, start)
+
+
+class InMemoryJobStore(JobStore):
+    """进程内任务存储（单 worker 部署）"""
+
+    def __init__(self):
+        super().__init__()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._events: Dict[str, List[Dict[str, Any]]] = {}
+
+    def _evict_expired(self) -> None:
+        cutoff = time.time() - JOB_TTL_SECONDS
+        for job_id in [jid for jid, job in self._jobs.items() if job["created_at"] < cutoff]:
+            self._jobs.pop(job_id, None)
+            self._events.pop(job_id, None)
+
+    async def create(self, job: Dict[str, Any]) -> None:
+        self._evict_expired()
+        self._jobs[job["job_id"]] = dict(job)
+        self._events[job["job_id"]] = []
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return dict(job, event_count=len(self._events.get(job_id, [])))
+
+    async def update(self, job_id: str, **fields) -> None:
+        if job_id in self._jobs:
+            self._jobs[job_id].update(fields)
+        self._notify(job_id)
+
+    async def _append_event(self, job_id: str, event: Dict[str, Any]) -> None:
+        self._events.setdefault(job_id, []).append(event)
+
+    async def read_events(self, job_id: str, start: int = 0) -> List[Dict[str, Any]]:
+        return self._events.get(job_id, [])[start:]
+
+
+class RedisJobStore(JobStore):
+    """Redis 任务存储（多 worker / 多实例部署共享）"""
+
+    KEY_PREFIX = "skills:job:"
+
+    def _job_key(self, job_id: str) -> str:
+        return f"{self.KEY_PREFIX}{job_id}"
+
+    def _events_key(self, job_id: str) -> str:
+        return f"{self.KEY_PREFIX}{job_id}:events"
+
+    async def create(self, job: Dict[str, Any]) -> None:
+        await get_redis().set(
+            self._job_key(job["job_id"]), json.dumps(job, ensure_ascii=False), ex=JOB_TTL_SECONDS
+        )
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        redis = get_redis()
+        raw = await redis.get(self._job_key(job_id))
+        if raw is None:
+            return None
+        return dict(json.loads(raw), event_count=await redis.llen(self._events_key(job_id)))
+
+    async def update(self, job_id: str, **fields) -> None:
+        redis = get_redis()
+        raw = await redis.get(self._job_key(job_id))
+        if raw is not None:
+            job = json.loads(raw)
+            job.update(fields)
+            await redis.set(
+                self._job_key(job_id), json.dumps(job, ensure_ascii=False), keepttl=True
+            )
+        self._notify(job_id)
+
+    async def _append_event(self, job_id: str, event: Dict[str, Any]) -> None:
+        redis = get_redis()
+        key = self._events_key(job_id)
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, json.dumps(event, ensure_ascii=False))
+            pipe.expire(key, JOB_TTL_SECONDS)
+            await pipe.execute()
+
+    async def read_events(self, job_id: str, start: int = 0) -> List[Dict[str, Any]]:
+        raw_events = await get_redis().lrange(self._events_key(job_id), start, -1)
+        return [json.loads(raw) for raw in raw_events]
+
+
+if JOB_STORE_BACKEND == "redis":
+    job_store: JobStore = RedisJobStore()
+else:
+    job_store = InMemoryJobStore()
+
+# 本 worker 中正在运行的任务（保持引用，避免被垃圾回收，并支持取消）
+_job_tasks: Dict[str, asyncio.Task] = {}
+
+
+async def _run_skill_job(
+    job_id: str, skill_request: SkillRequest, skills_config: List[Dict[str, Any]]
+):
+    """在后台执行 Skill，把事件写入任务事件日志，结束后保存 SkillResponse"""
+    final_response: List[SkillResponse] = []
+    status_fields: Dict[str, Any] = {"status": JobStatus.FAILED.value, "error": "Job ended without result"}
+    try:
+        await job_store.update(job_id, status=JobStatus.RUNNING.value, started_at=time.time())
+
+        async with aclosing(_skill_events(skill_request, skills_config, final_response)) as events:
+            async for event in events:
+                await job_store.append_event(job_id, event)
+                if event.get("type") == "error":
+                    status_fields = {"status": JobStatus.FAILED.value, "error": event.get("error")}
+
+        if final_response:
+            status_fields = {
+                "status": JobStatus.SUCCEEDED.value,
+                "result": final_response[0].model_dump(),
+                "error": None,
+            }
+    except asyncio.CancelledError:
+        status_fields = {"status": JobStatus.CANCELLED.value, "error": "Job cancelled"}
+        await job_store.append_event(job_id, {"type": "error", "error": "Job cancelled"})
+    except Exception as e:
+        status_fields = {"status": JobStatus.FAILED.value, "error": f"Internal Server Error: {str(e)}"}
+        await job_store.append_event(job_id, {"type": "error", "error": status_fields["error"]})
+    finally:
+        _job_tasks.pop(job_id, None)
+        await job_store.update(job_id, finished_at=time.time(), **status_fields)
+
+
+async def _shutdown_jobs():
+    """关闭服务时取消本 worker 中仍在运行的任务，并把状态写回存储"""
+    tasks = list(_job_tasks.values())
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+async def _get_job_or_404(job_id: str) -> Dict[str, Any]:
+    job = await job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return job
+
+
+@app.post("/jobs", response_model=JobResponse, status_code=status.HTTP_202_ACCEPTED)
+@limiter.limit("5/second")
+async def create_job(request: Request, skill_request: SkillRequest):
+    """
+    提交后台任务（立即返回 job_id）
+
+    任务在服务端独立执行，与客户端连接无关。之后可以通过
+    GET /jobs/{job_id} 轮询、GET /jobs/{job_id}/events 订阅 SSE 事件，
+    或 GET /jobs/{job_id}/result 获取最终的 SkillResponse。
+    Rate Limit: 5 requests per second
+    """
+    skills_config = _build_skills_config(skill_request.skill_ids)
+
+    job = {
+        "job_id": f"job_{uuid.uuid4().hex}",
+        "status": JobStatus.QUEUED.value,
+        "created_at": time.time(),
+        "request": skill_request.model_dump(),
+    }
+    await job_store.create(job)
+
+    # 后台任务与客户端连接无关，不受提交请求的截止时间限制
+    _request_deadline.set(None)
+    _job_tasks[job["job_id"]] = asyncio.create_task(
+        _run_skill_job(job["job_id"], skill_request, skills_config)
+    )
+    return JobResponse(**job)
+
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    """查询任务状态（完成后包含结果）"""
+    return JobResponse(**await _get_job_or_404(job_id))
+
+
+@app.get("/jobs/{job_id}/result", response_model=SkillResponse)
+async def get_job_result(job_id: str):
+    """获取任务的最终结果，任务未完成时返回 409"""
+    job = await _get_job_or_404(job_id)
+    if job["status"] == JobStatus.SUCCEEDED.value:
+        return SkillResponse(**job["result"])
+    if job["status"] in JOB_FINISHED_STATUSES:
+        raise HTTPException(status_code=500, detail=job.get("error") or "Job failed")
+    raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(request: Request, job_id: str):
+    """
+    订阅任务事件 (SSE)
+
+    先回放已产生的全部事件，再实时推送后续事件，直到任务结束。
+    断开连接只会结束订阅，不影响任务执行。
+    """
+    await _get_job_or_404(job_id)
+
+    async def follow_events():
+        cursor = 0
+        while True:
+            events = await job_store.wait_for_events(job_id, cursor)
+            for event in events:
+                yield event
+            cursor += len(events)
+
+            if not events:
+                job = await job_store.get(job_id)
+                if job is None or (
+                    job["status"] in JOB_FINISHED_STATUSES and job["event_count"] <= cursor
+                ):
+                    return
+
+    async def generate_stream():
+        async with aclosing(_with_keepalive(follow_events(), request)) as events:
+            async for event in events:
+                if event is None:
+                    yield f": keepalive {int(time.time())}\n\n"
+                    continue
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        generate_stream(),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+@app.delete("/jobs/{job_id}", response_model=JobResponse)
+async def cancel_job(job_id: str):
+    """取消正在本 worker 中运行的任务"""
+    job = await _get_job_or_404(job_id)
+    task = _job_tasks.get(job_id)
+    if task is None:
+        if job["status"] in JOB_FINISHED_STATUSES:
+            return JobResponse(**job)
+        raise HTTPException(status_code=409, detail="Job is not running on this worker")
+
+    task.cancel()
+    await asyncio.wait({task})
+    return JobResponse(**await _get_job_or_404(job_id))
+
+
+# ============================================================================
+# 会话 (Sessions)：服务端保存多轮对话的历史、container_id 和用量
+# ============================================================================
+
+SESSION_STORE_BACKEND = os.environ.get("SESSION_STORE", "redis" if SKILLS_REDIS_URL else "memory")
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "86400"))  # 会话空闲 24 小时后过期
+
+
+class SessionCreateRequest(BaseModel):
+    skill_ids: List[str] = Field(..., description="List of skill IDs to use (max 8)")
+    max_tokens: int = Field(
+        default=16384, ge=1, le=128000, description="Default maximum tokens per turn"
+    )
+
+
+class SessionMessageRequest(BaseModel):
+    message: str = Field(..., description="New user message for this turn")
+    max_tokens: Optional[int] = Field(
+        None, ge=1, le=128000, description="Override the session's max_tokens for this turn"
+    )
+    stream: bool = Field(False, description="Return Server-Sent Events instead of a SkillResponse")
+
+
+class SessionResponse(BaseModel):
+    session_id: str
+    skill_ids: List[str]
+    container_id: Optional[str] = None
+    max_tokens: int
+    turns: int = 0
+    usage: Dict[str, int]
+    history_tokens_saved: int = 0
+    created_at: float
+    updated_at: float
+
+
+class SessionStore(ABC):
+    """会话存储接口：每个会话保存为一个 dict（含完整的消息历史）"""
+
+    @abstractmethod
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """读取会话，不存在或已过期时返回 None"""
+
+    @abstractmethod
+    async def save(self, session: Dict[str, Any]) -> None:
+        """保存（覆盖）会话"""
+
+    @abstractmethod
+    async def delete(self, session_id: str) -> bool:
+        """删除会话，返回会话之前是否存在"""
+
+
+class InMemorySessionStore(SessionStore):
+    """进程内会话存储（单 worker 部署）"""
+
+    def __init__(self):
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+
+    def _evict_expired(self) -> None:
+        cutoff = time.time() - SESSION_TTL_SECONDS
+        for session_id in [sid for sid, s in self._sessions.items() if s["updated_at"] < cutoff]:
+            del self._sessions[session_id]
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        self._evict_expired()
+        session = self._sessions.get(session_id)
+        return json.loads(json.dumps(session)) if session is not None else None
+
+    async def save(self, session: Dict[str, Any]) -> None:
+        self._sessions[session["session_id"]] = json.loads(json.dumps(session))
+
+    async def delete(self, session_id: str) -> bool:
+        return self._sessions.pop(session_id, None) is not None
+
+
+class RedisSessionStore(SessionStore):
+    """Redis 会话存储（多 worker / 多实例部署共享）"""
+
+    KEY_PREFIX = "skills:session:"
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        raw = await get_redis().get(f"{self.KEY_PREFIX}{session_id}")
+        return json.loads(raw) if raw is not None else None
+
+    async def save(self, session: Dict[str, Any]) -> None:
+        await get_redis().set(
+            f"{self.KEY_PREFIX}{session['session_id']}",
+            json.dumps(session, ensure_ascii=False),
+            ex=SESSION_TTL_SECONDS,
+        )
+
+    async def delete(self, session_id: str) -> bool:
+        return bool(await get_redis().delete(f"{self.KEY_PREFIX}{session_id}"))
+
+
+session_store: SessionStore = (
+    RedisSessionStore() if SESSION_STORE_BACKEND == "redis" else InMemorySessionStore()
+)
+# 本 worker 中正在执行一轮对话的会话，同一会话同时只能有一轮在执行
+_active_sessions: set = set()
+
+
+async def _get_session_or_404(session_id: str) -> Dict[str, Any]:
+    session = await session_store.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found or expired")
+    return session
+
+
+async def _append_session_turn(session: Dict[str, Any], user_message: str, message) -> None:
+    """把一轮对话（user 消息 + 上游返回的完整 assistant 内容）写入会话历史"""
+    session["messages"].append({"role": "user", "content": user_message})
+    session["messages"].append(_assistant_message(message))
+    if getattr(message, "container", None):
+        session["container_id"] = message.container.id
+    for key, value in _usage_dict(message.usage).items():
+        session["usage"][key] = session["usage"].get(key, 0) + value
+    session["turns"] += 1
+    session["updated_at"] = time.time()
+    await session_store.save(session)
+
+
+async def _session_turn_events(
+    session: Dict[str, Any],
+    skill_request: SkillRequest,
+    skills_config: List[Dict[str, Any]],
+    final_messages: List[Any],
+    tokens_saved: int = 0,
+):
+    """执行会话中的一轮对话，done 事件发出之前把这一轮写入会话历史"""
+    try:
+        async with aclosing(
+            _iter_skill_stream_events(
+                skill_request,
+                skills_config,
+                on_final_message=final_messages.append,
+                history=session["messages"],
+            )
+        ) as events:
+            async for event in events:
+                if event.get("type") == "done" and final_messages:
+                    await _append_session_turn(session, skill_request.message, final_messages[0])
+                    event = dict(
+                        event,
+                        session_id=session["session_id"],
+                        turns=session["turns"],
+                        history_tokens_saved=tokens_saved,
+                    )
+                yield event
+    finally:
+        _active_sessions.discard(session["session_id"])
+
+
+@app.post("/sessions", response_model=SessionResponse, status_code=status.HTTP_201_CREATED)
+async def create_session(session_request: SessionCreateRequest):
+    """
+    创建会话
+
+    之后每一轮只需 POST /sessions/{session_id}/messages 发送新的用户消息，
+    历史消息和 container_id 由服务端保存。
+    """
+    _build_skills_config(session_request.skill_ids)
+    now = time.time()
+    session = {
+        "session_id": f"session_{uuid.uuid4().hex}",
+        "skill_ids": session_request.skill_ids,
+        "container_id": None,
+        "max_tokens": session_request.max_tokens,
+        "turns": 0,
+        "usage": {key: 0 for key in USAGE_TOKEN_KEYS},
+        "messages": [],
+        "created_at": now,
+        "updated_at": now,
+    }
+    await session_store.save(session)
+    return SessionResponse(**session)
 
-                                event_queue.put({
-                                    "type": "code_result_start",
-                                    "index": block_index,
-                                    "tool_use_id": getattr(block, "tool_use_id", ""),
-                                    "result": result_data if result_data else None
-                                })
-                            elif block_type == "server_tool_result":
-                                # 服务器端工具结果 - 提取结果内容
-                                result_content = getattr(block, "content", [])
-                                result_data = []
-                                for item in result_content:
-                                    item_type = getattr(item, "type", "unknown")
-                                    if item_type == "text":
-                                        result_data.append({
-                                            "type": "text",
-                                            "text": getattr(item, "text", "")
-                                        })
 
-                                event_queue.put({
-                                    "type": "server_result_start",
-                                    "index": block_index,
-                                    "tool_use_id": getattr(block, "tool_use_id", ""),
-                                    "result": result_data if result_data else None
-                                })
-                            elif block_type == "text":
-                                # 文本块开始
-                                event_queue.put({
-                                    "type": "content_start",
-                                    "content_type": "text",
-                                    "index": block_index
-                                })
-                            elif block_type in ("text_editor_code_execution_tool_result", "bash_code_execution_tool_result"):
-                                # Skills 的代码执行结果 - 提取结果内容
-                                # block.content 是 BetaTextEditorCodeExecutionViewResultBlock 或类似对象
-                                result_content = getattr(block, "content", None)
-                                result_data = None
+@app.get("/sessions/{session_id}", response_model=SessionResponse)
+async def get_session(session_id: str):
+    """查询会话（container_id、轮数和累计用量）"""
+    return SessionResponse(**await _get_session_or_404(session_id))
 
-                                if result_content:
-                                    # 获取内容类型
-                                    content_type = getattr(result_content, "type", "unknown")
 
-                                    if content_type == "text_editor_code_execution_view_result":
-                                        # 文件查看结果
-                                        result_data = {
-                                            "type": "file_view",
-                                            "content": getattr(result_content, "content", ""),
-                                            "file_type": getattr(result_content, "file_type", "text"),
-                                            "num_lines": getattr(result_content, "num_lines", 0),
-                                            "start_line": getattr(result_content, "start_line", 1),
-                                            "total_lines": getattr(result_content, "total_lines", 0)
-                                        }
-                                    elif content_type == "text_editor_code_execution_edit_result":
-                                        # 文件编辑结果
-                                        result_data = {
-                                            "type": "file_edit",
-                                            "path": getattr(result_content, "path", ""),
-                                            "old_content": getattr(result_content, "old_content", ""),
-                                            "new_content": getattr(result_content, "new_content", "")
-                                        }
-                                    elif content_type == "bash_code_execution_result":
-                                        # Bash 执行结果 - 也检查是否有文件输出
-                                        file_ids_in_result = []
-                                        result_items = getattr(result_content, "content", [])
-                                        for item in result_items:
-                                            if hasattr(item, "file_id") and item.file_id:
-                                                file_ids_in_result.append(item.file_id)
-                                                collected_file_ids.append(item.file_id)
+@app.get("/sessions/{session_id}/messages")
+async def get_session_messages(session_id: str):
+    """获取会话的完整消息历史"""
+    session = await _get_session_or_404(session_id)
+    return {"session_id": session_id, "messages": session["messages"]}
 
-                                        result_data = {
-                                            "type": "bash_result",
-                                            "stdout": getattr(result_content, "stdout", ""),
-                                            "stderr": getattr(result_content, "stderr", ""),
-                                            "exit_code": getattr(result_content, "exit_code", 0),
-                                            "file_ids": file_ids_in_result if file_ids_in_result else None
-                                        }
-                                    else:
-                                        # 其他类型，尝试提取通用信息
-                                        result_data = {
-                                            "type": content_type,
-                                            "content": str(result_content)[:500]  # 截断以避免过长
-                                        }
 
-                                event_queue.put({
-                                    "type": "skill_result_start",
-                                    "result_type": block_type.replace("_tool_result", ""),
-                                    "index": block_index,
-                                    "tool_use_id": getattr(block, "tool_use_id", ""),
-                                    "result": result_data
-                                })
-                            else:
-                                # 其他类型
-                                event_queue.put({
-                                    "type": "content_start",
-                                    "content_type": block_type,
-                                    "index": block_index
-                                })
+@app.post("/sessions/{session_id}/messages")
+@limiter.limit("5/second")
+async def send_session_message(
+    request: Request, response: Response, session_id: str, message_request: SessionMessageRequest
+):
+    """
+    在会话中发送新的一轮用户消息
 
-                        elif event.type == "content_block_stop":
-                            block_index = event.index
-                            block_info = current_blocks.get(block_index, {})
-                            block_type = block_info.get("type", "unknown")
+    服务端拼接历史消息、复用会话的容器，执行结束后把这一轮写入历史。
+    stream=false 返回 SkillResponse；stream=true 返回与 /stream/invoke 相同的 SSE 事件
+    （done 事件附带 session_id 和 turns，同样支持 Last-Event-ID 续传）。
+    同一会话上一轮仍在执行时返回 409。
+    Rate Limit: 5 requests per second
+    """
+    session = await _get_session_or_404(session_id)
+    if session_id in _active_sessions:
+        raise HTTPException(status_code=409, detail="Previous turn of this session is still running")
+
+    skills_config = _build_skills_config(session["skill_ids"])
+    # 压缩后的历史写回会话，之后几轮的前缀保持不变，仍能命中提示词缓存
+    session["messages"], tokens_saved = _compact_history(session["messages"])
+    session["history_tokens_saved"] = session.get("history_tokens_saved", 0) + tokens_saved
+    headers = {"X-Session-Id": session_id}
+    if tokens_saved:
+        headers["X-History-Tokens-Saved"] = str(tokens_saved)
 
-                            if block_type in ("tool_use", "server_tool_use"):
-                                # 步骤完成 - 查找对应的 step_number
-                                # 通过 index 或 tool_id 匹配步骤
-                                step_num = active_steps_info.get(block_index, {}).get("step_number", block_index + 1)
-                                event_queue.put({
-                                    "type": "step_complete",
-                                    "step_type": block_type,
-                                    "step_number": step_num,
-                                    "tool_name": block_info.get("name", "unknown"),
-                                    "tool_id": block_info.get("id", ""),
-                                    "index": block_index
-                                })
-                            elif block_type == "code_execution_tool_result":
-                                # 代码执行结果完成
-                                event_queue.put({
-                                    "type": "code_result_complete",
-                                    "index": block_index
-                                })
-                            elif block_type in ("text_editor_code_execution_tool_result", "bash_code_execution_tool_result"):
-                                # Skills 代码执行结果完成
-                                event_queue.put({
-                                    "type": "skill_result_complete",
-                                    "result_type": block_type.replace("_tool_result", ""),
-                                    "index": block_index
-                                })
-                            else:
-                                event_queue.put({
-                                    "type": "content_stop",
-                                    "content_type": block_type,
-                                    "index": block_index
-                                })
+    skill_request = SkillRequest(
+        skill_ids=session["skill_ids"],
+        message=message_request.message,
+        max_tokens=message_request.max_tokens or session["max_tokens"],
+        container_id=session["container_id"],
+    )
 
-                            # 清理
-                            if block_index in current_blocks:
-                                del current_blocks[block_index]
+    SkillSlot(skill_request.skill_ids, skill_request.max_tokens).check_admission()
+    _active_sessions.add(session_id)
+    final_messages: List[Any] = []
+    events = _session_turn_events(session, skill_request, skills_config, final_messages, tokens_saved)
+    if message_request.stream:
+        run = SkillStreamRun(events)
+        _stream_runs[run.stream_id] = run
+        STREAM_STATS["started"] += 1
+        return _stream_run_response(request, run, headers=headers)
+
+    # 非流式：在本请求内执行完这一轮
+    final_event = None
+    async with aclosing(events):
+        async for event in events:
+            if event.get("type") in ("done", "error"):
+                final_event = event
+    if not final_messages:
+        detail = final_event["error"] if final_event else "Turn ended without result"
+        raise HTTPException(status_code=500, detail=detail)
+    response.headers.update(headers)
+    return _skill_response_from_message(final_messages[0])
+
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """删除会话"""
+    if not await session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found or expired")
+    return {"status": "deleted", "session_id": session_id}
 
-                        elif event.type == "message_start":
-                            event_queue.put({"type": "message_start"})
-                        elif event.type == "message_stop":
-                            event_queue.put({
-                                "type": "message_stop",
-                                "total_steps": step_counter[0]
-                            })
-
-                # 获取最终响应
-                final_message = stream.get_final_message()
-                container_id = ""
-                if hasattr(final_message, "container") and final_message.container:
-                    container_id = final_message.container.id
-
-                # 从最终消息中再次提取file_ids（以防流式处理时遗漏）
-                for content in final_message.content:
-                    if hasattr(content, "type") and content.type == "bash_code_execution_tool_result":
-                        result_content = getattr(content, "content", None)
-                        if result_content and hasattr(result_content, "type"):
-                            if result_content.type == "bash_code_execution_result":
-                                for item in getattr(result_content, "content", []):
-                                    if hasattr(item, "file_id") and item.file_id:
-                                        if item.file_id not in collected_file_ids:
-                                            collected_file_ids.append(item.file_id)
-
-                # 发送完成事件
-                event_queue.put({
-                    "type": "done",
-                    "container_id": container_id,
-                    "stop_reason": final_message.stop_reason,
-                    "usage": {
-                        "input_tokens": final_message.usage.input_tokens,
-                        "output_tokens": final_message.usage.output_tokens
-                    },
-                    "file_ids": collected_file_ids if collected_file_ids else None
-                })
 
-        except anthropic.APIError as e:
-            event_queue.put({"type": "error", "error": f"Anthropic API Error: {str(e)}"})
-        except Exception as e:
-            event_queue.put({"type": "error", "error": f"Internal Server Error: {str(e)}"})
-        finally:
-            # 标记流结束
-            event_queue.put(None)
+# ============================================================================
+# 预生成：在低峰时段按配置提前生成热门请求的结果，高峰期直接命中结果缓存
+# ============================================================================
 
-    async def generate_stream():
-        """异步生成器，从队列读取事件并发送keepalive"""
-        # 启动Anthropic流式调用线程
-        stream_thread = threading.Thread(target=run_anthropic_stream, daemon=True)
-        stream_thread.start()
+PREGENERATE_ENABLED = os.environ.get("PREGENERATE_ENABLED", "false").lower() == "true"
+# 预生成的请求列表（JSON），格式见 README
+PREGENERATE_FILE = Path(os.environ.get("PREGENERATE_FILE", str(Path(__file__).parent / "pregenerate.json")))
+# 低峰时段（服务器本地时间，小时，左闭右开），如 22-6 表示 22:00 到次日 6:00
+PREGENERATE_HOURS = os.environ.get("PREGENERATE_HOURS", "1-6")
+PREGENERATE_CONCURRENCY = int(os.environ.get("PREGENERATE_CONCURRENCY", "1"))
+PREGENERATE_CHECK_INTERVAL = float(os.environ.get("PREGENERATE_CHECK_INTERVAL", "300"))
+# 缓存结果早于该时间（秒）时重新生成；预生成结果的 TTL 需覆盖到下一个低峰时段
+PREGENERATE_MAX_AGE = int(os.environ.get("PREGENERATE_MAX_AGE", "72000"))
+PREGENERATE_TTL = int(os.environ.get("PREGENERATE_TTL", "129600"))
+# 生成的文件不超过该大小时一并缓存，下载时不再请求上游
+PREGENERATE_FILE_MAX_BYTES = int(os.environ.get("PREGENERATE_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+# 多 worker 时每项生成持有的 Redis 锁的有效期（秒）：生成期间每 1/3 有效期续期一次，
+# worker 异常退出后锁很快过期，其他 worker 可以接手
+PREGENERATE_LOCK_TTL = 60.0
+
+
+def _file_cache_key(file_id: str) -> str:
+    return _cache_key("file", file_id=file_id)
+
+
+async def _get_cached_file(file_id: str) -> Optional[Dict[str, Any]]:
+    if not RESULT_CACHE_ENABLED:
+        return None
+    return await result_cache.get(_file_cache_key(file_id))
+
+
+async def _cache_file(file_id: str, ttl: int) -> bool:
+    """下载生成的文件并写入结果缓存，文件过大时跳过"""
+    file_metadata, file_content = await asyncio.gather(
+        _upstream_call(
+            "files",
+            lambda: client.beta.files.retrieve_metadata(file_id=file_id, betas=["files-api-2025-04-14"]),
+            idempotent=True,
+        ),
+        _upstream_call(
+            "files",
+            lambda: client.beta.files.download(file_id=file_id, betas=["files-api-2025-04-14"]),
+            idempotent=True,
+        ),
+    )
+    content_bytes = await file_content.read()
+    if len(content_bytes) > PREGENERATE_FILE_MAX_BYTES:
+        return False
+    created_at = getattr(file_metadata, "created_at", None)
+    await result_cache.set(
+        _file_cache_key(file_id),
+        {
+            "filename": file_metadata.filename,
+            "size_bytes": file_metadata.size_bytes,
+            "created_at": created_at.isoformat() if created_at else None,
+            "mime_type": getattr(file_metadata, "mime_type", None),
+            "content": base64.b64encode(content_bytes).decode("ascii"),
+        },
+        ttl,
+    )
+    return True
+
+
+class PregenerationScheduler:
+    """
+    低峰时段预生成调度（每个 worker 独立运行）
+
+    PREGENERATE_FILE 中的每一项都是一个 SkillRequest；带 locations 列表时，
+    message 中的 {location} 依次替换为每个地点，展开为多项。
+    低峰时段内每隔 PREGENERATE_CHECK_INTERVAL 秒检查一次，缓存中没有结果或
+    结果早于 PREGENERATE_MAX_AGE 的项按 PREGENERATE_CONCURRENCY 依次重新生成，
+    结果和生成的文件以 PREGENERATE_TTL 写入结果缓存（以及近似缓存）。
+    设置了 SKILLS_REDIS_URL 时用 Redis 锁避免多个 worker 重复生成同一项。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: List[SkillRequest] = []
+        self._task: Optional[asyncio.Task] = None
+        self.last_run_at: Optional[float] = None
+        self.stats: Dict[str, int] = {"runs": 0, "generated": 0, "fresh": 0, "failed": 0, "files_cached": 0}
 
-        KEEPALIVE_INTERVAL = 15  # 每15秒发送一次keepalive
-        last_event_time = time.time()
+    def _load(self) -> List[SkillRequest]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                raw_entries = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Invalid PREGENERATE_FILE {self.path}: {e}") from e
+
+        entries = []
+        for raw in raw_entries:
+            raw = dict(raw)
+            locations = raw.pop("locations", None)
+            messages = [raw["message"].format(location=loc) for loc in locations] if locations else [raw["message"]]
+            for message in messages:
+                skill_request = SkillRequest(**{**raw, "message": message})
+                try:
+                    _build_skills_config(skill_request.skill_ids)
+                except HTTPException as e:
+                    raise ValueError(f"Invalid PREGENERATE_FILE entry: {e.detail}") from e
+                entries.append(skill_request)
+        return entries
+
+    def start(self) -> None:
+        if not RESULT_CACHE_ENABLED:
+            raise ValueError("PREGENERATE_ENABLED requires RESULT_CACHE_ENABLED=true")
+        self.entries = self._load()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait({self._task})
+            self._task = None
+
+    @staticmethod
+    def in_window(hour: Optional[int] = None) -> bool:
+        start, _, end = PREGENERATE_HOURS.partition("-")
+        start, end = int(start), int(end)
+        hour = time.localtime().tm_hour if hour is None else hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    async def _generate(self, skill_request: SkillRequest) -> None:
+        # 低峰时段已结束时剩余的项留到下一个时段
+        cache_key = _skill_cache_key(None, skill_request)
+        if cache_key is None or not self.in_window():
+            return
+
+        lock_key = None
+        lock_refresher = None
+        if SKILLS_REDIS_URL:
+            lock_key = f"skills:pregenerate:lock:{cache_key.rsplit(':', 1)[-1]}"
+            if not await get_redis().set(lock_key, "1", nx=True, px=int(PREGENERATE_LOCK_TTL * 1000)):
+                return
+            # 一次生成包括自动继续和重试，可能远超锁的有效期：生成期间定期续期
+            lock_refresher = asyncio.create_task(self._refresh_lock(lock_key))
+        try:
+            cached = await result_cache.get(cache_key)
+            if cached is not None and time.time() - cached["cached_at"] < PREGENERATE_MAX_AGE:
+                self.stats["fresh"] += 1
+                return
+
+            try:
+                skill_response = await _invoke_upstream(
+                    skill_request, _build_skills_config(skill_request.skill_ids), None
+                )
+            except HTTPException as e:
+                self.stats["failed"] += 1
+                logger.warning("pregeneration failed: %s", e.detail)
+                return
+            if skill_response.stop_reason not in CACHEABLE_STOP_REASONS:
+                self.stats["failed"] += 1
+                return
+
+            value = {"response": skill_response.model_dump()}
+            await result_cache.set(cache_key, value, PREGENERATE_TTL)
+            similarity_scope = _similarity_scope(None, skill_request)
+            if similarity_scope:
+                await similarity_cache.set(similarity_scope, skill_request.message, value, PREGENERATE_TTL)
+            self.stats["generated"] += 1
+
+            for file_id in skill_response.file_ids:
+                try:
+                    if await _cache_file(file_id, PREGENERATE_TTL):
+                        self.stats["files_cached"] += 1
+                except Exception:
+                    logger.exception("failed to cache pregenerated file %s", file_id)
+        finally:
+            if lock_refresher is not None:
+                lock_refresher.cancel()
+            if lock_key:
+                await get_redis().delete(lock_key)
 
+    @staticmethod
+    async def _refresh_lock(lock_key: str) -> None:
         while True:
+            await asyncio.sleep(PREGENERATE_LOCK_TTL / 3)
             try:
-                # 非阻塞方式检查队列，超时1秒
+                await get_redis().pexpire(lock_key, int(PREGENERATE_LOCK_TTL * 1000))
+            except Exception:
+                logger.exception("failed to refresh pregeneration lock %s", lock_key)
+
+    async def _run(self) -> None:
+        semaphore = asyncio.Semaphore(PREGENERATE_CONCURRENCY)
+
+        async def generate(skill_request: SkillRequest):
+            async with semaphore:
                 try:
-                    event = event_queue.get(timeout=1.0)
-                except queue.Empty:
-                    event = None
+                    await self._generate(skill_request)
+                except Exception:
+                    self.stats["failed"] += 1
+                    logger.exception("pregeneration failed")
 
-                current_time = time.time()
+        while True:
+            if self.in_window():
+                self.stats["runs"] += 1
+                self.last_run_at = time.time()
+                await asyncio.gather(*(generate(entry) for entry in self.entries))
+            await asyncio.sleep(PREGENERATE_CHECK_INTERVAL)
 
-                if event is None and not stream_thread.is_alive():
-                    # 线程结束且队列为空，退出
-                    break
-                elif event is None:
-                    # 队列暂时为空，检查是否需要发送keepalive
-                    if current_time - last_event_time >= KEEPALIVE_INTERVAL:
-                        # 发送SSE keepalive注释（以:开头的行被SSE客户端忽略但保持连接）
-                        yield f": keepalive {int(current_time)}\n\n"
-                        last_event_time = current_time
-                else:
-                    # 有实际事件，发送它
-                    yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
-                    last_event_time = current_time
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": PREGENERATE_ENABLED,
+            "entries": len(self.entries),
+            "in_window": self.in_window(),
+            "last_run_at": self.last_run_at,
+        }
 
-                    # 如果是结束事件，退出循环
-                    if event.get("type") in ("done", "error"):
-                        break
 
-            except Exception as e:
-                yield f"data: {json.dumps({'type': 'error', 'error': f'Stream error: {str(e)}'}, ensure_ascii=False)}\n\n"
-                break
+pregeneration_scheduler = PregenerationScheduler(PREGENERATE_FILE)
 
-    return StreamingResponse(
-        generate_stream(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
+
+# ============================================================================
+# Files API 请求对冲 (hedging)：文件元数据和文件列表请求超过最近的 p95 延迟仍未返回时，
+# 再发一个相同的请求，使用先返回的结果
+# ============================================================================
+
+FILES_HEDGE_ENABLED = os.environ.get("FILES_HEDGE_ENABLED", "false").lower() == "true"
+# 观测样本不足时使用的对冲延迟（秒），以及对冲延迟的下限
+FILES_HEDGE_DEFAULT_DELAY = float(os.environ.get("FILES_HEDGE_DEFAULT_DELAY", "0.5"))
+FILES_HEDGE_MIN_DELAY = float(os.environ.get("FILES_HEDGE_MIN_DELAY", "0.05"))
+# 对冲请求最多占原始请求的比例，以及可以累积的对冲次数
+FILES_HEDGE_BUDGET = float(os.environ.get("FILES_HEDGE_BUDGET", "0.1"))
+FILES_HEDGE_BURST = float(os.environ.get("FILES_HEDGE_BURST", "10"))
+FILES_HEDGE_WINDOW = 200  # 用最近多少次调用的延迟计算 p95
+FILES_HEDGE_MIN_SAMPLES = 20
+
+
+class RequestHedger:
+    """
+    对冲只读请求：请求超过最近延迟的 p95 仍未返回时发出一个相同的请求，
+    使用先成功的结果并取消另一个。
+
+    对冲预算是一个令牌桶：每个原始请求加 FILES_HEDGE_BUDGET，每次对冲消耗 1，
+    对冲请求数因此不超过原始请求的这个比例；Files API 熔断器不在 closed 状态时
+    （上游故障期间）不对冲，避免放大负载。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._latencies: deque = deque(maxlen=FILES_HEDGE_WINDOW)
+        self._budget = FILES_HEDGE_BURST
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "skipped": 0}
+
+    def delay(self) -> float:
+        if len(self._latencies) < FILES_HEDGE_MIN_SAMPLES:
+            return FILES_HEDGE_DEFAULT_DELAY
+        latencies = sorted(self._latencies)
+        return max(FILES_HEDGE_MIN_DELAY, latencies[math.ceil(len(latencies) * 0.95) - 1])
+
+    async def _timed(self, call: Callable[[], Any]):
+        # 只对主请求采样；主请求被取消时记录已等待的时间（真实延迟的下界），
+        # 否则输掉对冲的慢请求永远不会进入样本，p95 会越来越低、对冲越来越频繁
+        started = time.monotonic()
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            self._latencies.append(time.monotonic() - started)
+            raise
+        self._latencies.append(time.monotonic() - started)
+        return result
+
+    def _start(self, call: Callable[[], Any], primary: bool = False) -> asyncio.Task:
+        task = asyncio.create_task(self._timed(call) if primary else call())
+        # 被取消的一方稍后失败时，避免 "exception was never retrieved" 警告
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def call(self, call: Callable[[], Any]):
+        self.stats["requests"] += 1
+        if not FILES_HEDGE_ENABLED:
+            return await call()
+        self._budget = min(FILES_HEDGE_BURST, self._budget + FILES_HEDGE_BUDGET)
+
+        primary = self._start(call, primary=True)
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.delay())
+            if not done:
+                if self._budget >= 1 and circuit_breakers["files"].state == "closed":
+                    self._budget -= 1
+                    self.stats["hedged"] += 1
+                    tasks.append(self._start(call))
+                else:
+                    self.stats["skipped"] += 1
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                        return task.result()
+            # 都失败时返回主请求的错误
+            return primary.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": FILES_HEDGE_ENABLED,
+            "delay": round(self.delay(), 3),
+            "budget": round(self._budget, 2),
         }
-    )
+
+
+file_hedgers = {"metadata": RequestHedger("metadata"), "list": RequestHedger("list")}
 
 
 @app.get("/files/{file_id}/metadata")
@@ -686,9 +4392,26 @@ async def get_file_metadata(request: Request, file_id: str):
     Rate Limit: 10 requests per second
     """
     try:
-        file_metadata = client.beta.files.retrieve_metadata(
-            file_id=file_id,
-            betas=["files-api-2025-04-14"]
+        cached_file = await _get_cached_file(file_id)
+        if cached_file is not None:
+            return {
+                "status": "success",
+                "file_id": file_id,
+                "filename": cached_file["filename"],
+                "size_bytes": cached_file["size_bytes"],
+                "created_at": cached_file["created_at"],
+                "mime_type": cached_file["mime_type"],
+            }
+
+        file_metadata = await file_hedgers["metadata"].call(
+            lambda: _upstream_call(
+                "files",
+                lambda: client.beta.files.retrieve_metadata(
+                    file_id=file_id,
+                    betas=["files-api-2025-04-14"]
+                ),
+                idempotent=True,
+            )
         )
         return {
             "status": "success",
@@ -700,6 +4423,9 @@ async def get_file_metadata(request: Request, file_id: str):
         }
     except anthropic.APIError as e:
         raise HTTPException(status_code=500, detail=f"Anthropic API Error: {str(e)}")
+    except HTTPException:
+        # 上游熔断
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
@@ -714,23 +4440,37 @@ async def download_file(request: Request, file_id: str):
     返回文件的原始内容
     """
     try:
-        # 先获取元数据以获取文件名
-        file_metadata = client.beta.files.retrieve_metadata(
-            file_id=file_id,
-            betas=["files-api-2025-04-14"]
-        )
-
-        # 下载文件内容
-        file_content = client.beta.files.download(
-            file_id=file_id,
-            betas=["files-api-2025-04-14"]
-        )
-
-        # 读取文件内容
-        content_bytes = file_content.read()
+        cached_file = await _get_cached_file(file_id)
+        if cached_file is not None:
+            # 预生成时已缓存的文件，不再请求上游
+            filename = cached_file["filename"]
+            content_bytes = base64.b64decode(cached_file["content"])
+        else:
+            # 并发获取元数据（文件名）和文件内容
+            file_metadata, file_content = await asyncio.gather(
+                _upstream_call(
+                    "files",
+                    lambda: client.beta.files.retrieve_metadata(
+                        file_id=file_id,
+                        betas=["files-api-2025-04-14"]
+                    ),
+                    idempotent=True,
+                ),
+                _upstream_call(
+                    "files",
+                    lambda: client.beta.files.download(
+                        file_id=file_id,
+                        betas=["files-api-2025-04-14"]
+                    ),
+                    idempotent=True,
+                ),
+            )
+
+            # 读取文件内容
+            content_bytes = await file_content.read()
+            filename = file_metadata.filename
 
         # 根据文件扩展名确定 MIME 类型
-        filename = file_metadata.filename
         mime_type = "application/octet-stream"  # 默认
         if filename.endswith(".md"):
             mime_type = "text/markdown"
@@ -747,7 +4487,6 @@ async def download_file(request: Request, file_id: str):
         elif filename.endswith(".pptx"):
             mime_type = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
 
-        from fastapi.responses import Response
         from urllib.parse import quote
 
         # URL encode the filename for the Content-Disposition header
@@ -763,6 +4502,9 @@ async def download_file(request: Request, file_id: str):
         )
     except anthropic.APIError as e:
         raise HTTPException(status_code=500, detail=f"Anthropic API Error: {str(e)}")
+    except HTTPException:
+        # 上游熔断
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
@@ -776,7 +4518,11 @@ async def list_files(request: Request):
     Rate Limit: 5 requests per second
     """
     try:
-        files = client.beta.files.list(betas=["files-api-2025-04-14"])
+        files = await file_hedgers["list"].call(
+            lambda: _upstream_call(
+                "files", lambda: client.beta.files.list(betas=["files-api-2025-04-14"]), idempotent=True
+            )
+        )
         return {
             "status": "success",
             "files": [
@@ -791,6 +4537,9 @@ async def list_files(request: Request):
         }
     except anthropic.APIError as e:
         raise HTTPException(status_code=500, detail=f"Anthropic API Error: {str(e)}")
+    except HTTPException:
+        # 上游熔断
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
@@ -801,6 +4550,39 @@ async def health_check():
     return {"status": "healthy", "api_key_configured": bool(api_key)}
 
 
+@app.get("/metrics")
+async def metrics():
+    """运行指标"""
+    return {
+        "usage": USAGE_TOTALS,
+        "streams": _stream_metrics(),
+        "coalescing": _coalesce_metrics(),
+        "rate_limit": limiter.metrics(),
+        "upstream_budget": upstream_budget.metrics(),
+        "admission": admission.metrics(),
+        "file_hedging": {name: hedger.metrics() for name, hedger in file_hedgers.items()},
+        "circuit_breakers": {name: breaker.metrics() for name, breaker in circuit_breakers.items()},
+        "load_shedding": {**SHED_STATS, "default_deadline": REQUEST_DEADLINE_DEFAULT or None},
+        "bulkheads": {name: bulkhead.metrics() for name, bulkhead in bulkheads.items()} if BULKHEADS_ENABLED else {},
+        "container_pool": container_pool.metrics(),
+        "pregeneration": pregeneration_scheduler.metrics(),
+        "history_compaction": COMPACTION_STATS,
+        "idempotency": _idempotency_metrics(),
+        "result_cache": {
+            **result_cache.stats,
+            "enabled": RESULT_CACHE_ENABLED,
+            "entries": len(result_cache._entries),
+        },
+        "similarity_cache": {
+            **similarity_cache.stats,
+            "enabled": SIMILARITY_CACHE_ENABLED,
+            "threshold": SIMILARITY_CACHE_THRESHOLD,
+            "skills": sorted(SIMILARITY_CACHE_SKILLS),
+            "entries": len(similarity_cache._entries),
+        },
+    }
+
+
 # ============================================================================
 # OpenAI 兼容的代理端点 (替代 LiteLLM)
 # ============================================================================
@@ -829,18 +4611,21 @@ MODEL_MAPPING = {
 
 @app.post("/v1/chat/completions")
 @limiter.limit("5/second")
-async def openai_chat_completions(request: Request, chat_request: OpenAIChatRequest):
+async def openai_chat_completions(request: Request, response: Response, chat_request: OpenAIChatRequest):
     """
     OpenAI 兼容的 chat/completions 端点
     支持 Anthropic Skills 和 code_execution
 
     自动发送 keepalive 心跳，避免 Cloudflare 超时
+    启用结果缓存时，响应头 X-Cache 为 HIT / MISS，命中的流式请求以相同的 SSE 格式回放
+    历史超出 token 预算时压缩较早的轮次，响应头 X-History-Tokens-Saved 给出节省的估算 token 数
     """
     # 模型映射
     model = MODEL_MAPPING.get(chat_request.model, chat_request.model)
 
-    # 转换消息格式
-    messages = [{"role": m.role, "content": m.content} for m in chat_request.messages]
+    # 转换消息格式（system 消息转为 Anthropic 的 system 参数）
+    system = [{"type": "text", "text": m.content} for m in chat_request.messages if m.role == "system"]
+    messages = [{"role": m.role, "content": m.content} for m in chat_request.messages if m.role != "system"]
 
     # 构建容器配置
     container = chat_request.container
@@ -859,31 +4644,141 @@ async def openai_chat_completions(request: Request, chat_request: OpenAIChatRequ
                 betas = ["code-execution-2025-08-25"]
                 break
 
+    skill_ids = [skill["skill_id"] for skill in (container or {}).get("skills", [])]
+    cache_key = _chat_cache_key(
+        request, model, system + messages, chat_request.max_tokens, container, tools_config
+    )
+    cache_ttl = 0
+    cache_headers = {}
+    if cache_key:
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            cache_headers["X-Cache"] = "HIT"
+            if chat_request.stream:
+                chunks = _replay_events(_chat_chunks_from_completion(cached["completion"]))
+                return _chat_sse_response(request, chunks, cache_headers)
+            return JSONResponse(cached["completion"], headers=cache_headers)
+
+        cache_headers["X-Cache"] = "MISS"
+        cache_ttl = _skill_cache_ttl(skill_ids) if skill_ids else RESULT_CACHE_TTL
+
+    # 长对话超出 token 预算时压缩较早的历史
+    messages, tokens_saved = _compact_history(messages)
+    if tokens_saved:
+        cache_headers["X-History-Tokens-Saved"] = str(tokens_saved)
+
+    # 与 Skills 调用共用隔离舱、准入队列和截止时间检查
+    slot = SkillSlot(skill_ids, chat_request.max_tokens)
+    slot.check_admission()
+
     if chat_request.stream:
-        return await _stream_chat_completion(model, messages, chat_request.max_tokens, container, tools_config, betas)
+        chunks = _iter_chat_stream_chunks(
+            slot, model, system, messages, chat_request.max_tokens, container, tools_config, betas
+        )
+        if cache_key:
+            chunks = _caching_chat_chunks(chunks, model, cache_key, cache_ttl)
+        return _chat_sse_response(request, chunks, cache_headers)
     else:
-        return await _non_stream_chat_completion(model, messages, chat_request.max_tokens, container, tools_config, betas)
+        completion = await _non_stream_chat_completion(
+            slot, model, system, messages, chat_request.max_tokens, container, tools_config, betas
+        )
+        response.headers.update(cache_headers)
+        if cache_key:
+            if completion["choices"][0]["finish_reason"] in CACHEABLE_STOP_REASONS:
+                await result_cache.set(cache_key, {"completion": completion}, cache_ttl)
+        return completion
+
+
+def _chat_cache_key(request: Request, model, messages, max_tokens, container, tools_config) -> Optional[str]:
+    """chat/completions 的缓存 key；复用已有容器（多轮对话）时不缓存"""
+    if not RESULT_CACHE_ENABLED or (container and container.get("id")):
+        return None
+    if "no-" in request.headers.get("cache-control", ""):
+        return None
+    return _cache_key(
+        "chat",
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        container=container,
+        tools=tools_config,
+    )
+
+
+def _chat_chunks_from_completion(completion: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """由缓存的非流式结果合成流式 chunk"""
+    choice = completion["choices"][0]
+    base = {
+        "id": completion["id"],
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": completion["model"],
+    }
+    return [
+        {**base, "choices": [{"index": 0, "delta": {"content": choice["message"]["content"]}, "finish_reason": None}]},
+        {
+            **base,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": choice["finish_reason"]}],
+            "usage": completion["usage"],
+            "provider_specific_fields": completion["provider_specific_fields"],
+        },
+    ]
+
+
+async def _caching_chat_chunks(chunks, model, cache_key: str, ttl: int):
+    """转发流式 chunk，成功结束后把拼接出的完整结果写入缓存"""
+    content = ""
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            yield chunk
+            if "error" in chunk:
+                return
+            choice = chunk["choices"][0]
+            content += choice["delta"].get("content", "")
+            if choice["finish_reason"] in CACHEABLE_STOP_REASONS:
+                await result_cache.set(cache_key, {"completion": {
+                    "id": chunk["id"],
+                    "object": "chat.completion",
+                    "created": chunk["created"],
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": choice["finish_reason"],
+                    }],
+                    "usage": chunk["usage"],
+                    "provider_specific_fields": chunk["provider_specific_fields"],
+                }}, ttl)
 
 
-async def _non_stream_chat_completion(model, messages, max_tokens, container, tools_config, betas):
+async def _non_stream_chat_completion(
+    slot: SkillSlot, model, system, messages, max_tokens, container, tools_config, betas
+):
     """非流式响应"""
     try:
+        await slot.wait()
         kwargs = {
             "model": model,
             "max_tokens": max_tokens,
             "messages": messages,
         }
+        if system:
+            kwargs["system"] = system
         if betas:
             kwargs["betas"] = betas
         if container:
             kwargs["container"] = container
         if tools_config:
             kwargs["tools"] = tools_config
+        kwargs = _with_prompt_cache(kwargs)
+        await slot.before_call(kwargs)
 
         if betas:
-            response = client.beta.messages.create(**kwargs)
+            response = await _upstream_call("messages", lambda: client.beta.messages.create(**kwargs))
         else:
-            response = client.messages.create(**kwargs)
+            response = await _upstream_call("messages", lambda: client.messages.create(**kwargs))
+
+        _record_usage("/v1/chat/completions", _usage_dict(response.usage), "completed")
 
         # 转换为 OpenAI 格式
         content = ""
@@ -904,145 +4799,147 @@ async def _non_stream_chat_completion(model, messages, max_tokens, container, to
                 },
                 "finish_reason": response.stop_reason
             }],
-            "usage": {
-                "prompt_tokens": response.usage.input_tokens,
-                "completion_tokens": response.usage.output_tokens,
-                "total_tokens": response.usage.input_tokens + response.usage.output_tokens
-            },
+            "usage": _openai_usage(response.usage),
             "provider_specific_fields": {
                 "container": {"id": response.container.id} if hasattr(response, "container") and response.container else None
             }
         }
     except anthropic.APIError as e:
+        _record_usage("/v1/chat/completions", None, "failed")
         raise HTTPException(status_code=500, detail=f"Anthropic API Error: {str(e)}")
+    finally:
+        slot.release()
 
 
-async def _stream_chat_completion(model, messages, max_tokens, container, tools_config, betas):
-    """流式响应，带 keepalive 心跳"""
-
-    event_queue = queue.Queue()
+async def _iter_chat_stream_chunks(
+    slot: SkillSlot, model, system, messages, max_tokens, container, tools_config, betas
+):
+    """驱动 Anthropic 流式调用，产出 OpenAI 格式的 chunk"""
+    stream = None
+    outcome = "cancelled"
+    try:
+        await slot.wait()
+        kwargs = {
+            "model": model,
+            "max_tokens": max_tokens,
+            "messages": messages,
+        }
+        if system:
+            kwargs["system"] = system
+        if betas:
+            kwargs["betas"] = betas
+        if container:
+            kwargs["container"] = container
+        if tools_config:
+            kwargs["tools"] = tools_config
+        kwargs = _with_prompt_cache(kwargs)
+        await slot.before_call(kwargs)
 
-    def run_stream():
-        try:
-            kwargs = {
+        if betas:
+            stream_context = _upstream_stream(lambda: client.beta.messages.stream(**kwargs))
+        else:
+            stream_context = _upstream_stream(lambda: client.messages.stream(**kwargs))
+
+        async with stream_context as stream:
+            async for event in stream:
+                if hasattr(event, "type"):
+                    if event.type == "content_block_delta":
+                        if hasattr(event.delta, "text"):
+                            # 转换为 OpenAI 格式的 delta
+                            yield {
+                                "id": "chatcmpl-stream",
+                                "object": "chat.completion.chunk",
+                                "created": int(time.time()),
+                                "model": model,
+                                "choices": [{
+                                    "index": 0,
+                                    "delta": {"content": event.delta.text},
+                                    "finish_reason": None
+                                }]
+                            }
+                    elif event.type == "message_stop":
+                        pass  # 等待获取 final message
+
+            # 获取最终响应
+            final_message = await stream.get_final_message()
+            container_id = ""
+            if hasattr(final_message, "container") and final_message.container:
+                container_id = final_message.container.id
+            outcome = "completed"
+
+            # 发送最终 chunk
+            yield {
+                "id": "chatcmpl-stream",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
                 "model": model,
-                "max_tokens": max_tokens,
-                "messages": messages,
+                "choices": [{
+                    "index": 0,
+                    "delta": {},
+                    "finish_reason": final_message.stop_reason
+                }],
+                "usage": _openai_usage(final_message.usage),
+                "provider_specific_fields": {
+                    "container": {"id": container_id} if container_id else None
+                }
             }
-            if betas:
-                kwargs["betas"] = betas
-            if container:
-                kwargs["container"] = container
-            if tools_config:
-                kwargs["tools"] = tools_config
-
-            if betas:
-                stream_context = client.beta.messages.stream(**kwargs)
-            else:
-                stream_context = client.messages.stream(**kwargs)
 
-            with stream_context as stream:
-                for event in stream:
-                    if hasattr(event, "type"):
-                        if event.type == "content_block_delta":
-                            if hasattr(event.delta, "text"):
-                                # 转换为 OpenAI 格式的 delta
-                                openai_chunk = {
-                                    "id": "chatcmpl-stream",
-                                    "object": "chat.completion.chunk",
-                                    "created": int(time.time()),
-                                    "model": model,
-                                    "choices": [{
-                                        "index": 0,
-                                        "delta": {"content": event.delta.text},
-                                        "finish_reason": None
-                                    }]
-                                }
-                                event_queue.put(openai_chunk)
-                        elif event.type == "message_stop":
-                            pass  # 等待获取 final message
-
-                # 获取最终响应
-                final_message = stream.get_final_message()
-                container_id = ""
-                if hasattr(final_message, "container") and final_message.container:
-                    container_id = final_message.container.id
-
-                # 发送最终 chunk
-                final_chunk = {
-                    "id": "chatcmpl-stream",
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": model,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": final_message.stop_reason
-                    }],
-                    "usage": {
-                        "prompt_tokens": final_message.usage.input_tokens,
-                        "completion_tokens": final_message.usage.output_tokens,
-                        "total_tokens": final_message.usage.input_tokens + final_message.usage.output_tokens
-                    },
-                    "provider_specific_fields": {
-                        "container": {"id": container_id} if container_id else None
-                    }
-                }
-                event_queue.put(final_chunk)
-                event_queue.put("DONE")
+    except HTTPException as e:
+        # 隔离舱 / 准入队列已满、排队超时或超过请求的截止时间
+        outcome = "failed"
+        yield {"error": e.detail, "status_code": e.status_code}
+    except Exception as e:
+        outcome = "failed"
+        yield {"error": str(e)}
+    finally:
+        slot.release()
+        _record_usage(
+            "/v1/chat/completions", _partial_usage(stream) if stream is not None else None, outcome
+        )
 
-        except Exception as e:
-            event_queue.put({"error": str(e)})
-            event_queue.put("DONE")
-        finally:
-            event_queue.put(None)
 
-    async def generate():
-        stream_thread = threading.Thread(target=run_stream, daemon=True)
-        stream_thread.start()
+def _openai_usage(usage) -> Dict[str, Any]:
+    """
+    转换为 OpenAI 格式的 usage
 
-        KEEPALIVE_INTERVAL = 15
-        last_event_time = time.time()
+    与 LiteLLM 一致：prompt_tokens 包含写入和命中提示词缓存的 token，
+    命中部分同时在 prompt_tokens_details.cached_tokens 中给出。
+    """
+    usage = _usage_dict(usage)
+    prompt_tokens = (
+        usage["input_tokens"] + usage["cache_creation_input_tokens"] + usage["cache_read_input_tokens"]
+    )
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": usage["output_tokens"],
+        "total_tokens": prompt_tokens + usage["output_tokens"],
+        "prompt_tokens_details": {"cached_tokens": usage["cache_read_input_tokens"]},
+        "cache_creation_input_tokens": usage["cache_creation_input_tokens"],
+        "cache_read_input_tokens": usage["cache_read_input_tokens"],
+    }
 
-        while True:
-            try:
-                try:
-                    event = event_queue.get(timeout=1.0)
-                except queue.Empty:
-                    event = None
 
-                current_time = time.time()
+def _chat_sse_response(request: Request, chunks, headers: Optional[Dict[str, str]] = None):
+    """流式响应，带 keepalive 心跳"""
 
-                if event is None and not stream_thread.is_alive():
-                    break
-                elif event is None:
-                    if current_time - last_event_time >= KEEPALIVE_INTERVAL:
-                        # 发送 SSE keepalive 注释
-                        yield f": keepalive {int(current_time)}\n\n"
-                        last_event_time = current_time
-                elif event == "DONE":
-                    yield "data: [DONE]\n\n"
-                    break
-                elif isinstance(event, dict):
-                    if "error" in event:
-                        yield f"data: {json.dumps({'error': event['error']})}\n\n"
-                        break
-                    else:
-                        yield f"data: {json.dumps(event)}\n\n"
-                        last_event_time = current_time
-
-            except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                break
+    async def generate():
+        async with aclosing(_with_keepalive(chunks, request)) as events:
+            async for event in events:
+                if event is None:
+                    # 发送 SSE keepalive 注释
+                    yield f": keepalive {int(time.time())}\n\n"
+                elif "error" in event:
+                    yield f"data: {json.dumps({'error': event['error']})}\n\n"
+                    return
+                else:
+                    yield f"data: {json.dumps(event)}\n\n"
+
+        yield "data: [DONE]\n\n"
 
     return StreamingResponse(
         generate(),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        }
+        headers={**SSE_HEADERS, **(headers or {})},
     )
 
 
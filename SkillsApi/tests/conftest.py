@@ -0,0 +1,14 @@
+"""
+SkillsApi 测试公共配置
+
+skills_api 在导入时读取环境变量并创建 Anthropic 客户端，这里在导入之前设置好测试用的配置；
+上游调用通过 httpx.MockTransport 或替换 client 的方法模拟，不会访问网络。
+"""
+import os
+import sys
+from pathlib import Path
+
+os.environ.setdefault("ANTHROPIC_API_KEY", "test-key")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,97 @@
+"""准入调度：加权公平队列的放行顺序"""
+import asyncio
+
+import skills_api
+from skills_api import AdmissionScheduler
+
+
+def _drain(scheduler, tickets):
+    """依次释放已放行的请求，返回放行顺序（租户名）"""
+    order = []
+    pending = list(tickets)
+    while pending:
+        admitted = [t for t in pending if t.admitted_at is not None]
+        assert len(admitted) == 1
+        ticket = admitted[0]
+        order.append(ticket.tenant)
+        pending.remove(ticket)
+        scheduler.release(ticket)
+    return order
+
+
+def test_backlogged_tenant_does_not_starve_others():
+    async def run():
+        scheduler = AdmissionScheduler(capacity=1, max_queue=100)
+        tickets = [scheduler.enqueue("A", 1.0) for _ in range(5)]
+        late = scheduler.enqueue("B", 1.0)
+        # B 排在 A 积压的请求之间，而不是最后
+        assert late.position == 2
+        return _drain(scheduler, [*tickets, late])
+
+    order = asyncio.run(run())
+    assert order.index("B") < 5
+    assert order == ["A", "A", "B", "A", "A", "A"]
+
+
+def test_expensive_request_of_other_tenant_is_not_starved():
+    async def run():
+        scheduler = AdmissionScheduler(capacity=1, max_queue=100)
+        tickets = [scheduler.enqueue("A", 1.0) for _ in range(10)]
+        heavy = scheduler.enqueue("B", 4.0)
+        return _drain(scheduler, [*tickets, heavy])
+
+    order = asyncio.run(run())
+    # A 的积压还没处理完时 B 就被放行
+    assert order.index("B") < 10
+
+
+def test_tenant_weight_gives_larger_share(monkeypatch):
+    monkeypatch.setitem(skills_api.ADMISSION_TENANT_WEIGHTS, "key:gold", 3.0)
+
+    async def run():
+        scheduler = AdmissionScheduler(capacity=1, max_queue=100)
+        first = scheduler.enqueue("other", 1.0)
+        tickets = [first]
+        for _ in range(6):
+            tickets.append(scheduler.enqueue("key:gold", 1.0))
+            tickets.append(scheduler.enqueue("other", 1.0))
+        return _drain(scheduler, tickets)
+
+    order = asyncio.run(run())
+    assert order[:8].count("key:gold") >= 5
+
+
+def test_queue_full_is_rejected_with_503():
+    async def run():
+        scheduler = AdmissionScheduler(capacity=1, max_queue=1)
+        scheduler.enqueue("A", 1.0)
+        scheduler.enqueue("A", 1.0)
+        try:
+            scheduler.enqueue("B", 1.0)
+        except skills_api.HTTPException as e:
+            return e.status_code
+
+    assert asyncio.run(run()) == 503
+
+
+def test_global_queue_deadline_timeout(monkeypatch):
+    """在全局准入队列中等待超时：返回 504，全局调度器同样统计 timed_out"""
+    monkeypatch.setattr(skills_api, "admission", AdmissionScheduler(capacity=1, max_queue=10))
+    request = skills_api.SkillRequest(skill_ids=["pdf"], message="hi")
+
+    async def run():
+        holder = skills_api.SkillSlot(request.skill_ids, request.max_tokens)
+        await holder.wait()
+        skills_api._request_deadline.set(skills_api.time.monotonic() + 0.05)
+        slot = skills_api.SkillSlot(request.skill_ids, request.max_tokens)
+        try:
+            await slot.wait()
+        except skills_api.HTTPException as e:
+            return e.status_code, skills_api.admission.stats["timed_out"]
+        finally:
+            slot.release()
+            holder.release()
+
+    status_code, timed_out = asyncio.run(run())
+    assert status_code == 504
+    assert timed_out == 1
@@ -0,0 +1,177 @@
+"""批量调用：在线 NDJSON 与离线 Message Batches API"""
+import asyncio
+import json
+
+import anthropic
+import httpx
+import pytest
+
+import skills_api
+
+BATCH_ID = "msgbatch_test"
+
+
+def _message(text):
+    return {
+        "id": "msg_test", "type": "message", "role": "assistant", "model": skills_api.SKILL_MODEL,
+        "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+        "usage": {"input_tokens": 10, "output_tokens": 20},
+        "container": {"id": "container_test", "expires_at": "2099-01-01T00:00:00Z"},
+    }
+
+
+def _user_text(message):
+    """提示词缓存会把 content 改写为内容块列表"""
+    content = message["content"]
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+def _batch(processing_status):
+    return {
+        "id": BATCH_ID, "type": "message_batch", "processing_status": processing_status,
+        "request_counts": {"processing": 0, "succeeded": 2, "errored": 0, "canceled": 0, "expired": 0},
+        "created_at": "2025-01-01T00:00:00Z", "expires_at": "2099-01-01T00:00:00Z",
+        "ended_at": "2025-01-01T01:00:00Z" if processing_status == "ended" else None,
+        "archived_at": None, "cancel_initiated_at": None,
+        "results_url": f"https://api.anthropic.com/v1/messages/batches/{BATCH_ID}/results"
+        if processing_status == "ended" else None,
+    }
+
+
+class FakeUpstream:
+    """用 httpx.MockTransport 模拟 Messages / Message Batches API"""
+
+    def __init__(self):
+        self.requests = []
+        self.processing_status = "in_progress"
+        self.submitted = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        path = request.url.path
+        if request.method == "POST" and path == "/v1/messages":
+            body = json.loads(request.content)
+            text = _user_text(body["messages"][-1])
+            if text == "fail":
+                return httpx.Response(
+                    400, json={"type": "error", "error": {"type": "invalid_request_error", "message": "bad"}}
+                )
+            return httpx.Response(200, json=_message(f"echo: {text}"))
+        if request.method == "POST" and path == "/v1/messages/batches":
+            self.submitted = json.loads(request.content)["requests"]
+            return httpx.Response(200, json=_batch("in_progress"))
+        if request.method == "GET" and path == f"/v1/messages/batches/{BATCH_ID}":
+            return httpx.Response(200, json=_batch(self.processing_status))
+        if request.method == "POST" and path == f"/v1/messages/batches/{BATCH_ID}/cancel":
+            return httpx.Response(200, json=_batch("canceling"))
+        if request.method == "GET" and path == f"/v1/messages/batches/{BATCH_ID}/results":
+            lines = [
+                {"custom_id": "item-1", "result": {"type": "succeeded", "message": _message("second")}},
+                {"custom_id": "item-0", "result": {
+                    "type": "errored", "error": {"type": "error", "error": {"type": "api_error", "message": "boom"}},
+                }},
+            ]
+            return httpx.Response(200, text="\n".join(json.dumps(line) for line in lines))
+        if path.startswith("/v1/messages/batches/"):
+            return httpx.Response(
+                404, json={"type": "error", "error": {"type": "not_found_error", "message": "missing"}}
+            )
+        return httpx.Response(500, json={"type": "error", "error": {"type": "api_error", "message": path}})
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeUpstream()
+    monkeypatch.setattr(skills_api, "client", anthropic.AsyncAnthropic(
+        api_key="test-key",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(fake)),
+    ))
+    monkeypatch.setattr(skills_api, "RESULT_CACHE_ENABLED", False)
+    return fake
+
+
+def _request(method, url, **kwargs):
+    async def run():
+        transport = httpx.ASGITransport(app=skills_api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.request(method, url, **kwargs)
+
+    return asyncio.run(run())
+
+
+def _ndjson(body: str):
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def test_online_batch_streams_one_line_per_item(upstream):
+    response = _request("POST", "/invoke/batch", json={"requests": [
+        {"skill_ids": ["pdf"], "message": "first"},
+        {"skill_ids": ["pdf"], "message": "fail"},
+        {"skill_ids": ["pdf"], "message": "third"},
+    ]})
+
+    assert response.status_code == 200
+    lines = sorted(_ndjson(response.text), key=lambda line: line["index"])
+    assert [line["index"] for line in lines] == [0, 1, 2]
+    assert lines[0]["status"] == "success"
+    assert lines[0]["response"]["response"] == [{"type": "text", "text": "echo: first"}]
+    assert lines[1]["status"] == "error"
+    assert lines[1]["status_code"] >= 400 and "error" in lines[1]
+    assert lines[2]["response"]["response"] == [{"type": "text", "text": "echo: third"}]
+
+
+def test_online_batch_rejects_too_many_items(upstream, monkeypatch):
+    monkeypatch.setattr(skills_api, "BATCH_MAX_ITEMS", 1)
+    response = _request("POST", "/invoke/batch", json={"requests": [
+        {"skill_ids": ["pdf"], "message": "a"},
+        {"skill_ids": ["pdf"], "message": "b"},
+    ]})
+
+    assert response.status_code == 400
+    assert not upstream.requests
+
+
+def test_offline_batch_submit_poll_and_results(upstream):
+    submitted = _request("POST", "/invoke/batch", json={"mode": "offline", "requests": [
+        {"skill_ids": ["pdf"], "message": "first"},
+        {"skill_ids": ["pdf"], "message": "second"},
+    ]})
+    assert submitted.status_code == 202
+    assert submitted.json()["batch_id"] == BATCH_ID
+    assert [item["custom_id"] for item in upstream.submitted] == ["item-0", "item-1"]
+    assert [_user_text(m) for m in upstream.submitted[1]["params"]["messages"]] == ["second"]
+
+    polled = _request("GET", f"/invoke/batch/{BATCH_ID}")
+    assert polled.status_code == 200
+    assert polled.json()["processing_status"] == "in_progress"
+
+    not_ready = _request("GET", f"/invoke/batch/{BATCH_ID}/results")
+    assert not_ready.status_code == 409
+
+    upstream.processing_status = "ended"
+    results = _request("GET", f"/invoke/batch/{BATCH_ID}/results")
+    assert results.status_code == 200
+    lines = {line["index"]: line for line in _ndjson(results.text)}
+    assert lines[1]["status"] == "success"
+    assert lines[1]["response"]["response"] == [{"type": "text", "text": "second"}]
+    assert lines[0] == {"index": 0, "status": "error", "status_code": 500, "error": "Anthropic API Error: boom"}
+
+
+def test_offline_batch_cancel_and_unknown_id(upstream):
+    cancelled = _request("DELETE", f"/invoke/batch/{BATCH_ID}")
+    assert cancelled.status_code == 200
+    assert cancelled.json()["processing_status"] == "canceling"
+
+    assert _request("GET", "/invoke/batch/msgbatch_missing").status_code == 404
+
+
+def test_offline_batch_rejects_parallel_items(upstream):
+    response = _request("POST", "/invoke/batch", json={"mode": "offline", "requests": [
+        {"skill_ids": ["pdf", "xlsx"], "message": "a", "parallel": True},
+    ]})
+
+    assert response.status_code == 400
+    assert not upstream.requests
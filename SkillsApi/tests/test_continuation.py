@@ -0,0 +1,153 @@
+"""pause_turn 自动继续"""
+import asyncio
+import json
+
+import anthropic
+import httpx
+import pytest
+
+import skills_api
+
+
+class PausingUpstream:
+    """用 httpx.MockTransport 模拟 Messages API：前 pauses 次调用返回 pause_turn，之后返回 end_turn"""
+
+    def __init__(self, pauses: int):
+        self.pauses = pauses
+        self.bodies = []
+
+    def _message(self):
+        part = len(self.bodies)
+        return {
+            "id": f"msg_{part}", "type": "message", "role": "assistant", "model": skills_api.SKILL_MODEL,
+            "content": [{"type": "text", "text": f"part {part}"}],
+            "stop_reason": "pause_turn" if part <= self.pauses else "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": 10, "output_tokens": 20},
+            "container": {"id": "container_test", "expires_at": "2099-01-01T00:00:00Z"},
+        }
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.bodies.append(body)
+        message = self._message()
+        if not body.get("stream"):
+            return httpx.Response(200, json=message)
+        text = message["content"][0]["text"]
+        events = [
+            ("message_start", {"type": "message_start", "message": {
+                **message, "content": [], "stop_reason": None, "usage": {"input_tokens": 10, "output_tokens": 0},
+            }}),
+            ("content_block_start", {"type": "content_block_start", "index": 0,
+                                     "content_block": {"type": "text", "text": ""}}),
+            ("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                     "delta": {"type": "text_delta", "text": text}}),
+            ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+            ("message_delta", {"type": "message_delta", "delta": {"stop_reason": message["stop_reason"],
+                                                                  "stop_sequence": None},
+                               "usage": {"output_tokens": 20}}),
+            ("message_stop", {"type": "message_stop"}),
+        ]
+        sse = "".join(f"event: {name}\ndata: {json.dumps(data)}\n\n" for name, data in events)
+        return httpx.Response(200, text=sse, headers={"content-type": "text/event-stream"})
+
+
+@pytest.fixture
+def use_upstream(monkeypatch):
+    monkeypatch.setattr(skills_api, "RESULT_CACHE_ENABLED", False)
+
+    def install(pauses: int) -> PausingUpstream:
+        fake = PausingUpstream(pauses)
+        monkeypatch.setattr(skills_api, "client", anthropic.AsyncAnthropic(
+            api_key="test-key",
+            max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(fake)),
+        ))
+        return fake
+
+    return install
+
+
+def _post(url, **kwargs):
+    async def run():
+        transport = httpx.ASGITransport(app=skills_api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post(url, **kwargs)
+
+    return asyncio.run(run())
+
+
+def _sse_events(body: str):
+    return [json.loads(line[len("data: "):]) for line in body.splitlines() if line.startswith("data: ")]
+
+
+def test_invoke_continuation_passes_upstream_budget(use_upstream, monkeypatch):
+    # 上游额度估算会序列化整段 messages，自动继续追加的 assistant 内容必须是普通 dict
+    monkeypatch.setattr(skills_api, "UPSTREAM_THROTTLE_ENABLED", True)
+    upstream = use_upstream(pauses=1)
+
+    response = _post("/invoke", json={"skill_ids": ["pdf"], "message": "hi"})
+
+    assert response.status_code == 200, response.text
+    assert len(upstream.bodies) == 2
+    assert upstream.bodies[1]["messages"][-1] == {
+        "role": "assistant", "content": [{"type": "text", "text": "part 1"}],
+    }
+
+
+def test_invoke_merges_continued_turns(use_upstream):
+    upstream = use_upstream(pauses=2)
+
+    response = _post("/invoke", json={"skill_ids": ["pdf"], "message": "hi"})
+
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert len(upstream.bodies) == 3
+    assert body["stop_reason"] == "end_turn"
+    assert [block["text"] for block in body["response"]] == ["part 1", "part 2", "part 3"]
+    assert body["usage"]["output_tokens"] == 60
+    # 每次继续都在同一个容器中，带上之前的全部 assistant 内容
+    assert upstream.bodies[2]["container"]["id"] == "container_test"
+    assert [m["role"] for m in upstream.bodies[2]["messages"]] == ["user", "assistant", "assistant"]
+
+
+def test_invoke_stops_after_max_continuations(use_upstream, monkeypatch):
+    monkeypatch.setattr(skills_api, "PAUSE_TURN_MAX_CONTINUATIONS", 1)
+    upstream = use_upstream(pauses=5)
+
+    response = _post("/invoke", json={"skill_ids": ["pdf"], "message": "hi"})
+
+    assert response.status_code == 200, response.text
+    assert len(upstream.bodies) == 2
+    assert response.json()["stop_reason"] == "pause_turn"
+
+
+def test_stream_merges_continued_turns(use_upstream):
+    upstream = use_upstream(pauses=1)
+
+    response = _post("/stream/invoke", json={"skill_ids": ["pdf"], "message": "hi"})
+
+    events = _sse_events(response.text)
+    types = [event["type"] for event in events]
+    assert len(upstream.bodies) == 2
+    assert types.count("message_start") == 1
+    assert types.count("message_stop") == 1
+    assert {"type": "continuation", "continuation": 1} in events
+    assert events[-1]["type"] == "done"
+    assert events[-1]["stop_reason"] == "end_turn"
+    assert events[-1]["usage"]["output_tokens"] == 40
+    assert upstream.bodies[1]["messages"][-1] == {
+        "role": "assistant", "content": [{"type": "text", "text": "part 1"}],
+    }
+
+
+def test_stream_stops_after_max_continuations(use_upstream, monkeypatch):
+    monkeypatch.setattr(skills_api, "PAUSE_TURN_MAX_CONTINUATIONS", 2)
+    upstream = use_upstream(pauses=5)
+
+    response = _post("/stream/invoke", json={"skill_ids": ["pdf"], "message": "hi"})
+
+    events = _sse_events(response.text)
+    assert len(upstream.bodies) == 3
+    assert [event["continuation"] for event in events if event["type"] == "continuation"] == [1, 2]
+    assert events[-1]["type"] == "done"
+    assert events[-1]["stop_reason"] == "pause_turn"
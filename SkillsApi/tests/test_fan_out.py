@@ -0,0 +1,30 @@
+"""多 Skill 并行 (fan-out)"""
+import asyncio
+
+import pytest
+
+import skills_api
+
+
+def test_failed_branch_waits_for_cancelled_branches(monkeypatch):
+    cleaned_up = []
+
+    async def fake_invoke_upstream(branch_request, skills_config, cache_key, similarity_scope=None):
+        if branch_request.skill_ids == ["pdf"]:
+            await asyncio.sleep(0.01)
+            raise skills_api.HTTPException(status_code=500, detail="boom")
+        try:
+            await asyncio.sleep(10)
+        finally:
+            await asyncio.sleep(0.01)
+            cleaned_up.append(branch_request.skill_ids[0])
+
+    monkeypatch.setattr(skills_api, "_invoke_upstream", fake_invoke_upstream)
+    request = skills_api.SkillRequest(skill_ids=["pdf", "xlsx", "docx"], message="hi", parallel=True)
+
+    async def run():
+        with pytest.raises(skills_api.HTTPException):
+            await skills_api._invoke_fan_out(request, [], None)
+        return list(cleaned_up)
+
+    assert sorted(asyncio.run(run())) == ["docx", "xlsx"]
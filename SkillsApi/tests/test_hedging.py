@@ -0,0 +1,65 @@
+"""Files API 只读请求的对冲"""
+import asyncio
+
+import pytest
+
+import skills_api
+
+
+@pytest.fixture(autouse=True)
+def hedging(monkeypatch):
+    monkeypatch.setattr(skills_api, "FILES_HEDGE_ENABLED", True)
+    monkeypatch.setattr(skills_api, "FILES_HEDGE_DEFAULT_DELAY", 0.01)
+
+
+def _slow_then_fast():
+    """第一次调用一直挂起（直到被取消），之后的调用立即返回"""
+    calls = []
+    cancelled = []
+
+    async def call():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+            return "primary"
+        return "hedge"
+
+    return call, calls, cancelled
+
+
+def test_slow_request_is_hedged_and_loser_cancelled():
+    hedger = skills_api.RequestHedger("test")
+    call, calls, cancelled = _slow_then_fast()
+
+    async def run():
+        result = await hedger.call(call)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "hedge"
+    assert len(calls) == 2
+    assert cancelled == [True]
+    assert hedger.stats["hedged"] == 1
+    assert hedger.stats["hedge_wins"] == 1
+    # 被取消的主请求按已等待时间采样，对冲请求不采样
+    assert len(hedger._latencies) == 1
+    assert hedger._latencies[0] >= 0.01
+
+
+def test_no_hedge_without_budget():
+    hedger = skills_api.RequestHedger("test")
+    hedger._budget = 0
+    calls = []
+
+    async def call():
+        calls.append(None)
+        await asyncio.sleep(0.05)
+        return "primary"
+
+    assert asyncio.run(hedger.call(call)) == "primary"
+    assert len(calls) == 1
+    assert hedger.stats["skipped"] == 1
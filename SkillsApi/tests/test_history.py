@@ -0,0 +1,49 @@
+"""历史压缩"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import skills_api
+
+
+def _history(turns: int):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "x" * 400})
+        messages.append({"role": "assistant", "content": [{"type": "text", "text": f"answer {i} " + "y" * 400}]})
+    messages.append({"role": "user", "content": "latest question"})
+    return messages
+
+
+def test_keep_turns_is_at_least_one():
+    # 配置为 0 时也至少保留当前这一轮（在导入时读取环境变量，用子进程验证）
+    result = subprocess.run(
+        [sys.executable, "-c", "import skills_api; print(skills_api.HISTORY_KEEP_TURNS)"],
+        cwd=Path(skills_api.__file__).parent,
+        env={**os.environ, "HISTORY_KEEP_TURNS": "0"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.split()[-1] == "1"
+
+
+@pytest.mark.parametrize("keep_turns", [1, 2])
+def test_compaction_keeps_latest_turn(monkeypatch, keep_turns):
+    monkeypatch.setattr(skills_api, "HISTORY_KEEP_TURNS", keep_turns)
+    monkeypatch.setattr(skills_api, "HISTORY_TOKEN_BUDGET", 500)
+
+    compacted, saved = skills_api._compact_history(_history(10))
+
+    assert saved > 0
+    # 摘要放在保留下来的第一条 user 消息开头
+    assert compacted[0]["content"][0]["text"].startswith(skills_api.HISTORY_SUMMARY_MARKER)
+    assert skills_api._message_text(compacted[-1]).endswith("latest question")
+
+
+def test_history_under_budget_is_unchanged():
+    messages = _history(2)
+    assert skills_api._compact_history(messages) == (messages, 0)
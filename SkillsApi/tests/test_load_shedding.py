@@ -0,0 +1,82 @@
+"""负载保护：截止时间、排队预测和 503 + Retry-After"""
+import asyncio
+
+import httpx
+import pytest
+
+import skills_api
+from skills_api import AdmissionScheduler
+
+
+@pytest.fixture
+def busy_admission(monkeypatch):
+    """并发数为 1 且名额已被占用、每单位成本约 10 秒的全局准入队列"""
+    scheduler = AdmissionScheduler(capacity=1, max_queue=10)
+    scheduler._seconds_per_cost = 10.0
+    monkeypatch.setattr(skills_api, "admission", scheduler)
+    return scheduler
+
+
+async def _post(path, json, headers):
+    transport = httpx.ASGITransport(app=skills_api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.post(path, json=json, headers=headers)
+
+
+def _run_busy(busy_admission, path, json, headers):
+    async def run():
+        holder = busy_admission.enqueue("other", 1.0)
+        try:
+            return await _post(path, json, headers)
+        finally:
+            busy_admission.release(holder)
+
+    return asyncio.run(run())
+
+
+def test_stream_is_shed_before_response_starts(busy_admission):
+    response = _run_busy(
+        busy_admission,
+        "/stream/invoke",
+        {"skill_ids": ["pdf"], "message": "hi"},
+        {"X-Request-Timeout": "1", "Cache-Control": "no-cache"},
+    )
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_chat_completion_is_shed(busy_admission):
+    response = _run_busy(
+        busy_admission,
+        "/v1/chat/completions",
+        {"messages": [{"role": "user", "content": "hi"}], "stream": True},
+        {"X-Request-Timeout": "1", "Cache-Control": "no-cache"},
+    )
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_chat_completion_waits_in_admission_queue(busy_admission):
+    # 没有耗时观测数据时不预先拒绝，排队到截止时间后丢弃，不调用上游
+    busy_admission._seconds_per_cost = None
+    response = _run_busy(
+        busy_admission,
+        "/v1/chat/completions",
+        {"messages": [{"role": "user", "content": "hi"}], "stream": False},
+        {"X-Request-Timeout": "0.1", "Cache-Control": "no-cache"},
+    )
+    assert response.status_code == 504
+    assert skills_api.SHED_STATS["expired"] >= 1
+
+
+def test_request_without_deadline_is_not_shed(busy_admission):
+    async def run():
+        holder = busy_admission.enqueue("other", 1.0)
+        try:
+            skills_api._request_deadline.set(None)
+            skills_api.SkillSlot(["pdf"], 16384).check_admission()
+            return busy_admission.predict_wait("tenant", 1.0)
+        finally:
+            busy_admission.release(holder)
+
+    assert asyncio.run(run()) == pytest.approx(10.0)
@@ -0,0 +1,48 @@
+"""低峰预生成：多 worker 之间的生成锁"""
+import asyncio
+
+import fakeredis
+
+import skills_api
+
+
+def _skill_response():
+    return skills_api.SkillResponse(
+        status="success", container_id="container_test", stop_reason="end_turn",
+        model=skills_api.SKILL_MODEL, response=[{"type": "text", "text": "report"}], usage={}, file_ids=[],
+    )
+
+
+def test_lock_is_held_for_the_whole_generation(monkeypatch):
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(skills_api, "SKILLS_REDIS_URL", "redis://test")
+    monkeypatch.setattr(skills_api, "_redis_client", redis)
+    monkeypatch.setattr(skills_api, "RESULT_CACHE_ENABLED", True)
+    monkeypatch.setattr(skills_api, "PREGENERATE_LOCK_TTL", 0.3)
+    monkeypatch.setattr(skills_api.PregenerationScheduler, "in_window", staticmethod(lambda hour=None: True))
+    monkeypatch.setattr(skills_api, "result_cache", skills_api.ResultCache(16))
+
+    calls = []
+
+    async def slow_invoke(skill_request, skills_config, cache_key, similarity_scope=None):
+        # 生成时间远超锁的有效期（例如多次 pause_turn 自动继续）
+        calls.append(skill_request.message)
+        await asyncio.sleep(1.0)
+        return _skill_response()
+
+    monkeypatch.setattr(skills_api, "_invoke_upstream", slow_invoke)
+    skill_request = skills_api.SkillRequest(skill_ids=["pdf"], message="pregenerate lock")
+    first, second = skills_api.PregenerationScheduler("unused"), skills_api.PregenerationScheduler("unused")
+
+    async def run():
+        generating = asyncio.create_task(first._generate(skill_request))
+        await asyncio.sleep(0.8)
+        # 另一个 worker 此时尝试生成同一项：锁仍被持有，直接跳过
+        await second._generate(skill_request)
+        await generating
+        return await redis.keys("skills:pregenerate:lock:*")
+
+    remaining_locks = asyncio.run(run())
+    assert calls == ["pregenerate lock"]
+    assert first.stats["generated"] == 1
+    assert remaining_locks == []
@@ -0,0 +1,119 @@
+"""令牌桶限流：Redis 脚本、进程内退化与 RateLimit-* 响应头"""
+import asyncio
+
+import fakeredis
+import httpx
+import pytest
+
+import skills_api
+from skills_api import RateLimiter
+
+
+class BrokenRedis:
+    def register_script(self, script):
+        raise ConnectionError("redis is down")
+
+
+@pytest.fixture
+def redis_storage(monkeypatch):
+    monkeypatch.setattr(skills_api, "RATE_LIMIT_STORAGE", "redis")
+    monkeypatch.setattr(skills_api, "_redis_client", fakeredis.FakeAsyncRedis(decode_responses=True))
+
+
+@pytest.mark.parametrize("storage", ["memory", "redis"])
+def test_bucket_allows_denies_and_refills(storage, monkeypatch, request):
+    if storage == "redis":
+        request.getfixturevalue("redis_storage")
+    else:
+        monkeypatch.setattr(skills_api, "RATE_LIMIT_STORAGE", "memory")
+    limiter = RateLimiter()
+
+    async def run():
+        # 容量 2，每秒补充 5 个
+        hits = [await limiter._hit("test", 5, 2) for _ in range(3)]
+        await asyncio.sleep(0.3)
+        hits.append(await limiter._hit("test", 5, 2))
+        return hits
+
+    first, second, denied, refilled = asyncio.run(run())
+    assert first == pytest.approx(1, abs=0.1)
+    assert second == pytest.approx(0, abs=0.1)
+    assert denied < 0
+    assert refilled >= 0
+    assert limiter.stats["fallbacks"] == 0
+
+
+def test_unreachable_redis_falls_back_to_local_buckets(monkeypatch):
+    monkeypatch.setattr(skills_api, "RATE_LIMIT_STORAGE", "redis")
+    monkeypatch.setattr(skills_api, "_redis_client", BrokenRedis())
+    limiter = RateLimiter()
+
+    async def run():
+        return [await limiter._hit("test", 1, 1) for _ in range(2)]
+
+    allowed, denied = asyncio.run(run())
+    assert allowed >= 0
+    assert denied < 0
+    # 退化期间不再重试 Redis
+    assert limiter.stats["fallbacks"] == 1
+    assert limiter.metrics()["fallback_active"]
+
+
+@pytest.fixture
+def limited_invoke(monkeypatch):
+    """/invoke 限额 2/minute；请求使用无效的 skill_id，通过限流后直接返回 400，不访问上游"""
+    monkeypatch.setattr(skills_api, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(skills_api, "RATE_LIMIT_STORAGE", "memory")
+    monkeypatch.setattr(skills_api, "RATE_LIMIT_ROUTES", {"/invoke": "2/minute"})
+    monkeypatch.setattr(skills_api.limiter, "_buckets", {})
+
+    def post(count, api_key=None, ip="127.0.0.1"):
+        async def run():
+            transport = httpx.ASGITransport(app=skills_api.app, client=(ip, 1234))
+            headers = {skills_api.RATE_LIMIT_KEY_HEADER: api_key} if api_key else {}
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return [
+                    await client.post("/invoke", json={"skill_ids": ["missing"], "message": "hi"}, headers=headers)
+                    for _ in range(count)
+                ]
+
+        return asyncio.run(run())
+
+    return post
+
+
+def test_rate_limit_headers_and_429(limited_invoke):
+    first, second, limited = limited_invoke(3)
+
+    assert [first.status_code, second.status_code] == [400, 400]
+    assert first.headers["RateLimit-Limit"] == "2"
+    assert first.headers["RateLimit-Policy"] == "2;w=60"
+    assert [first.headers["RateLimit-Remaining"], second.headers["RateLimit-Remaining"]] == ["1", "0"]
+    assert "Retry-After" not in second.headers
+
+    assert limited.status_code == 429
+    assert limited.json() == {"error": "Rate limit exceeded: 2 per 1 minute"}
+    assert limited.headers["RateLimit-Remaining"] == "0"
+    assert 1 <= int(limited.headers["Retry-After"]) <= 30
+
+
+def test_clients_are_keyed_by_api_key_then_ip(limited_invoke):
+    assert limited_invoke(3, api_key="key-a")[-1].status_code == 429
+    # 同一 IP 上的其他 key 和不带 key 的请求各有自己的桶
+    assert limited_invoke(1, api_key="key-b")[0].status_code == 400
+    assert limited_invoke(2)[-1].status_code == 400
+    assert limited_invoke(1)[0].status_code == 429
+    assert limited_invoke(1, ip="10.0.0.2")[0].status_code == 400
+    # 按 key 计数时 IP 不影响桶
+    assert limited_invoke(1, api_key="key-a", ip="10.0.0.3")[0].status_code == 429
+
+
+def test_per_key_limit_spans_routes(limited_invoke, monkeypatch):
+    monkeypatch.setattr(skills_api, "RATE_LIMIT_ROUTES", {})
+    monkeypatch.setattr(skills_api, "RATE_LIMIT_PER_KEY", "1/minute")
+
+    first, limited = limited_invoke(2, api_key="key-a")
+
+    assert first.status_code == 400
+    assert limited.status_code == 429
+    assert limited.headers["RateLimit-Limit"] == "1"
@@ -0,0 +1,61 @@
+"""上游重试与熔断"""
+import asyncio
+
+import anthropic
+import httpx
+import pytest
+
+import skills_api
+from skills_api import CircuitBreaker
+
+
+def _status_error(status_code: int) -> anthropic.APIStatusError:
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    response = httpx.Response(status_code, request=request, json={"type": "error", "error": {"type": "x"}})
+    return anthropic.APIStatusError("error", response=response, body=None)
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    monkeypatch.setattr(skills_api, "ANTHROPIC_MAX_RETRIES", 0)
+    monkeypatch.setattr(skills_api, "CIRCUIT_BREAKER_FAILURE_THRESHOLD", 3)
+    breaker = CircuitBreaker("messages")
+    monkeypatch.setitem(skills_api.circuit_breakers, "messages", breaker)
+    return breaker
+
+
+def _call(status_code: int):
+    async def fail():
+        raise _status_error(status_code)
+
+    async def run():
+        try:
+            await skills_api._upstream_call("messages", fail)
+        except (anthropic.APIError, skills_api.HTTPException):
+            pass
+
+    asyncio.run(run())
+
+
+def test_breaker_opens_on_consecutive_overloads(breaker):
+    for _ in range(3):
+        _call(529)
+    assert breaker.state == "open"
+    assert breaker.stats["transitions"] == {"closed->open": 1}
+
+
+def test_rate_limit_does_not_reset_failures(breaker):
+    # 529 与 429 交替：429 不算成功，连续的 529 仍然会触发熔断
+    for status_code in (529, 429, 529, 429, 529):
+        _call(status_code)
+    assert breaker.state == "open"
+
+
+def test_rate_limited_probe_keeps_breaker_half_open(breaker, monkeypatch):
+    for _ in range(3):
+        _call(529)
+    monkeypatch.setattr(skills_api, "CIRCUIT_BREAKER_RESET_TIMEOUT", 0)
+    _call(429)
+    assert breaker.state == "half_open"
+    _call(529)
+    assert breaker.state == "open"
@@ -0,0 +1,273 @@
+"""任务和会话存储：接口与通过 API 的完整生命周期"""
+import asyncio
+import json
+import time
+
+import fakeredis
+import httpx
+import pytest
+from anthropic.types.beta import BetaMessage
+
+import skills_api
+
+
+def _sse_events(body: str):
+    return [json.loads(line[len("data: "):]) for line in body.splitlines() if line.startswith("data: ")]
+
+
+def test_incomplete_job_store_fails_on_creation():
+    class PartialJobStore(skills_api.JobStore):
+        async def create(self, job):
+            pass
+
+    with pytest.raises(TypeError):
+        PartialJobStore()
+
+
+def test_in_memory_job_store_implements_interface():
+    store = skills_api.InMemoryJobStore()
+    assert isinstance(store, skills_api.JobStore)
+
+
+def test_incomplete_session_store_fails_on_creation():
+    class PartialSessionStore(skills_api.SessionStore):
+        async def get(self, session_id):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialSessionStore()
+
+
+def test_in_memory_session_store_implements_interface():
+    store = skills_api.InMemorySessionStore()
+    assert isinstance(store, skills_api.SessionStore)
+
+
+def _skill_response(text):
+    return skills_api.SkillResponse(
+        status="success", container_id="container_test", stop_reason="end_turn",
+        model=skills_api.SKILL_MODEL, response=[{"type": "text", "text": text}], usage={}, file_ids=[],
+    )
+
+
+@pytest.fixture(params=["memory", "redis"])
+def job_store(request, monkeypatch):
+    if request.param == "redis":
+        monkeypatch.setattr(skills_api, "_redis_client", fakeredis.FakeAsyncRedis(decode_responses=True))
+        store = skills_api.RedisJobStore()
+    else:
+        store = skills_api.InMemoryJobStore()
+    monkeypatch.setattr(skills_api, "job_store", store)
+    return store
+
+
+def _run_with_client(scenario):
+    """在同一个事件循环中执行整个场景，后台任务不会随请求结束而被销毁"""
+    async def run():
+        transport = httpx.ASGITransport(app=skills_api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await scenario(client)
+
+    return asyncio.run(run())
+
+
+def test_job_lifecycle_events_and_result(job_store, monkeypatch):
+    release = asyncio.Event()
+
+    def fake_skill_events(skill_request, skills_config, final_response):
+        async def events():
+            yield {"type": "text_delta", "text": "working"}
+            await release.wait()
+            final_response.append(_skill_response("finished"))
+            yield {"type": "done", "container_id": "container_test", "stop_reason": "end_turn"}
+
+        return events()
+
+    monkeypatch.setattr(skills_api, "_skill_events", fake_skill_events)
+
+    async def scenario(client):
+        submitted = await client.post("/jobs", json={"skill_ids": ["pdf"], "message": "hi"})
+        job_id = submitted.json()["job_id"]
+        await asyncio.sleep(0.05)
+        running = await client.get(f"/jobs/{job_id}")
+        not_ready = await client.get(f"/jobs/{job_id}/result")
+        release.set()
+        # 事件订阅先回放已有事件，再跟随到任务结束
+        events = await client.get(f"/jobs/{job_id}/events")
+        finished = await client.get(f"/jobs/{job_id}")
+        result = await client.get(f"/jobs/{job_id}/result")
+        return submitted, running, not_ready, events, finished, result
+
+    submitted, running, not_ready, events, finished, result = _run_with_client(scenario)
+    assert submitted.status_code == 202
+    assert submitted.json()["status"] == "queued"
+    assert running.json()["status"] == "running"
+    assert running.json()["event_count"] == 1
+    assert not_ready.status_code == 409
+    assert [event["type"] for event in _sse_events(events.text)] == ["text_delta", "done"]
+    assert finished.json()["status"] == "succeeded"
+    assert finished.json()["finished_at"] is not None
+    assert result.status_code == 200
+    assert result.json()["response"] == [{"type": "text", "text": "finished"}]
+
+
+def test_job_cancel(job_store, monkeypatch):
+    def fake_skill_events(skill_request, skills_config, final_response):
+        async def events():
+            yield {"type": "text_delta", "text": "working"}
+            await asyncio.Event().wait()
+
+        return events()
+
+    monkeypatch.setattr(skills_api, "_skill_events", fake_skill_events)
+
+    async def scenario(client):
+        job_id = (await client.post("/jobs", json={"skill_ids": ["pdf"], "message": "hi"})).json()["job_id"]
+        await asyncio.sleep(0.05)
+        cancelled = await client.delete(f"/jobs/{job_id}")
+        events = await client.get(f"/jobs/{job_id}/events")
+        result = await client.get(f"/jobs/{job_id}/result")
+        cancelled_again = await client.delete(f"/jobs/{job_id}")
+        return cancelled, events, result, cancelled_again
+
+    cancelled, events, result, cancelled_again = _run_with_client(scenario)
+    assert cancelled.status_code == 200
+    assert cancelled.json()["status"] == "cancelled"
+    assert _sse_events(events.text)[-1] == {"type": "error", "error": "Job cancelled"}
+    assert result.status_code == 500
+    assert cancelled_again.json()["status"] == "cancelled"
+
+
+def test_expired_jobs_are_evicted(monkeypatch):
+    store = skills_api.InMemoryJobStore()
+    monkeypatch.setattr(skills_api, "job_store", store)
+    monkeypatch.setattr(skills_api, "JOB_TTL_SECONDS", 60)
+
+    async def run():
+        await store.create({"job_id": "job_old", "status": "succeeded", "created_at": time.time() - 120})
+        await store.append_event("job_old", {"type": "done"})
+        await store.create({"job_id": "job_new", "status": "queued", "created_at": time.time()})
+        return await store.get("job_old"), await store.read_events("job_old"), await store.get("job_new")
+
+    old, old_events, new = asyncio.run(run())
+    assert old is None
+    assert old_events == []
+    assert new["status"] == "queued"
+    assert _run_with_client(lambda client: client.get("/jobs/job_old")).status_code == 404
+
+
+@pytest.fixture(params=["memory", "redis"])
+def session_store(request, monkeypatch):
+    if request.param == "redis":
+        monkeypatch.setattr(skills_api, "_redis_client", fakeredis.FakeAsyncRedis(decode_responses=True))
+        store = skills_api.RedisSessionStore()
+    else:
+        store = skills_api.InMemorySessionStore()
+    monkeypatch.setattr(skills_api, "session_store", store)
+    return store
+
+
+@pytest.fixture
+def session_upstream(monkeypatch):
+    """每一轮返回 "reply N"，并记录每一轮收到的 container_id 和历史消息"""
+    calls = []
+
+    def fake_stream_events(skill_request, skills_config, on_final_message=None, history=None):
+        calls.append({"container_id": skill_request.container_id, "history": json.loads(json.dumps(history))})
+        message = BetaMessage.model_validate({
+            "id": f"msg_{len(calls)}", "type": "message", "role": "assistant", "model": skills_api.SKILL_MODEL,
+            "content": [{"type": "text", "text": f"reply {len(calls)}"}],
+            "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": 10, "output_tokens": 20},
+            "container": {"id": "container_session", "expires_at": "2099-01-01T00:00:00Z"},
+        })
+
+        async def events():
+            yield {"type": "text_delta", "text": f"reply {len(calls)}"}
+            on_final_message(message)
+            yield {"type": "done", "container_id": "container_session", "stop_reason": "end_turn"}
+
+        return events()
+
+    monkeypatch.setattr(skills_api, "_iter_skill_stream_events", fake_stream_events)
+    return calls
+
+
+def test_session_keeps_history_and_container(session_store, session_upstream):
+    async def scenario(client):
+        session_id = (await client.post("/sessions", json={"skill_ids": ["pdf"]})).json()["session_id"]
+        first = await client.post(f"/sessions/{session_id}/messages", json={"message": "first"})
+        second = await client.post(
+            f"/sessions/{session_id}/messages", json={"message": "second", "stream": True}
+        )
+        session = await client.get(f"/sessions/{session_id}")
+        messages = await client.get(f"/sessions/{session_id}/messages")
+        return first, second, session, messages
+
+    first, second, session, messages = _run_with_client(scenario)
+    assert first.status_code == 200
+    assert first.json()["response"] == [{"type": "text", "text": "reply 1"}]
+    done = _sse_events(second.text)[-1]
+    assert done["type"] == "done" and done["turns"] == 2
+
+    # 第二轮带上第一轮的完整历史，并复用第一轮的容器
+    assert session_upstream[0] == {"container_id": None, "history": []}
+    assert session_upstream[1]["container_id"] == "container_session"
+    assert [m["role"] for m in session_upstream[1]["history"]] == ["user", "assistant"]
+
+    assert session.json()["turns"] == 2
+    assert session.json()["container_id"] == "container_session"
+    assert session.json()["usage"]["output_tokens"] == 40
+    assert messages.json()["messages"] == [
+        {"role": "user", "content": "first"},
+        {"role": "assistant", "content": [{"type": "text", "text": "reply 1"}]},
+        {"role": "user", "content": "second"},
+        {"role": "assistant", "content": [{"type": "text", "text": "reply 2"}]},
+    ]
+
+
+def test_session_delete(session_store, session_upstream):
+    async def scenario(client):
+        session_id = (await client.post("/sessions", json={"skill_ids": ["pdf"]})).json()["session_id"]
+        deleted = await client.delete(f"/sessions/{session_id}")
+        return (
+            deleted,
+            await client.get(f"/sessions/{session_id}"),
+            await client.post(f"/sessions/{session_id}/messages", json={"message": "hi"}),
+            await client.delete(f"/sessions/{session_id}"),
+        )
+
+    deleted, fetched, sent, deleted_again = _run_with_client(scenario)
+    assert deleted.json() == {"status": "deleted", "session_id": deleted.json()["session_id"]}
+    assert [fetched.status_code, sent.status_code, deleted_again.status_code] == [404, 404, 404]
+    assert not session_upstream
+
+
+def test_idle_sessions_expire(monkeypatch, session_upstream):
+    store = skills_api.InMemorySessionStore()
+    monkeypatch.setattr(skills_api, "session_store", store)
+    monkeypatch.setattr(skills_api, "SESSION_TTL_SECONDS", 60)
+
+    async def scenario(client):
+        session_id = (await client.post("/sessions", json={"skill_ids": ["pdf"]})).json()["session_id"]
+        await client.post(f"/sessions/{session_id}/messages", json={"message": "first"})
+        active = await client.get(f"/sessions/{session_id}")
+        store._sessions[session_id]["updated_at"] -= 120
+        return active, await client.get(f"/sessions/{session_id}")
+
+    active, expired = _run_with_client(scenario)
+    assert active.status_code == 200
+    assert expired.status_code == 404
+
+
+def test_redis_sessions_are_saved_with_ttl(monkeypatch):
+    redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    monkeypatch.setattr(skills_api, "_redis_client", redis)
+    monkeypatch.setattr(skills_api, "SESSION_TTL_SECONDS", 60)
+    store = skills_api.RedisSessionStore()
+
+    async def run():
+        await store.save({"session_id": "session_test", "messages": []})
+        return await redis.ttl(f"{store.KEY_PREFIX}session_test")
+
+    assert 0 < asyncio.run(run()) <= 60
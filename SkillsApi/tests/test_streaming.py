@@ -0,0 +1,146 @@
+"""流式调用：幂等重试与回放"""
+import asyncio
+import json
+
+import httpx
+
+import skills_api
+
+
+def _sse_events(body: str):
+    return [json.loads(line[len("data: "):]) for line in body.splitlines() if line.startswith("data: ")]
+
+
+def _live_events(skill_request, skills_config, final_response):
+    """包含排队位置和自动继续事件的一次执行"""
+    async def events():
+        yield {"type": "queued", "pool": "global", "position": 3, "expected_wait": 1.5}
+        yield {"type": "text_delta", "text": "part 1"}
+        yield {"type": "continuation", "continuation": 1}
+        yield {"type": "text_delta", "text": "part 2"}
+        yield {"type": "done", "container_id": "", "stop_reason": "end_turn", "usage": {}, "file_ids": None}
+
+    return events()
+
+
+def _post_stream_twice(json_body, headers=None):
+    async def run():
+        transport = httpx.ASGITransport(app=skills_api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return [
+                await client.post("/stream/invoke", json=json_body, headers=headers or {})
+                for _ in range(2)
+            ]
+
+    return asyncio.run(run())
+
+
+def test_cache_hit_does_not_replay_live_only_events(monkeypatch):
+    monkeypatch.setattr(skills_api, "_skill_events", _live_events)
+    monkeypatch.setattr(skills_api, "RESULT_CACHE_ENABLED", True)
+
+    first, second = _post_stream_twice({"skill_ids": ["pdf"], "message": "cache live-only events"})
+
+    assert first.headers["X-Cache"] == "MISS"
+    assert {"queued", "continuation"} <= {event["type"] for event in _sse_events(first.text)}
+    assert second.headers["X-Cache"] == "HIT"
+    replayed = _sse_events(second.text)
+    assert [event["type"] for event in replayed] == ["text_delta", "text_delta", "done"]
+
+
+def test_idempotent_replay_does_not_replay_live_only_events(monkeypatch):
+    monkeypatch.setattr(skills_api, "_skill_events", _live_events)
+    monkeypatch.setattr(skills_api, "RESULT_CACHE_ENABLED", False)
+
+    first, second = _post_stream_twice(
+        {"skill_ids": ["pdf"], "message": "idempotent live-only events"},
+        headers={"Idempotency-Key": "live-only-events"},
+    )
+
+    assert {"queued", "continuation"} <= {event["type"] for event in _sse_events(first.text)}
+    assert second.headers["Idempotent-Replayed"] == "true"
+    replayed = _sse_events(second.text)
+    assert [event["type"] for event in replayed] == ["text_delta", "text_delta", "done"]
+
+
+def test_idempotent_retry_after_error_calls_upstream_again(monkeypatch):
+    calls = []
+
+    def fake_skill_events(skill_request, skills_config, final_response):
+        calls.append(skill_request.message)
+
+        async def events():
+            if len(calls) == 1:
+                yield {"type": "error", "error": "Anthropic API Error: Overloaded"}
+                return
+            yield {"type": "text_delta", "text": "ok"}
+            yield {"type": "done", "container_id": "", "stop_reason": "end_turn", "usage": {}, "file_ids": None}
+
+        return events()
+
+    monkeypatch.setattr(skills_api, "_skill_events", fake_skill_events)
+    monkeypatch.setattr(skills_api, "RESULT_CACHE_ENABLED", False)
+
+    async def run():
+        transport = httpx.ASGITransport(app=skills_api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            bodies = []
+            for _ in range(2):
+                response = await client.post(
+                    "/stream/invoke",
+                    json={"skill_ids": ["pdf"], "message": "hi"},
+                    headers={"Idempotency-Key": "retry-after-error", "Cache-Control": "no-cache"},
+                )
+                bodies.append(_sse_events(response.text))
+            return bodies
+
+    first, second = asyncio.run(run())
+    assert first[-1]["type"] == "error"
+    assert second[-1]["type"] == "done"
+    assert len(calls) == 2
+
+
+def test_stream_key_is_scoped_to_caller(monkeypatch):
+    release = asyncio.Event()
+    calls = []
+
+    def fake_skill_events(skill_request, skills_config, final_response):
+        calls.append(skill_request.message)
+
+        async def events():
+            yield {"type": "text_delta", "text": skill_request.message}
+            await release.wait()
+            yield {"type": "done", "container_id": "", "stop_reason": "end_turn", "usage": {}, "file_ids": None}
+
+        return events()
+
+    monkeypatch.setattr(skills_api, "_skill_events", fake_skill_events)
+    monkeypatch.setattr(skills_api, "RESULT_CACHE_ENABLED", False)
+
+    def headers(api_key):
+        return {"X-Stream-Key": "report-1", skills_api.RATE_LIMIT_KEY_HEADER: api_key}
+
+    async def run():
+        transport = httpx.ASGITransport(app=skills_api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            async def invoke(api_key, message):
+                return await client.post(
+                    "/stream/invoke", json={"skill_ids": ["pdf"], "message": message}, headers=headers(api_key)
+                )
+
+            owner = asyncio.create_task(invoke("key-a", "owner"))
+            await asyncio.sleep(0.05)
+            # 其他调用方使用相同的 key：开始自己的执行，而不是订阅别人的
+            other = asyncio.create_task(invoke("key-b", "other"))
+            await asyncio.sleep(0.05)
+            release.set()
+            owner, other = await owner, await other
+            watched = await client.get("/stream/by-key/report-1", headers=headers("key-a"))
+            foreign = await client.get("/stream/by-key/report-1", headers=headers("key-c"))
+            return owner, other, watched, foreign
+
+    owner, other, watched, foreign = asyncio.run(run())
+    assert calls == ["owner", "other"]
+    assert _sse_events(other.text)[0] == {"type": "text_delta", "text": "other"}
+    assert _sse_events(watched.text)[0] == {"type": "text_delta", "text": "owner"}
+    assert foreign.status_code == 404